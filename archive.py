@@ -0,0 +1,254 @@
+
+import asyncio
+import json
+import posixpath
+import tarfile
+import time
+import zipfile
+
+from aiohttp import web
+
+from errors import FtpProxyError, InvalidQueryParameter, InvalidRequestBody
+from pool import error_message, Workers
+import tracing
+
+
+# Chunks read ahead for each file fetched concurrently
+BUFFERED_CHUNKS = 16
+MANIFEST = 'manifest.json'
+
+
+def archive_name(path, root='/'):
+    """Name of a remote file in the archive, relative to `root` and never above it"""
+    path = posixpath.normpath('/' + path)
+    root = posixpath.normpath('/' + root)
+    return posixpath.relpath(path, root) if path.startswith(root.rstrip('/') + '/') else path.lstrip('/')
+
+
+class _Sink:
+    """Write-only file object collecting what zipfile writes, to be sent by the response"""
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+class ZipWriter:
+    content_type = 'application/zip'
+    extension = 'zip'
+    needs_size = False
+
+    def __init__(self):
+        self._sink = _Sink()
+        self._zip = zipfile.ZipFile(self._sink, 'w', zipfile.ZIP_STORED)
+        self._entry = None
+
+    def start(self, name, size):
+        info = zipfile.ZipInfo(name, date_time=time.localtime()[:6])
+        # Sizes are only known once written, data descriptors allow streaming
+        self._entry = self._zip.open(info, 'w', force_zip64=True)
+        return self._sink.drain()
+
+    def data(self, chunk):
+        self._entry.write(chunk)
+        return self._sink.drain()
+
+    def end(self):
+        self._entry.close()
+        return self._sink.drain()
+
+    def close(self):
+        self._zip.close()
+        return self._sink.drain()
+
+
+class TarWriter:
+    content_type = 'application/x-tar'
+    extension = 'tar'
+    needs_size = True
+
+    def __init__(self):
+        self._remaining = 0
+        self._size = 0
+
+    def start(self, name, size):
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.mtime = time.time()
+        info.mode = 0o644
+        self._remaining = self._size = size
+        return info.tobuf(tarfile.PAX_FORMAT, 'utf-8', 'surrogateescape')
+
+    def data(self, chunk):
+        # Headers announced the size, files grown since are truncated
+        chunk = chunk[:self._remaining]
+        self._remaining -= len(chunk)
+        return chunk
+
+    def end(self):
+        # Files shrunk since, or failed, are padded with zeros
+        padding = self._remaining + (-self._size) % tarfile.BLOCKSIZE
+        return b'\0' * padding
+
+    def close(self):
+        return b'\0' * (2 * tarfile.BLOCKSIZE)
+
+
+WRITERS = {'zip': ZipWriter, 'tar': TarWriter}
+
+
+class _File:
+    def __init__(self, path, name):
+        self.path = path
+        self.name = name
+        self.size = None
+        self.written = 0
+        self.error = None
+        self.ready = asyncio.Event()
+        self.chunks = asyncio.Queue(BUFFERED_CHUNKS)
+
+    def manifest(self):
+        if self.error is not None:
+            return {'path': self.path, 'name': self.name, 'status': 'error', 'error': self.error}
+        return {'path': self.path, 'name': self.name, 'status': 'ok', 'size': self.written}
+
+
+class Archive:
+    """Fetch remote files with bounded concurrency, in the order they are archived
+
+    Each worker borrows a connection with `connect()` and fetches files one
+    after the other with `open_file(connection, path)`, which returns the
+    file size and an async iterator over its content. Workers read at most
+    `BUFFERED_CHUNKS` ahead of the archive. FtpProxyError only fails the
+    current file, other errors fail it and the connection, which is then
+    replaced.
+    """
+
+    def __init__(self, files, connect, open_file, concurrency):
+        self.files = [_File(path, name) for path, name in files]
+        self.connect = connect
+        self.open_file = open_file
+        self.concurrency = concurrency
+        self._workers = Workers(self.files, connect, self._fetch, self._fail)
+        self._tasks = []
+
+    async def start(self):
+        """Open the first connection, raising connection errors before anything is sent"""
+        lease = self.connect()
+        connection = await lease.__aenter__()
+        self._tasks.append(asyncio.ensure_future(self._workers.run(lease, connection)))
+        for _ in range(min(self.concurrency, len(self.files)) - 1):
+            self._tasks.append(asyncio.ensure_future(self._workers.run()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def _fail(self, file, exc):
+        file.error = error_message(exc)
+        file.ready.set()
+        file.chunks.put_nowait(None)
+
+    async def _fetch(self, connection, file):
+        error = None
+        try:
+            await self._read(connection, file)
+        except asyncio.CancelledError:
+            raise
+        except Exception as exc:
+            file.error = error_message(exc)
+            error = exc
+        file.ready.set()
+        await file.chunks.put(None)
+        if error is not None and not isinstance(error, FtpProxyError):
+            raise error
+
+    async def _read(self, connection, file):
+        file.size, chunks = await self.open_file(connection, file.path)
+        try:
+            file.ready.set()
+            async for chunk in chunks:
+                await file.chunks.put(chunk)
+        finally:
+            await chunks.aclose()
+
+    async def __aiter__(self):
+        """Files in order, once their size is known or they failed"""
+        for file in self.files:
+            await file.ready.wait()
+            yield file
+
+
+async def stream_archive(request, files, connect, open_file, concurrency, format='zip'):
+    """Stream remote `files`, (path, name) pairs, as a zip or tar archive
+
+    Files which could not be fetched are left out, or cut short when they
+    failed once sent, and reported in a last "manifest.json" entry.
+    """
+    writer = WRITERS[format]()
+    archive = Archive(files, connect, open_file, concurrency)
+    await archive.start()
+    try:
+        response = web.StreamResponse()
+        response.content_type = writer.content_type
+        response.headers['Content-Disposition'] = f'attachment; filename="archive.{writer.extension}"'
+        await response.prepare(request)
+
+        async for file in archive:
+            sending = file.error is None and (file.size is not None or not writer.needs_size)
+            if sending:
+                await response.write(writer.start(file.name, file.size))
+            while True:
+                chunk = await file.chunks.get()
+                if chunk is None:
+                    break
+                if sending:
+                    file.written += len(chunk)
+                    await tracing.write(response, writer.data(chunk))
+            if sending:
+                await response.write(writer.end())
+            elif file.error is None:
+                file.error = 'Unknown file size'
+
+        manifest = [file.manifest() for file in archive.files]
+        body = json.dumps({
+            'files': manifest,
+            'count': len(manifest),
+            'errors': sum(1 for entry in manifest if entry['status'] == 'error'),
+        }, indent=2).encode()
+        await response.write(writer.start(MANIFEST, len(body)) + writer.data(body) + writer.end())
+        await response.write(writer.close())
+        return response
+    finally:
+        await archive.stop()
+
+
+def parse_format(request):
+    format = request.query.get('format', 'zip')
+    if format not in WRITERS:
+        raise InvalidQueryParameter('format')
+    return format
+
+
+async def read_files(request):
+    """Paths given as a JSON {"paths": [...]} body, None without body"""
+    if not request.can_read_body:
+        return None
+    try:
+        paths = (await request.json())['paths']
+    except (ValueError, TypeError, KeyError):
+        raise InvalidRequestBody('{"paths": [<path>, ...]}')
+    if not isinstance(paths, list) or not all(isinstance(path, str) and path for path in paths):
+        raise InvalidRequestBody('{"paths": [<path>, ...]}')
+    return paths
@@ -0,0 +1,62 @@
+"""TCP relay adding latency between the proxy and a local test server"""
+
+import asyncio
+
+
+class LatencyRelay:
+    """Forward connections from `port` to `target_port`, delaying every packet
+
+    `rtt` is the added round trip time in seconds, half of it applied in each
+    direction. Bandwidth is not limited.
+    """
+    def __init__(self, target_port, port, rtt, host='localhost'):
+        self.host = host
+        self.target_port = target_port
+        self.port = port
+        self.delay = rtt / 2
+        self.server = None
+
+    async def __aenter__(self):
+        self.server = await asyncio.start_server(self._relay, self.host, self.port)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def _relay(self, client_reader, client_writer):
+        try:
+            server_reader, server_writer = await asyncio.open_connection(self.host, self.target_port)
+        except OSError:
+            client_writer.close()
+            return
+        await asyncio.gather(
+            self._pipe(client_reader, server_writer),
+            self._pipe(server_reader, client_writer),
+        )
+
+    async def _pipe(self, reader, writer):
+        loop = asyncio.get_event_loop()
+        queue = asyncio.Queue()
+
+        async def deliver():
+            while True:
+                due, data = await queue.get()
+                await asyncio.sleep(max(0, due - loop.time()))
+                if not data:
+                    writer.close()
+                    return
+                writer.write(data)
+                await writer.drain()
+
+        delivery = asyncio.ensure_future(deliver())
+        try:
+            while True:
+                data = await reader.read(65536)
+                await queue.put((loop.time() + self.delay, data))
+                if not data:
+                    break
+            await delivery
+        except (OSError, asyncio.CancelledError):
+            delivery.cancel()
+            writer.close()
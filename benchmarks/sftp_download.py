@@ -0,0 +1,93 @@
+"""SFTP download throughput through the proxy, against the local asyncssh test server
+
+Compares the serial reads used before (a single request in flight) with the
+pipelined reads, for increasing round trip times between proxy and server.
+
+    python benchmarks/sftp_download.py --size 32 --rtt 0 10 50
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+import aiohttp
+import asyncssh
+from aiohttp import web
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.dirname(here), os.path.join(os.path.dirname(here), 'tests'), here]
+
+import config  # noqa: E402
+from ftp_proxy import init_func  # noqa: E402
+from latency import LatencyRelay  # noqa: E402
+from sftp_test import SSHServer, SFTPServer  # noqa: E402
+
+
+SFTP_PORT = 8022
+RELAY_PORT = 8023
+PROXY_PORT = 8080
+
+
+async def download(session, size, port):
+    headers = {
+        'X-ftpproxy-host': 'localhost',
+        'X-ftpproxy-port': str(port),
+        'X-ftpproxy-user': SSHServer.USERNAME,
+        'X-ftpproxy-password': SSHServer.PASSWORD,
+    }
+    start = time.perf_counter()
+    async with session.get(f'http://localhost:{PROXY_PORT}/sftp/download', headers=headers,
+                           params={'path': 'payload.bin'}) as resp:
+        assert resp.status == 200, await resp.text()
+        received = 0
+        async for chunk in resp.content.iter_any():
+            received += len(chunk)
+    assert received == size
+    return time.perf_counter() - start
+
+
+async def run(args):
+    size = args.size * 1024 * 1024
+    with open('payload.bin', 'wb') as fp:
+        fp.write(os.urandom(size))
+
+    host_key = asyncssh.generate_private_key('ecdsa-sha2-nistp256')
+    await asyncssh.create_server(SSHServer, host='', port=SFTP_PORT, sftp_factory=SFTPServer,
+                                 server_host_keys=[host_key])
+    runner = web.AppRunner(init_func())
+    await runner.setup()
+    await web.TCPSite(runner, 'localhost', PROXY_PORT).start()
+
+    print(f'{"rtt (ms)":>9} {"window":>7} {"MB/s":>9}')
+    async with aiohttp.ClientSession() as session:
+        for port, rtt in enumerate(args.rtt, start=RELAY_PORT):
+            # One relay port per latency, so that each gets its own pooled connection
+            async with LatencyRelay(SFTP_PORT, port, rtt / 1000):
+                for window in (1, args.window):
+                    config.SFTP_READ_WINDOW = window
+                    await download(session, size, port)  # warm up the connection pool
+                    elapsed = min([await download(session, size, port) for _ in range(args.repeat)])
+                    print(f'{rtt:>9} {window:>7} {args.size / elapsed:>9.1f}')
+
+    await runner.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, default=16, help='file size in MiB')
+    parser.add_argument('--rtt', type=float, nargs='+', default=[0, 10, 50], help='added round trip times in ms')
+    parser.add_argument('--window', type=int, default=config.SFTP_READ_WINDOW, help='pipelined read requests')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root:
+        # The test SFTP server serves the current directory
+        os.chdir(root)
+        asyncio.get_event_loop().run_until_complete(run(args))
+
+
+if __name__ == '__main__':
+    main()
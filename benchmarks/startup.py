@@ -0,0 +1,78 @@
+"""Startup time of the proxy, for each set of enabled protocols and event loop
+
+Measures, over several cold starts, the time taken to import ftp_proxy and
+the time from starting `ftpproxy serve` until it answers a first request,
+along with its resident memory at that point.
+
+    python benchmarks/startup.py --runs 10 --protocols ftp ftp,sftp --loop asyncio uvloop
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+here = os.path.dirname(os.path.abspath(__file__))
+root = os.path.dirname(here)
+
+PORT = 8082
+
+
+def environment(protocols, loop):
+    return {**os.environ, 'FTPPROXY_PROTOCOLS': protocols, 'FTPPROXY_EVENT_LOOP': loop}
+
+
+def import_time(protocols, loop):
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-c', 'import ftp_proxy'], cwd=root, env=environment(protocols, loop), check=True)
+    return time.perf_counter() - start
+
+
+def rss(pid):
+    with open(f'/proc/{pid}/status') as fp:
+        for line in fp:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def first_response_time(protocols, loop):
+    """Seconds until the server answers, and its resident memory then"""
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, '-c', 'import ftp_proxy; ftp_proxy.cli()', '--host', 'localhost', '--port', str(PORT)],
+                               cwd=root, env=environment(protocols, loop), stdout=subprocess.DEVNULL)
+    try:
+        while process.poll() is None:
+            try:
+                with urllib.request.urlopen(f'http://localhost:{PORT}/stats', timeout=1):
+                    return time.perf_counter() - start, rss(process.pid)
+            except (urllib.error.URLError, ConnectionError):
+                time.sleep(0.005)
+        raise RuntimeError(f'proxy exited with status {process.returncode}')
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--protocols', nargs='+', default=['ftp', 'ftp,sftp'], help='values of FTPPROXY_PROTOCOLS')
+    parser.add_argument('--loop', nargs='+', default=['asyncio'], choices=['asyncio', 'uvloop'])
+    args = parser.parse_args()
+
+    print(f'{"protocols":<12}{"loop":<10}{"import ms":>12}{"first response ms":>20}{"RSS MB":>10}')
+    for protocols in args.protocols:
+        for loop in args.loop:
+            imports = [import_time(protocols, loop) for _ in range(args.runs)]
+            starts, memory = zip(*[first_response_time(protocols, loop) for _ in range(args.runs)])
+            print(f'{protocols:<12}{loop:<10}{statistics.median(imports) * 1000:>12.0f}'
+                  f'{statistics.median(starts) * 1000:>20.0f}{max(memory) / 1024 / 1024:>10.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,287 @@
+"""Load and throughput benchmarks of the proxy against the local test servers
+
+Runs the proxy in a child process, so that its memory and CPU usage can be
+measured, and drives ping, ls and download requests at each concurrency
+level. Network latency between the proxy and the servers is added by a
+relay (FTP data connections are not relayed, only control connections).
+
+    python benchmarks/suite.py --concurrency 1 16 --rtt 0 20 --output results.json
+    python benchmarks/suite.py --compare results.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import aiohttp
+import asyncssh
+
+here = os.path.dirname(os.path.abspath(__file__))
+root = os.path.dirname(here)
+sys.path[:0] = [root, os.path.join(root, 'tests'), here]
+
+from latency import LatencyRelay  # noqa: E402
+from ftp_test import FtpServer  # noqa: E402
+from sftp_test import SSHServer, SFTPServer  # noqa: E402
+
+
+FTP_PORT = 2221
+SFTP_PORT = 8022
+RELAY_PORTS = {'ftp': 2231, 'sftp': 8032}
+PROXY_PORT = 8081
+BLOCK = os.urandom(1024 * 1024)
+
+SCENARIOS = {
+    # name: (protocol, route, query params)
+    'ftp-ping': ('ftp', 'ping', {}),
+    'ftp-ls': ('ftp', 'ls', {'path': '/tree'}),
+    'ftp-ls-recursive': ('ftp', 'ls', {'path': '/tree', 'recursive': 'true'}),
+    'ftp-download-small': ('ftp', 'download', {'path': '/small.bin'}),
+    'ftp-download-large': ('ftp', 'download', {'path': '/large.bin'}),
+    'sftp-ping': ('sftp', 'ping', {}),
+    'sftp-ls': ('sftp', 'ls', {'path': '/tree'}),
+    'sftp-ls-recursive': ('sftp', 'ls', {'path': '/tree', 'recursive': 'true'}),
+    'sftp-download-small': ('sftp', 'download', {'path': '/small.bin'}),
+    'sftp-download-large': ('sftp', 'download', {'path': '/large.bin'}),
+}
+
+
+def write_file(path, size):
+    """Incompressible content, repeating a random block to be quick to generate"""
+    with open(path, 'wb') as fp:
+        while size > 0:
+            fp.write(BLOCK[:size])
+            size -= len(BLOCK)
+
+
+def generate_tree(path, depth, fanout, files):
+    os.makedirs(path, exist_ok=True)
+    for i in range(files):
+        with open(os.path.join(path, f'file{i}.csv'), 'w') as fp:
+            fp.write('a,b,c\n')
+    if depth > 0:
+        for i in range(fanout):
+            generate_tree(os.path.join(path, f'dir{i}'), depth - 1, fanout, files)
+
+
+class ProxyProcess:
+    """The proxy in a child process, sampling its resident memory and CPU time"""
+
+    def __init__(self, port):
+        self.port = port
+        self.process = None
+
+    async def __aenter__(self):
+        code = ('from aiohttp import web; from ftp_proxy import init_func; '
+                f'web.run_app(init_func(), host="localhost", port={self.port}, print=None)')
+        self.process = subprocess.Popen([sys.executable, '-c', code], cwd=root)
+        async with aiohttp.ClientSession() as session:
+            for _ in range(100):
+                try:
+                    async with session.get(f'http://localhost:{self.port}/stats'):
+                        return self
+                except aiohttp.ClientConnectionError:
+                    await asyncio.sleep(0.1)
+        raise RuntimeError('proxy did not start')
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.process.terminate()
+        self.process.wait()
+
+    def cpu_time(self):
+        with open(f'/proc/{self.process.pid}/stat') as fp:
+            fields = fp.read().rsplit(')', 1)[1].split()
+        # utime and stime, in clock ticks
+        return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+    def rss(self):
+        with open(f'/proc/{self.process.pid}/status') as fp:
+            for line in fp:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+        return 0
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+async def request(session, protocol, route, params, accept_encoding):
+    port = RELAY_PORTS[protocol]
+    headers = {
+        'X-ftpproxy-host': 'localhost',
+        'X-ftpproxy-port': str(port),
+        'Accept-Encoding': accept_encoding,
+    }
+    if protocol == 'sftp':
+        headers.update({'X-ftpproxy-user': SSHServer.USERNAME, 'X-ftpproxy-password': SSHServer.PASSWORD})
+    start = time.perf_counter()
+    async with session.get(f'http://localhost:{PROXY_PORT}/{protocol}/{route}', headers=headers, params=params) as resp:
+        received = 0
+        async for chunk in resp.content.iter_any():
+            received += len(chunk)
+        if resp.status != 200:
+            raise RuntimeError(f'{protocol}/{route} failed with HTTP {resp.status}')
+    return time.perf_counter() - start, received
+
+
+async def run_scenario(proxy, name, concurrency, requests, accept_encoding):
+    protocol, route, params = SCENARIOS[name]
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector, auto_decompress=False) as session:
+        # Warm up the proxy connection pools
+        await request(session, protocol, route, params, accept_encoding)
+
+        latencies = []
+        received = 0
+        remaining = requests
+
+        async def client():
+            nonlocal received, remaining
+            while remaining > 0:
+                remaining -= 1
+                latency, size = await request(session, protocol, route, params, accept_encoding)
+                latencies.append(latency)
+                received += size
+
+        rss = proxy.rss()
+
+        async def sample():
+            nonlocal rss
+            while True:
+                rss = max(rss, proxy.rss())
+                await asyncio.sleep(0.1)
+
+        sampler = asyncio.ensure_future(sample())
+        cpu_start = proxy.cpu_time()
+        start = time.perf_counter()
+        await asyncio.gather(*[client() for _ in range(concurrency)])
+        elapsed = time.perf_counter() - start
+        cpu = proxy.cpu_time() - cpu_start
+        sampler.cancel()
+
+    return {
+        'requests': len(latencies),
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+        'requests_per_sec': round(len(latencies) / elapsed, 1),
+        'mb_per_sec': round(received / elapsed / 1024 / 1024, 2),
+        'proxy_cpu_percent': round(cpu / elapsed * 100, 1),
+        'proxy_max_rss_mb': round(rss / 1024 / 1024, 1),
+    }
+
+
+async def run(args):
+    write_file('small.bin', args.small_size * 1024)
+    write_file('large.bin', args.large_size * 1024 * 1024)
+    generate_tree('tree', args.tree_depth, args.tree_fanout, args.tree_files)
+
+    loop = asyncio.get_event_loop()
+    host_key = asyncssh.generate_private_key('ecdsa-sha2-nistp256')
+    ssh_server = await asyncssh.create_server(SSHServer, host='', port=SFTP_PORT, sftp_factory=SFTPServer,
+                                              server_host_keys=[host_key])
+    results = []
+    async with FtpServer(loop, port=FTP_PORT), ProxyProcess(PROXY_PORT) as proxy:
+        for rtt in args.rtt:
+            async with LatencyRelay(FTP_PORT, RELAY_PORTS['ftp'], rtt / 1000), \
+                    LatencyRelay(SFTP_PORT, RELAY_PORTS['sftp'], rtt / 1000):
+                for name in args.scenario:
+                    for concurrency in args.concurrency:
+                        large = name.endswith('-large')
+                        requests = (args.large_requests or concurrency) if large else args.requests
+                        result = await run_scenario(proxy, name, concurrency, requests, args.accept_encoding)
+                        result.update(scenario=name, rtt_ms=rtt, concurrency=concurrency)
+                        results.append(result)
+                        print_result(result)
+    ssh_server.close()
+    return results
+
+
+COLUMNS = ['scenario', 'rtt_ms', 'concurrency', 'requests', 'p50_ms', 'p99_ms', 'requests_per_sec', 'mb_per_sec',
+           'proxy_cpu_percent', 'proxy_max_rss_mb']
+
+
+def print_header():
+    print(' '.join(f'{column:>{max(len(column), 20 if i == 0 else 0)}}' for i, column in enumerate(COLUMNS)))
+
+
+def print_result(result, baseline=None):
+    cells = []
+    for i, column in enumerate(COLUMNS):
+        width = max(len(column), 20 if i == 0 else 0)
+        value = f'{result[column]}'
+        if baseline is not None and i > 3 and baseline.get(column):
+            value += f' ({(result[column] / baseline[column] - 1) * 100:+.0f}%)'
+        cells.append(f'{value:>{width}}')
+    print(' '.join(cells))
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=root).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, path):
+    """Print results of a previous run, with the change of the current one"""
+    with open(path) as fp:
+        baseline = {(r['scenario'], r['rtt_ms'], r['concurrency']): r for r in json.load(fp)['results']}
+    print(f'\nChange from {path}')
+    print_header()
+    for result in results:
+        print_result(result, baseline.get((result['scenario'], result['rtt_ms'], result['concurrency'])))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scenario', nargs='+', choices=sorted(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 16], help='concurrent clients')
+    parser.add_argument('--requests', type=int, default=200, help='requests per scenario and concurrency')
+    parser.add_argument('--large-requests', type=int, help='large file downloads, defaults to the concurrency')
+    parser.add_argument('--rtt', type=float, nargs='+', default=[0.0], help='added round trip times in ms')
+    parser.add_argument('--small-size', type=int, default=64, help='small file size in KiB')
+    parser.add_argument('--large-size', type=int, default=256, help='large file size in MiB')
+    parser.add_argument('--tree-depth', type=int, default=3, help='levels of folders listed recursively')
+    parser.add_argument('--tree-fanout', type=int, default=4, help='folders per folder')
+    parser.add_argument('--tree-files', type=int, default=20, help='files per folder')
+    parser.add_argument('--accept-encoding', default='identity', help='Accept-Encoding header of requests')
+    parser.add_argument('--output', help='save results to this JSON file')
+    parser.add_argument('--compare', help='JSON results of a previous run to compare with')
+    args = parser.parse_args()
+
+    print_header()
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        # The test servers serve the current directory
+        os.chdir(directory)
+        try:
+            results = asyncio.get_event_loop().run_until_complete(run(args))
+        finally:
+            os.chdir(cwd)
+
+    report = {
+        'revision': git_revision(),
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'settings': {name: value for name, value in os.environ.items() if name.startswith('FTPPROXY_')},
+        'arguments': vars(args),
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(report, fp, indent=2)
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
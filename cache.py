@@ -0,0 +1,263 @@
+
+import asyncio
+import collections
+import concurrent.futures
+import contextlib
+import functools
+import hashlib
+import json
+import posixpath
+import sqlite3
+import time
+
+from aiohttp import web
+
+from singleflight import SingleFlight
+
+
+class _Listing:
+    def __init__(self, scope, path, recursive, body):
+        self.scope = scope
+        self.path = path
+        self.recursive = recursive
+        self.body = body
+        self.created = time.monotonic()
+
+
+def normalize_path(path):
+    return posixpath.normpath('/' + (path or '').lstrip('/'))
+
+
+def cache_control(request):
+    """Maximum accepted age of a cached listing, None if unspecified, 0 for no-cache"""
+    max_age = None
+    for directive in request.headers.get('Cache-Control', '').split(','):
+        name, _, value = directive.strip().partition('=')
+        if name.lower() == 'no-cache':
+            return 0
+        if name.lower() == 'max-age':
+            try:
+                max_age = max(int(value), 0)
+            except ValueError:
+                pass
+    return max_age
+
+
+class ListingCache:
+    """In-process LRU of serialized directory listings, bounded by their size in bytes
+
+    Listings are keyed by a hash of the protocol, credentials, path and every
+    listing option. Concurrent misses on a same key share a single upstream
+    listing.
+    """
+
+    def __init__(self, max_bytes, ttl):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        self._entries = collections.OrderedDict()
+        self._flights = SingleFlight('ls')
+        self.counters = collections.Counter()
+
+    @staticmethod
+    def key(protocol, credentials, path, **options):
+        data = json.dumps([protocol, list(credentials), path, sorted(options.items())])
+        return hashlib.sha256(data.encode()).hexdigest()
+
+    def get(self, key, max_age):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if time.monotonic() - entry.created > max_age:
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def put(self, key, entry):
+        if len(entry.body) > self.max_bytes:
+            return
+        self._remove(key)
+        self._entries[key] = entry
+        self.size += len(entry.body)
+        while self.size > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.counters['evictions'] += 1
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry.body)
+
+    def invalidate(self, scope, path=None):
+        """Drop listings which may include `path` on the server given by `scope`"""
+        dropped = 0
+        for key, entry in list(self._entries.items()):
+            if entry.scope != scope:
+                continue
+            if path is not None and not _overlaps(entry, path):
+                continue
+            self._remove(key)
+            dropped += 1
+        return dropped
+
+    async def run(self, function, *args):
+        """Call `function`, a method of the cache, in-process caches being fast enough for the event loop"""
+        return function(*args)
+
+    async def fetch(self, key, entry_factory, max_age, store=True):
+        """Cached listing if fresh enough, else the result of a single shared `entry_factory()` call"""
+        entry = await self.run(self.get, key, max_age) if max_age else None
+        if entry is not None:
+            self.counters['hits'] += 1
+            return entry, True
+
+        self.counters['misses'] += 1
+        if self._flights.running(key):
+            self.counters['shared'] += 1
+        return await self._flights.run(key, functools.partial(self._populate, key, entry_factory, store)), False
+
+    async def _populate(self, key, entry_factory, store):
+        entry = await entry_factory()
+        if store:
+            await self.run(self.put, key, entry)
+        return entry
+
+    def stats(self):
+        return {
+            'max_bytes': self.max_bytes,
+            'ttl': self.ttl,
+            'bytes': self.size,
+            'entries': len(self._entries),
+            **{name: self.counters[name] for name in ('hits', 'misses', 'shared', 'evictions')},
+        }
+
+
+class SharedListingCache(ListingCache):
+    """Listing cache shared by the worker processes of a server, in a SQLite database
+
+    Listings are read from the database on every hit, so that invalidations
+    from any worker apply to all of them. Concurrent misses are only shared
+    within a worker. Database calls wait for the locks of other workers, they
+    are run one at a time in a thread of their own.
+    """
+
+    def __init__(self, filename, max_bytes, ttl):
+        super().__init__(max_bytes, ttl)
+        self._executor = concurrent.futures.ThreadPoolExecutor(1)
+        self._db = sqlite3.connect(filename, timeout=10, isolation_level=None, check_same_thread=False)
+        # Readers do not block the writer
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS listings ('
+                         'key TEXT PRIMARY KEY, scope TEXT, path TEXT, recursive INTEGER, body BLOB, created REAL, used REAL)')
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        self._db.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        except BaseException:
+            self._db.execute('ROLLBACK')
+            raise
+        self._db.execute('COMMIT')
+
+    def get(self, key, max_age):
+        row = self._db.execute('SELECT scope, path, recursive, body, created FROM listings WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        scope, path, recursive, body, created = row
+        if time.time() - created > max_age:
+            return None
+        self._db.execute('UPDATE listings SET used = ? WHERE key = ?', (time.time(), key))
+        return _Listing(tuple(json.loads(scope)), path, bool(recursive), body)
+
+    def put(self, key, entry):
+        if len(entry.body) > self.max_bytes:
+            return
+        now = time.time()
+        with self._transaction():
+            self._db.execute('INSERT OR REPLACE INTO listings VALUES (?, ?, ?, ?, ?, ?, ?)',
+                             (key, json.dumps(entry.scope), entry.path, entry.recursive, entry.body, now, now))
+            size = self._size()
+            while size > self.max_bytes:
+                oldest, length = self._db.execute('SELECT key, length(body) FROM listings ORDER BY used LIMIT 1').fetchone()
+                self._db.execute('DELETE FROM listings WHERE key = ?', (oldest,))
+                size -= length
+                self.counters['evictions'] += 1
+
+    def _size(self):
+        return self._db.execute('SELECT coalesce(sum(length(body)), 0) FROM listings').fetchone()[0]
+
+    def invalidate(self, scope, path=None):
+        rows = self._db.execute('SELECT key, path, recursive FROM listings WHERE scope = ?', (json.dumps(scope),)).fetchall()
+        keys = [(key,) for key, entry_path, recursive in rows
+                if path is None or _overlaps(_Listing(scope, entry_path, bool(recursive), b''), path)]
+        with self._transaction():
+            self._db.executemany('DELETE FROM listings WHERE key = ?', keys)
+        return len(keys)
+
+    def stats(self):
+        return {
+            **super().stats(),
+            'bytes': self._size(),
+            'entries': self._db.execute('SELECT count(*) FROM listings').fetchone()[0],
+        }
+
+    async def run(self, function, *args):
+        return await asyncio.get_event_loop().run_in_executor(self._executor, function, *args)
+
+    def close(self):
+        self._executor.shutdown()
+        self._db.close()
+
+
+def _overlaps(entry, path):
+    if entry.path == path:
+        return True
+    # Listings including the invalidated path
+    if path.startswith(entry.path.rstrip('/') + '/') and (entry.recursive or posixpath.dirname(path) == entry.path):
+        return True
+    # Listings below the invalidated path
+    return entry.path.startswith(path.rstrip('/') + '/')
+
+
+async def cached_listing(request, protocol, credentials, path, list_files, **options):
+    """JSON response listing `path`, served from the application listing cache when possible
+
+    `list_files()` returns the listing to cache. Clients may request fresher
+    listings with a "Cache-Control: max-age=<seconds>" or "no-cache" header.
+    """
+    cache = request.app['listing_cache']
+    host, port = credentials[:2]
+    key = cache.key(protocol, credentials, path, **options)
+
+    async def entry_factory():
+        files = await list_files()
+        return _Listing((protocol, host, port), normalize_path(path), options.get('recursive', False), json.dumps(files).encode())
+
+    max_age = cache_control(request)
+    if max_age is None:
+        max_age = cache.ttl
+    # no-cache still refreshes the cached listing for other clients
+    entry, hit = await cache.fetch(key, entry_factory, max_age, store=bool(max_age or cache.ttl))
+    return web.Response(body=entry.body, content_type='application/json',
+                        headers={'X-ftpproxy-cache': 'hit' if hit else 'miss'})
+
+
+async def invalidate(request, protocol, credentials):
+    """Drop cached listings of a server, optionally only those including the `path` query param"""
+    host, port = credentials[:2]
+    path = request.query.get('path')
+    listing_cache = request.app['listing_cache']
+    dropped = await listing_cache.run(listing_cache.invalidate, (protocol, host, port), path and normalize_path(path))
+    return web.json_response({'invalidated': dropped})
+
+
+async def invalidate_file(request, protocol, credentials, path):
+    """Drop cached listings including a file changed through the proxy, and its cached download"""
+    host, port = credentials[:2]
+    listing_cache = request.app['listing_cache']
+    await listing_cache.run(listing_cache.invalidate, (protocol, host, port), normalize_path(path))
+    download_cache = request.app['download_cache']
+    if download_cache is not None:
+        download_cache.discard(download_cache.key(protocol, credentials, path))
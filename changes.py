@@ -0,0 +1,162 @@
+
+import asyncio
+import contextlib
+import hashlib
+import json
+import os
+import re
+import time
+import uuid
+import zlib
+
+from aiohttp import web
+
+from cache import ListingCache
+from errors import ExpiredCursor, InvalidQueryParameter
+
+
+# Age after which a partially written snapshot is considered abandoned
+PART_MAX_AGE = 3600
+
+_CURSOR = re.compile(r'^[0-9a-f]{32}$')
+
+
+def encode(entries):
+    """Snapshot of listing entries, sorted paths being stored as the length of their prefix shared with the previous one"""
+    rows = []
+    previous = ''
+    for path, type, size, modified in sorted((entry['path'], entry['type'], entry['size'], entry['modified']) for entry in entries):
+        common = len(os.path.commonprefix([previous, path]))
+        rows.append([common, path[common:], type, size, modified])
+        previous = path
+    return json.dumps(rows, separators=(',', ':')).encode()
+
+
+def decode(body):
+    """{path: (type, size, modified)} of an encoded snapshot"""
+    entries = {}
+    path = ''
+    for common, suffix, type, size, modified in json.loads(body):
+        path = path[:common] + suffix
+        entries[path] = type, size, modified
+    return entries
+
+
+class SnapshotStore:
+    """Listing snapshots kept on disk, named by the cursor returned to clients
+
+    Cursors are made of a hash of the listing scope (protocol, credentials,
+    path and options), so that they are only used for the listing they were
+    returned for, and a hash of the snapshot content, so that unchanged
+    listings keep their cursor. Least recently used snapshots are removed
+    beyond `max_bytes`, files being safely shared by worker processes.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def scope(protocol, credentials, path, **options):
+        return ListingCache.key(protocol, credentials, path, **options)[:16]
+
+    def _filename(self, cursor):
+        return os.path.join(self.directory, f'{cursor}.snapshot')
+
+    def _read(self, scope, cursor):
+        if not _CURSOR.match(cursor) or not cursor.startswith(scope):
+            raise InvalidQueryParameter('cursor')
+        filename = self._filename(cursor)
+        try:
+            with open(filename, 'rb') as fp:
+                data = fp.read()
+            # Last used, for eviction
+            os.utime(filename)
+        except FileNotFoundError:
+            raise ExpiredCursor
+        return decode(zlib.decompress(data))
+
+    def _write(self, scope, entries):
+        body = encode(entries)
+        cursor = scope + hashlib.sha256(body).hexdigest()[:16]
+        filename = self._filename(cursor)
+        if os.path.exists(filename):
+            os.utime(filename)
+            return cursor
+        temporary = f'{filename}.{uuid.uuid4().hex}.part'
+        with open(temporary, 'wb') as fp:
+            fp.write(zlib.compress(body))
+        os.replace(temporary, filename)
+        self._evict(keep=filename)
+        return cursor
+
+    def _evict(self, keep):
+        snapshots = []
+        for entry in os.scandir(self.directory):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                # Removed by another worker
+                continue
+            if entry.name.endswith('.part'):
+                # Left by a crash
+                if stat.st_mtime < time.time() - PART_MAX_AGE:
+                    with contextlib.suppress(FileNotFoundError):
+                        os.unlink(entry.path)
+                continue
+            snapshots.append((stat.st_mtime, entry.path, stat.st_size))
+        size = sum(snapshot[2] for snapshot in snapshots)
+        for _, filename, file_size in sorted(snapshots):
+            if size <= self.max_bytes:
+                break
+            if filename == keep:
+                continue
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(filename)
+            size -= file_size
+
+    async def load(self, scope, cursor):
+        """Snapshot returned with `cursor`, as {path: (type, size, modified)}"""
+        return await asyncio.get_event_loop().run_in_executor(None, self._read, scope, cursor)
+
+    async def save(self, scope, entries):
+        """Store a snapshot of listing `entries`, returning its cursor"""
+        return await asyncio.get_event_loop().run_in_executor(None, self._write, scope, entries)
+
+
+def diff(previous, entries):
+    """Entries added and modified since the `previous` snapshot, and removed paths"""
+    added = []
+    modified = []
+    paths = set()
+    for entry in entries:
+        paths.add(entry['path'])
+        before = previous.get(entry['path'])
+        if before is None:
+            added.append(entry)
+        elif before != (entry['type'], entry['size'], entry['modified']):
+            modified.append(entry)
+    removed = sorted(path for path in previous if path not in paths)
+    return added, modified, removed
+
+
+async def list_changes(request, protocol, credentials, path, list_entries, **options):
+    """JSON response of the entries added, modified or removed since the `cursor` query parameter
+
+    `list_entries()` returns the detailed listing entries of `path`, all of
+    them being added without cursor. The response holds the cursor of the
+    new snapshot.
+    """
+    store = request.app['snapshots']
+    scope = store.scope(protocol, credentials, path, **options)
+    cursor = request.query.get('cursor')
+    previous = {} if not cursor else await store.load(scope, cursor)
+    entries = await list_entries()
+    added, modified, removed = diff(previous, entries)
+    return web.json_response({
+        'cursor': await store.save(scope, entries),
+        'added': added,
+        'modified': modified,
+        'removed': removed,
+    })
@@ -0,0 +1,96 @@
+
+import asyncio
+import hashlib
+import zlib
+
+from aiohttp import web
+
+from errors import FtpProxyError, InvalidQueryParameter
+from pool import error_message, Workers
+
+
+class _Crc32:
+    def __init__(self):
+        self._value = 0
+
+    def update(self, data):
+        self._value = zlib.crc32(data, self._value)
+
+    def hexdigest(self):
+        return f'{self._value:08x}'
+
+
+ALGORITHMS = {'md5': hashlib.md5, 'sha1': hashlib.sha1, 'sha256': hashlib.sha256, 'crc32': _Crc32}
+# Hexadecimal digest lengths, to find digests in server replies
+HEX_LENGTHS = {'md5': 32, 'sha1': 40, 'sha256': 64, 'crc32': 8}
+
+
+def parse_algorithm(request):
+    algorithm = request.query.get('algorithm', 'sha256').lower()
+    if algorithm not in ALGORITHMS:
+        raise InvalidQueryParameter('algorithm')
+    return algorithm
+
+
+async def hash_chunks(algorithm, chunks):
+    """Hexadecimal digest of the content of `chunks`, hashed as it is read"""
+    digest = ALGORITHMS[algorithm]()
+    async for chunk in chunks:
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+async def _checksum_files(paths, connect, checksum_file, concurrency):
+    """{path: (checksum, source) or error message} of `paths`, fetched by up to `concurrency` workers
+
+    Each worker checks one file after the other with
+    `checksum_file(connection, path)`. FtpProxyError only fails the current
+    file, other errors fail it and the connection, which is then replaced.
+    """
+    results = {}
+
+    async def process(connection, path):
+        try:
+            results[path] = await checksum_file(connection, path)
+        except Exception as exc:
+            results[path] = error_message(exc)
+            if not isinstance(exc, FtpProxyError):
+                raise
+
+    def fail(path, exc):
+        results[path] = error_message(exc)
+
+    workers = Workers(paths, connect, process, fail)
+    await asyncio.gather(*[workers.run() for _ in range(max(min(concurrency, len(paths)), 1))])
+    return results
+
+
+async def checksums(request, paths, connect, checksum_file, concurrency):
+    """JSON response with the checksums of `paths`
+
+    `checksum_file(connection, path, algorithm)` returns the hexadecimal
+    digest of a file and whether it was computed by the "server" or the
+    "proxy", reading the file. A single path given without request body
+    fails the request when its checksum cannot be computed, files given in a
+    body are reported one by one instead.
+    """
+    algorithm = parse_algorithm(request)
+    if isinstance(paths, str):
+        async with connect() as connection:
+            checksum, source = await checksum_file(connection, paths, algorithm)
+        return web.json_response({'path': paths, 'algorithm': algorithm, 'checksum': checksum, 'source': source})
+
+    results = await _checksum_files(paths, connect, lambda connection, path: checksum_file(connection, path, algorithm), concurrency)
+    files = []
+    for path in paths:
+        result = results[path]
+        if isinstance(result, str):
+            files.append({'path': path, 'status': 'error', 'error': result})
+        else:
+            files.append({'path': path, 'status': 'ok', 'checksum': result[0], 'source': result[1]})
+    return web.json_response({
+        'algorithm': algorithm,
+        'files': files,
+        'count': len(files),
+        'errors': sum(1 for file in files if file['status'] == 'error'),
+    })
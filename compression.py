@@ -0,0 +1,127 @@
+"""Content-Encoding of download responses, negotiated from Accept-Encoding"""
+
+import asyncio
+import posixpath
+import zlib
+
+import config
+
+try:
+    import zstandard
+except ImportError:  # Optional dependency
+    zstandard = None
+
+
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+# Bytes buffered before being compressed in the default executor, download
+# chunks being smaller
+EXECUTOR_THRESHOLD = 64 * 1024
+# Smaller files are not worth the compression headers
+MIN_SIZE = 1024
+# Sampled files compressing to more than this ratio are sent as is
+MAX_RATIO = 0.9
+
+COMPRESSED_EXTENSIONS = frozenset([
+    '.gz', '.tgz', '.bz2', '.tbz2', '.xz', '.txz', '.lz', '.lzma', '.lz4', '.zst', '.z', '.zip', '.7z', '.rar',
+    '.jar', '.war', '.apk', '.parquet', '.orc', '.avro',
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic', '.mp3', '.mp4', '.m4a', '.mkv', '.avi', '.mov', '.ogg',
+    '.pdf', '.docx', '.xlsx', '.pptx', '.odt', '.ods',
+])
+
+
+class _Gzip:
+    def __init__(self):
+        self._compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def flush(self):
+        return self._compressor.flush()
+
+
+class _Zstd:
+    def __init__(self):
+        self._compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def flush(self):
+        return self._compressor.flush()
+
+
+ENCODINGS = {'gzip': _Gzip}
+if zstandard is not None:
+    ENCODINGS['zstd'] = _Zstd
+
+
+def accepted_encodings(header):
+    """Quality value of each coding of an Accept-Encoding header"""
+    accepted = {}
+    for coding in header.split(','):
+        name, *params = [part.strip() for part in coding.split(';')]
+        if not name:
+            continue
+        quality = 1.0
+        for param in params:
+            key, _, value = param.partition('=')
+            if key.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[name.lower()] = quality
+    return accepted
+
+
+def negotiate(request, path, size=None, sample=None):
+    """Content-Encoding to apply to a download of `path`, None to send it as is
+
+    `sample`, the start of the file when already read, lets incompressible
+    files go through as is whatever their extension.
+    """
+    if 'Range' in request.headers or (size is not None and size < MIN_SIZE):
+        return None
+    if posixpath.splitext(path)[1].lower() in COMPRESSED_EXTENSIONS:
+        return None
+    accepted = accepted_encodings(request.headers.get('Accept-Encoding', ''))
+    encoding = None
+    for name in config.DOWNLOAD_COMPRESSION:
+        if name in ENCODINGS and accepted.get(name, accepted.get('*', 0)) > 0:
+            encoding = name
+            break
+    if encoding is None or (sample and not compressible(sample)):
+        return None
+    return encoding
+
+
+def compressible(sample):
+    sample = sample[:EXECUTOR_THRESHOLD]
+    return len(zlib.compress(sample, 1)) <= MAX_RATIO * len(sample)
+
+
+def _finish(compressor, data):
+    return compressor.compress(data) + compressor.flush()
+
+
+async def compress(encoding, chunks, first=b''):
+    """Compress `first` then `chunks` in the default executor, by EXECUTOR_THRESHOLD bytes at least
+
+    Compressors hold back their output anyway, buffering chunks only delays
+    it when they are small.
+    """
+    compressor = ENCODINGS[encoding]()
+    loop = asyncio.get_event_loop()
+    buffered = [first]
+    size = len(first)
+    async for chunk in chunks:
+        buffered.append(chunk)
+        size += len(chunk)
+        if size >= EXECUTOR_THRESHOLD:
+            data = await loop.run_in_executor(None, compressor.compress, b''.join(buffered))
+            buffered, size = [], 0
+            if data:
+                yield data
+    yield await loop.run_in_executor(None, _finish, compressor, b''.join(buffered))
@@ -0,0 +1,113 @@
+"""Runtime settings, overridable through FTPPROXY_* environment variables"""
+
+import os
+import tempfile
+
+
+def _list(value):
+    return tuple(item.strip() for item in value.split(',') if item.strip())
+
+
+def _env(name, default, cast=str):
+    value = os.environ.get(f'FTPPROXY_{name}')
+    if value is None or value == '':
+        return default
+    return cast(value)
+
+
+# Comma separated protocols served, among ftp and sftp. Modules of the other
+# protocols are never imported, sftp requiring asyncssh and cryptography
+PROTOCOLS = _env('PROTOCOLS', ('ftp', 'sftp'), _list)
+# Event loop of the server, asyncio or uvloop which requires the uvloop package
+EVENT_LOOP = _env('EVENT_LOOP', 'asyncio')
+
+# Seconds allowed to open an upstream connection
+TIMEOUT_CONNECT = _env('TIMEOUT_CONNECT', 10, float)
+# Seconds allowed to log in, including the SSH key exchange
+TIMEOUT_AUTH = _env('TIMEOUT_AUTH', 10, float)
+# Seconds allowed for the server to start answering an operation: a command
+# reply, the first entry of a listing or the first chunk of a file
+TIMEOUT_FIRST_BYTE = _env('TIMEOUT_FIRST_BYTE', 30, float)
+# Seconds allowed between two chunks once a transfer or listing started,
+# transfers lasting as long as data keeps flowing
+TIMEOUT_IDLE = _env('TIMEOUT_IDLE', 60, float)
+# Comma separated "<host pattern>=<connect>:<auth>:<first byte>:<idle>", timeouts
+# of the servers of the first matching pattern, empty values keeping the above
+HOST_TIMEOUTS = _env('HOST_TIMEOUTS', (), _list)
+
+# Upstream FTP control connections kept per (host, port, user, password)
+FTP_POOL_SIZE = _env('FTP_POOL_SIZE', 4, int)
+# Seconds an unused FTP connection is kept open
+FTP_POOL_IDLE_TIMEOUT = _env('FTP_POOL_IDLE_TIMEOUT', 60, float)
+# Control connections listing directories concurrently during a recursive
+# listing, within FTP_POOL_SIZE
+FTP_WALK_CONNECTIONS = _env('FTP_WALK_CONNECTIONS', 4, int)
+
+# Upstream SSH connections kept per (host, port, user, password)
+SFTP_POOL_SIZE = _env('SFTP_POOL_SIZE', 2, int)
+# Seconds an unused SSH connection is kept open
+SFTP_POOL_IDLE_TIMEOUT = _env('SFTP_POOL_IDLE_TIMEOUT', 60, float)
+# Concurrent SFTP channels opened on a single SSH connection
+SFTP_MAX_CHANNELS = _env('SFTP_MAX_CHANNELS', 8, int)
+# Size of a single SFTP read request
+SFTP_BLOCK_SIZE = _env('SFTP_BLOCK_SIZE', 32768, int)
+# SFTP read requests kept in flight for a single download
+SFTP_READ_WINDOW = _env('SFTP_READ_WINDOW', 64, int)
+# SFTP write requests kept in flight for a single upload
+SFTP_WRITE_WINDOW = _env('SFTP_WRITE_WINDOW', 16, int)
+# SFTP readdir requests kept in flight during a recursive listing
+SFTP_WALK_CONCURRENCY = _env('SFTP_WALK_CONCURRENCY', 16, int)
+
+# Seconds a directory listing is served from cache, 0 only caches for clients
+# sending a "Cache-Control: max-age" header
+LISTING_CACHE_TTL = _env('LISTING_CACHE_TTL', 0, float)
+# Maximum size of cached listings, in bytes
+LISTING_CACHE_SIZE = _env('LISTING_CACHE_SIZE', 64 * 1024 * 1024, int)
+
+# Directory where worker processes started by "ftpproxy serve --workers"
+# share listings, a temporary directory when empty
+STATE_DIR = _env('STATE_DIR', '')
+
+# Directory of the listing snapshots of change feeds, shared by worker processes
+SNAPSHOT_DIR = _env('SNAPSHOT_DIR', os.path.join(tempfile.gettempdir(), 'ftpproxy-snapshots'))
+# Maximum size of listing snapshots, in bytes
+SNAPSHOT_SIZE = _env('SNAPSHOT_SIZE', 256 * 1024 * 1024, int)
+
+# Directory of the download cache, downloads are not cached when empty
+DOWNLOAD_CACHE_DIR = _env('DOWNLOAD_CACHE_DIR', '')
+# Maximum size of cached downloads, in bytes
+DOWNLOAD_CACHE_SIZE = _env('DOWNLOAD_CACHE_SIZE', 1024 * 1024 * 1024, int)
+# Comma separated patterns of the servers whose downloads are cached
+DOWNLOAD_CACHE_HOSTS = _env('DOWNLOAD_CACHE_HOSTS', ('*',), _list)
+# Comma separated patterns of the servers whose downloads are never cached
+DOWNLOAD_CACHE_EXCLUDED_HOSTS = _env('DOWNLOAD_CACHE_EXCLUDED_HOSTS', (), _list)
+
+# Content-Encodings applied to downloads, by order of preference, among those
+# accepted by the client. zstd requires the zstandard package
+DOWNLOAD_COMPRESSION = _env('DOWNLOAD_COMPRESSION', ('zstd', 'gzip'), _list)
+
+# Files fetched concurrently for an archive, within the connections allowed per server
+ARCHIVE_CONCURRENCY = _env('ARCHIVE_CONCURRENCY', 4, int)
+# Files hashed concurrently by the proxy for a checksum request, within the
+# connections allowed per server
+CHECKSUM_CONCURRENCY = _env('CHECKSUM_CONCURRENCY', 4, int)
+
+# Comma separated "<host pattern>=<limit>[:<queue size>[:<queue timeout>]]",
+# requests handled concurrently per server of the first matching pattern, in
+# the order they came, requests opening several connections taking a turn for
+# each of them. Servers matching no pattern are not limited
+HOST_LIMITS = _env('HOST_LIMITS', (), _list)
+# Requests waiting for their turn per server, beyond which 503 is returned
+HOST_QUEUE_SIZE = _env('HOST_QUEUE_SIZE', 100, int)
+# Seconds a request waits for its turn before 503 is returned
+HOST_QUEUE_TIMEOUT = _env('HOST_QUEUE_TIMEOUT', 30, float)
+
+# Share of the requests whose phase timings are logged, between 0 and 1
+TRACE_SAMPLE_RATE = _env('TRACE_SAMPLE_RATE', 0.01, float)
+# Seconds beyond which the phase timings of a request are always logged, 0 to
+# only log sampled requests
+TRACE_SLOW_REQUEST = _env('TRACE_SLOW_REQUEST', 10, float)
+
+# Bearer token of the admin routes, such as /debug/profile, which are
+# forbidden when empty
+ADMIN_TOKEN = _env('ADMIN_TOKEN', '')
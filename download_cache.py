@@ -0,0 +1,305 @@
+
+import asyncio
+import collections
+import fcntl
+import fnmatch
+import hashlib
+import json
+import os
+import re
+import time
+import uuid
+
+from aiohttp import web
+
+import compression
+from cache import cache_control
+from utils import stream_download, validators
+
+
+CHUNK_SIZE = 256 * 1024
+# Age after which a partial download is considered abandoned
+PART_MAX_AGE = 3600
+
+_FILENAME = re.compile(r'^([0-9a-f]{64})-([0-9a-f]{16})$')
+
+
+class _File:
+    def __init__(self, version, size):
+        self.version = version
+        self.size = size
+
+
+class DownloadCache:
+    """On-disk LRU of downloaded files, bounded by their total size in bytes
+
+    Files are keyed by a hash of the protocol, credentials and path, and only
+    served while the remote size and modification time are unchanged. Cached
+    files are named "<key>-<version>", which lets the index be rebuilt from
+    the directory content on startup.
+
+    When `shared` by several worker processes, files stored by other workers
+    are looked up on disk, and the least recently used files of the whole
+    directory are evicted under a lock, with their access time as last use.
+    """
+
+    def __init__(self, directory, max_bytes, hosts=('*',), excluded_hosts=(), shared=False):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hosts = hosts
+        self.excluded_hosts = excluded_hosts
+        self.shared = shared
+        self.size = 0
+        self._files = collections.OrderedDict()
+        self.counters = collections.Counter()
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        self._index(self._scan('st_ctime'))
+        if self.shared:
+            self._reindex(self._sweep())
+        else:
+            self._evict()
+
+    def _scan(self, time_attribute):
+        """Cached files as sorted (time, key, version, size)"""
+        entries = []
+        for entry in os.scandir(self.directory):
+            match = _FILENAME.match(entry.name)
+            try:
+                stat = entry.stat()
+                if match is None:
+                    # Downloads interrupted by a crash
+                    if entry.name.endswith('.part') and stat.st_mtime < time.time() - PART_MAX_AGE:
+                        os.unlink(entry.path)
+                    continue
+            except FileNotFoundError:
+                # Removed by another worker
+                continue
+            entries.append((getattr(stat, time_attribute), *match.groups(), stat.st_size))
+        return sorted(entries)
+
+    def _index(self, entries):
+        self._files.clear()
+        self.size = 0
+        for _, key, version, size in entries:
+            self._files[key] = _File(version, size)
+            self.size += size
+
+    def enabled_for(self, host):
+        return (any(fnmatch.fnmatch(host, pattern) for pattern in self.hosts)
+                and not any(fnmatch.fnmatch(host, pattern) for pattern in self.excluded_hosts))
+
+    @staticmethod
+    def key(protocol, credentials, path):
+        data = json.dumps([protocol, list(credentials), path])
+        return hashlib.sha256(data.encode()).hexdigest()
+
+    @staticmethod
+    def version(size, mtime):
+        return hashlib.sha256(f'{size}:{mtime}'.encode()).hexdigest()[:16]
+
+    def filepath(self, key, version):
+        return os.path.join(self.directory, f'{key}-{version}')
+
+    def get(self, key, version):
+        """Path of the cached file if its version matches, dropping stale versions"""
+        cached = self._files.get(key)
+        if cached is None and self.shared:
+            cached = self._adopt(key, version)
+        if cached is not None and cached.version != version:
+            self._remove(key)
+            self.counters['stale'] += 1
+            cached = None
+        if cached is not None and self.shared and not self._touch(key, version):
+            self._files.pop(key)
+            self.size -= cached.size
+            cached = None
+        if cached is None:
+            self.counters['misses'] += 1
+            return None
+        self.counters['hits'] += 1
+        self._files.move_to_end(key)
+        return self.filepath(key, version)
+
+    def _adopt(self, key, version):
+        """Index a file stored by another worker"""
+        try:
+            size = os.stat(self.filepath(key, version)).st_size
+        except FileNotFoundError:
+            return None
+        self._files[key] = _File(version, size)
+        self.size += size
+        return self._files[key]
+
+    def _touch(self, key, version):
+        """Record a use for the eviction of other workers, False if they evicted the file"""
+        try:
+            filepath = self.filepath(key, version)
+            os.utime(filepath, ns=(time.time_ns(), os.stat(filepath).st_mtime_ns))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def put(self, key, version, size, mtime, temporary):
+        """Move a complete download in the cache"""
+        if size > self.max_bytes:
+            os.unlink(temporary)
+            return
+        self._remove(key)
+        filepath = self.filepath(key, version)
+        # Served with the remote modification time as Last-Modified
+        os.utime(temporary, (time.time(), mtime))
+        os.replace(temporary, filepath)
+        self._files[key] = _File(version, size)
+        self.size += size
+        if not self.shared:
+            self._evict()
+
+    def discard(self, key):
+        """Drop the cached file of a key, whatever its version"""
+        self._remove(key)
+
+    def _remove(self, key):
+        cached = self._files.pop(key, None)
+        if cached is None:
+            return
+        self.size -= cached.size
+        try:
+            os.unlink(self.filepath(key, cached.version))
+        except FileNotFoundError:
+            pass
+
+    def _evict(self):
+        while self.size > self.max_bytes:
+            self._remove(next(iter(self._files)))
+            self.counters['evictions'] += 1
+
+    def _sweep(self):
+        """Evict the least recently used files of the directory, returning the files left and the evicted count
+
+        Returns None when another worker is already evicting, a file stored
+        meanwhile being evicted by the next put.
+        """
+        with open(os.path.join(self.directory, '.lock'), 'a') as fp:
+            try:
+                fcntl.flock(fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return None
+            entries = self._scan('st_atime')
+            size = sum(entry[-1] for entry in entries)
+            evicted = 0
+            while size > self.max_bytes:
+                _, key, version, file_size = entries.pop(0)
+                try:
+                    os.unlink(self.filepath(key, version))
+                except FileNotFoundError:
+                    pass
+                size -= file_size
+                evicted += 1
+        return entries, evicted
+
+    def _reindex(self, swept):
+        if swept is not None:
+            entries, evicted = swept
+            self._index(entries)
+            self.counters['evictions'] += evicted
+
+    async def _evict_shared(self):
+        # Scanning the files of every worker, off the event loop
+        self._reindex(await asyncio.get_event_loop().run_in_executor(None, self._sweep))
+
+    async def tee(self, key, version, size, mtime, chunks):
+        """Pass `chunks` through, storing them once the whole file went through"""
+        temporary = os.path.join(self.directory, f'{uuid.uuid4().hex}.part')
+        written = 0
+        try:
+            with open(temporary, 'wb') as fp:
+                async for chunk in chunks:
+                    # Small writes to the page cache, cheaper than an executor round trip
+                    fp.write(chunk)
+                    written += len(chunk)
+                    yield chunk
+        except BaseException:
+            os.unlink(temporary)
+            raise
+        if written != size:
+            # Changed while being downloaded
+            os.unlink(temporary)
+            return
+        self.put(key, version, size, mtime, temporary)
+        if self.shared:
+            await self._evict_shared()
+
+    def stats(self):
+        return {
+            'directory': self.directory,
+            'max_bytes': self.max_bytes,
+            'bytes': self.size,
+            'files': len(self._files),
+            **{name: self.counters[name] for name in ('hits', 'misses', 'stale', 'evictions')},
+        }
+
+
+async def iter_local_file(filepath, offset, length):
+    loop = asyncio.get_event_loop()
+    with open(filepath, 'rb') as fp:
+        fp.seek(offset)
+        while length:
+            chunk = await loop.run_in_executor(None, fp.read, min(CHUNK_SIZE, length))
+            if not chunk:
+                return
+            length -= len(chunk)
+            yield chunk
+
+
+class Slot:
+    """Place of a remote file in the download cache, for a single request"""
+
+    def __init__(self, cache, key, path, size, mtime):
+        self.cache = cache
+        self.key = key
+        self.path = path
+        self.size = size
+        self.mtime = mtime
+        self.version = cache.version(size, mtime)
+        self.filepath = None
+        self.headers = {**validators(size, mtime), 'X-ftpproxy-cache': 'miss'}
+
+    async def respond(self, request):
+        """Response for a cached file, sent with sendfile unless ranges or compression are requested"""
+        headers = {**validators(self.size, self.mtime), 'X-ftpproxy-cache': 'hit'}
+        if 'Range' not in request.headers and compression.negotiate(request, self.path, self.size) is None:
+            response = web.FileResponse(self.filepath, headers={**headers, 'Content-Type': 'application/octet-stream'})
+            # Known before it is sent, for metrics
+            response.content_length = self.size
+            return response
+        filepath = self.filepath
+        return await stream_download(request, lambda offset, length: iter_local_file(filepath, offset, length),
+                                     self.size, headers=headers, path=self.path)
+
+    def read_range(self, read_range):
+        """Wrap `read_range` so that whole file downloads are stored in the cache"""
+        def tee_range(offset, length):
+            if offset == 0 and length in (None, self.size):
+                return self.cache.tee(self.key, self.version, self.size, self.mtime, read_range(0, length))
+            return read_range(offset, length)
+        return tee_range
+
+
+def lookup(request, protocol, credentials, path, size, mtime):
+    """Download cache slot of a remote file of `size` bytes modified at `mtime`, None when it should not be cached
+
+    Clients sending "Cache-Control: no-cache" get the file from the server,
+    which then refreshes the cache.
+    """
+    cache = request.app['download_cache']
+    if cache is None or not cache.enabled_for(credentials[0]):
+        return None
+    if size is None or mtime is None:
+        return None
+    slot = Slot(cache, cache.key(protocol, credentials, path), path, size, mtime)
+    if cache_control(request) != 0:
+        slot.filepath = cache.get(slot.key, slot.version)
+    return slot
@@ -1,18 +1,28 @@
 
+import asyncio
+
 from aiohttp import web
 
+import metrics
+
 
 @web.middleware
 async def error_middleware(request, handler):
     try:
         return await handler(request)
     except FtpProxyError as error:
-        return web.json_response({'error': error.message}, status=400)
+        metrics.ERRORS.inc(type(error).__name__)
+        if request.writer.output_size:
+            # The response is partly sent, cut it short so that the client sees it incomplete
+            request.transport.close()
+            raise asyncio.CancelledError
+        return web.json_response({'error': error.message}, status=error.status, headers=error.headers)
 
 
 class FtpProxyError(Exception):
     """Base exception class caught for every route"""
-    pass
+    status = 400
+    headers = None
 
 
 class MissingHostHeader(FtpProxyError):
@@ -31,6 +41,61 @@ class ServerUnreachable(FtpProxyError):
     message = 'Failed connecting to FTP server'
 
 
+class InvalidTimeoutHeader(FtpProxyError):
+    def __init__(self, header):
+        self.message = f'Invalid {header} header'
+
+
+class UpstreamTimeout(FtpProxyError):
+    status = 504
+    messages = {
+        'connect': 'Timed out connecting to the server',
+        'auth': 'Timed out logging in to the server',
+        'first_byte': 'Timed out waiting for the server to answer',
+        'idle': 'Timed out waiting for more data from the server',
+    }
+
+    def __init__(self, phase):
+        self.phase = phase
+        self.message = self.messages[phase]
+
+
+class AdminForbidden(FtpProxyError):
+    status = 403
+    message = 'Missing or invalid admin token'
+
+
 class MissingMandatoryQueryParameter(FtpProxyError):
     def __init__(self, param_name):
         self.message = f'Missing mandatory query parameter: {param_name}'
+
+
+class InvalidQueryParameter(FtpProxyError):
+    def __init__(self, param_name):
+        self.message = f'Invalid query parameter: {param_name}'
+
+
+class InvalidRequestBody(FtpProxyError):
+    def __init__(self, expected):
+        self.message = f'Invalid request body, expected {expected}'
+
+
+class ExpiredCursor(FtpProxyError):
+    status = 410
+    message = 'Unknown or expired cursor, list changes again without cursor'
+
+
+class ServerBusy(FtpProxyError):
+    status = 503
+    message = 'Too many concurrent requests to this server, retry later'
+
+    def __init__(self, retry_after):
+        self.headers = {'Retry-After': str(retry_after)}
+
+
+class RangeNotSatisfiable(FtpProxyError):
+    status = 416
+    message = 'Requested range not satisfiable'
+
+    def __init__(self, size):
+        self.headers = {'Content-Range': f'bytes */{size}'}
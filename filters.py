@@ -0,0 +1,126 @@
+
+import datetime
+import fnmatch
+import re
+
+from errors import InvalidQueryParameter
+from utils import parse_int
+
+
+def _segments(pattern):
+    return [segment for segment in pattern.strip('/').split('/') if segment]
+
+
+def _glob_match(segments, parts, partial=False):
+    """Whether path `parts` match glob `segments`, or may have matches below them when `partial`
+
+    "*" matches within a path segment and "**" any number of segments.
+    """
+    if not parts:
+        return bool(segments) if partial else all(segment == '**' for segment in segments)
+    if not segments:
+        return False
+    if segments[0] == '**':
+        return _glob_match(segments[1:], parts, partial) or _glob_match(segments, parts[1:], partial)
+    return fnmatch.fnmatchcase(parts[0], segments[0]) and _glob_match(segments[1:], parts[1:], partial)
+
+
+def _compile(request, name):
+    patterns = []
+    for pattern in request.query.getall(name, []):
+        try:
+            patterns.append(re.compile(pattern))
+        except re.error:
+            raise InvalidQueryParameter(name)
+    return patterns
+
+
+def parse_time(request, name):
+    """Optional POSIX timestamp query parameter, also given as an ISO 8601 date or time in UTC by default"""
+    value = request.query.get(name)
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        moment = datetime.datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        raise InvalidQueryParameter(name)
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=datetime.timezone.utc)
+    return moment.timestamp()
+
+
+class ListingFilter:
+    """Entries of a listing to return, and directories worth listing
+
+    Paths are relative to the listed directory. Entries match one of the
+    `include` globs and `include_regex` expressions when given, and none of
+    the `exclude` ones, an excluded directory being left out with all its
+    content. Directories are only listed when they may hold entries matching
+    `include` globs, since regular expressions can match any path they are
+    not used to skip directories. Entries other than directories must have
+    been modified since `modified_since` and weigh at least `min_size` bytes,
+    directories are then listed but not returned.
+    """
+
+    def __init__(self, include=(), exclude=(), include_regex=(), exclude_regex=(), modified_since=None, min_size=None):
+        self.include = [_segments(pattern) for pattern in include]
+        self.exclude = [_segments(pattern) for pattern in exclude]
+        self.include_regex = include_regex
+        self.exclude_regex = exclude_regex
+        self.modified_since = modified_since
+        self.min_size = min_size
+        # Cache key of the listings filtered the same way
+        self.options = {
+            'include': list(include), 'exclude': list(exclude),
+            'include_regex': [regex.pattern for regex in include_regex],
+            'exclude_regex': [regex.pattern for regex in exclude_regex],
+            'modified_since': modified_since, 'min_size': min_size,
+        }
+
+    @property
+    def active(self):
+        return any(self.options.values())
+
+    def _excluded(self, path, parts):
+        return (any(_glob_match(segments, parts) for segments in self.exclude)
+                or any(regex.search(path) for regex in self.exclude_regex))
+
+    def descend(self, path):
+        """Whether the subdirectory `path` should be listed"""
+        parts = path.split('/')
+        if self._excluded(path, parts):
+            return False
+        return not self.include or bool(self.include_regex) or any(_glob_match(segments, parts, partial=True) for segments in self.include)
+
+    def matches(self, path, type, size=None, modified=None):
+        """Whether an entry should be returned"""
+        parts = path.split('/')
+        if self._excluded(path, parts):
+            return False
+        if (self.include or self.include_regex) and not (any(_glob_match(segments, parts) for segments in self.include)
+                                                         or any(regex.search(path) for regex in self.include_regex)):
+            return False
+        if self.modified_since is not None or self.min_size is not None:
+            if type == 'dir':
+                return False
+            if self.modified_since is not None and (modified is None or modified < self.modified_since):
+                return False
+            if self.min_size is not None and (size is None or size < self.min_size):
+                return False
+        return True
+
+
+def parse_filter(request):
+    """Filter of the include, exclude, include_regex, exclude_regex, modified_since and min_size query parameters"""
+    return ListingFilter(
+        include=request.query.getall('include', []),
+        exclude=request.query.getall('exclude', []),
+        include_regex=_compile(request, 'include_regex'),
+        exclude_regex=_compile(request, 'exclude_regex'),
+        modified_since=parse_time(request, 'modified_since'),
+        min_size=parse_int(request, 'min_size'),
+    )
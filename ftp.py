@@ -2,31 +2,414 @@
 import aioftp
 from aiohttp import web
 import asyncio
+import collections
+import datetime
+import functools
+import pathlib
+import string
+import time
 
-from utils import parse_headers
-from errors import FtpProxyError, ServerUnreachable, MissingMandatoryQueryParameter
+from archive import archive_name, parse_format, read_files, stream_archive
+import cache
+import config
+from checksum import HEX_LENGTHS, checksums, hash_chunks
+from changes import list_changes
+import download_cache
+import metrics
+from limits import admit
+from pool import Pool
+from singleflight import flight_key
+from filters import parse_filter
+from timeouts import request_timeouts, timed, within
+import tracing
+from utils import (parse_headers, parse_int, listing_entry, conditional_response, stream_download, stream_json_lines, temporary_path,
+                   validators, wants_stream)
+from errors import FtpProxyError, ServerUnreachable, MissingMandatoryQueryParameter, UpstreamTimeout
 
 
 class AioftpError(FtpProxyError):
     def __init__(self, ftp_error):
-        super().__init__('\n'.join([info.strip() for info in ftp_error.info]))
+        self.message = '\n'.join([info.strip() for info in ftp_error.info])
 
 
-FTP_TIMEOUT = 5
+# Request body read at once while uploading
+UPLOAD_CHUNK_SIZE = 64 * 1024
+# Listed entries buffered by a walk, listings waiting for a slower client beyond it
+WALK_BUFFER = 1024
+
+
+class _Client(aioftp.Client):
+    """aioftp client timing the PASV exchange and connection of each data transfer"""
+
+    async def get_passive_connection(self, *args, **kwargs):
+        with tracing.phase('data'):
+            return await super().get_passive_connection(*args, **kwargs)
+
+
+class FtpPool(Pool):
+    """Logged in aioftp clients, one request at a time per control connection"""
+
+    async def _connect(self, key, timeouts):
+        host, port, login, password = key
+        # Data connections are bounded by the callers, which know the phase of the transfer
+        client = _Client()
+        try:
+            start = time.monotonic()
+            with tracing.phase('connect'):
+                await within(client.connect(host, port), timeouts.connect, 'connect')
+            connected = time.monotonic()
+            metrics.UPSTREAM_CONNECT.observe(connected - start, 'ftp')
+            with tracing.phase('auth'):
+                await within(client.login(login, password), timeouts.auth, 'auth')
+            metrics.UPSTREAM_AUTH.observe(time.monotonic() - connected, 'ftp')
+        except BaseException:
+            client.close()
+            raise
+        return client
+
+    async def _lease(self, client, timeouts):
+        # Command replies wait for the first byte timeout of the request
+        client.stream.read_timeout = client.stream.write_timeout = timeouts.first_byte
+        client.ftpproxy_timeouts = timeouts
+        return client
+
+    async def _check(self, client):
+        try:
+            await client.command('NOOP', '2xx')
+        except aioftp.StatusCodeError:
+            # Any reply, even "command not implemented", proves the connection alive
+            pass
+        return True
+
+    async def _close(self, client):
+        client.close()
+
+    def _is_broken(self, client, exc):
+        # Error replies leave the control connection in a known state, unlike interrupted transfers
+        return not isinstance(exc, (aioftp.StatusCodeError, FtpProxyError)) or isinstance(exc, UpstreamTimeout)
+
+
+async def stop_transfer(client, stream):
+    """Close a data connection before the end of the transfer
+
+    The server then replies either transfer complete or transfer aborted.
+    """
+    stream.close()
+    await client.command(None, ('2xx', '4xx'), '1xx')
+
+
+async def _mlst(client, path):
+    """Facts of MLST, None when the server does not implement it
+
+    Unlike client.stat, never lists the parent directory instead.
+    """
+    try:
+        _, info = await client.command('MLST ' + path, '2xx')
+    except aioftp.StatusCodeError as ftp_error:
+        if not ftp_error.received_codes[-1].matches('50x'):
+            raise
+        return None
+    _, facts = client.parse_mlsx_line(info[1].lstrip())
+    return facts
+
+
+async def _command_value(client, command):
+    """Value of a 213 reply, None when the server does not implement `command`"""
+    try:
+        _, info = await client.command(command, '213')
+    except aioftp.StatusCodeError as ftp_error:
+        if not ftp_error.received_codes[-1].matches('50x'):
+            raise
+        return None
+    return info[-1].strip()
+
+
+async def file_size(client, path):
+    """Remote size from SIZE, or MLST, None when unknown"""
+    size = await _command_value(client, 'SIZE ' + path)
+    if size is None:
+        facts = await _mlst(client, path)
+        size = facts and facts.get('size')
+    return int(size) if size and size.isdigit() else None
+
+
+async def file_version(client, path):
+    """Remote size and modification time from MLST, or SIZE and MDTM, None when unknown"""
+    facts = await _mlst(client, path)
+    if facts is not None:
+        size = facts.get('size', '')
+        modified = facts.get('modify')
+        return int(size) if size.isdigit() else None, modified and parse_modify(modified)
+    # MLST not implemented by the server
+    size = await _command_value(client, 'SIZE ' + path)
+    modified = await _command_value(client, 'MDTM ' + path)
+    return int(size) if size and size.isdigit() else None, modified and parse_modify(modified)
+
+
+async def iter_file(client, path, offset=0, size=None):
+    """Download a remote file from `offset`, stopping after `size` bytes if given"""
+    timeouts = client.ftpproxy_timeouts
+    stream = await within(client.download_stream(path, offset=offset), timeouts.first_byte, 'first_byte')
+    try:
+        async for block in timed(stream.iter_by_block(), timeouts):
+            if size is not None:
+                block = block[:size]
+                size -= len(block)
+            yield block
+            if size == 0:
+                break
+        else:
+            await stream.finish()
+            return
+    except BaseException:
+        stream.close()
+        raise
+    await stop_transfer(client, stream)
+
+
+async def upload_file(client, path, chunks):
+    """Store `chunks` in a remote file, returning its size
+
+    Each chunk is only read once the previous one was written to the data
+    connection, so that a slow server slows down the client.
+    """
+    timeouts = client.ftpproxy_timeouts
+    stream = await within(client.upload_stream(path), timeouts.first_byte, 'first_byte')
+    size = 0
+    try:
+        async for chunk in chunks:
+            await within(stream.write(chunk), timeouts.idle, 'idle')
+            size += len(chunk)
+    except BaseException:
+        try:
+            # Read the transfer reply, leaving the control connection usable
+            await stop_transfer(client, stream)
+        except Exception:
+            pass
+        raise
+    await stream.finish()
+    return size
+
+
+async def replace(client, source, destination):
+    """Rename `source` over `destination`, removing it first on servers refusing to replace files"""
+    try:
+        await client.rename(source, destination)
+    except aioftp.StatusCodeError:
+        if not await client.exists(destination):
+            raise
+        await client.remove_file(destination)
+        await client.rename(source, destination)
+
+
+def connect(request):
+    """Borrow a logged in client from the application FTP pool"""
+    host, port, login, password = parse_headers(request)
+    return admit(request, host, request.app['ftp_pool'].acquire(host, port, login, password, request_timeouts(request, host)))
+
+
+async def _ping(request):
+    try:
+        async with connect(request) as client:
+            timeouts = client.ftpproxy_timeouts
+            stream = await within(client.get_stream('LIST /', '1xx'), timeouts.first_byte, 'first_byte')
+            # Only the list command matters, stop the transfer after the first line
+            await within(stream.readline(), timeouts.first_byte, 'first_byte')
+            await stop_transfer(client, stream)
+    except asyncio.TimeoutError:
+        raise UpstreamTimeout('first_byte')
+    except OSError:
+        raise ServerUnreachable
+    except aioftp.errors.StatusCodeError as ftp_error:
+        raise AioftpError(ftp_error)
 
 
 async def ping(request):
     """test FTP connection by sending a minimal LS command
     returns "pong" on success
+
+    Concurrent pings of a server share a single check.
     """
-    host, port, login, password = parse_headers(request)
+    key = flight_key('ftp', parse_headers(request), 'ping')
+    await request.app['ping_flights'].run(key, functools.partial(_ping, request))
+    return web.json_response({'success': True})
+
+
+async def _list_directory(client, directory, depth, entries):
+    """Put the (path, info, depth) of `directory` in the `entries` queue as they are listed"""
+    async for path, info in timed(client.list(directory), client.ftpproxy_timeouts):
+        await entries.put((path, info, depth))
+
+
+async def walk(connect, root_path, recursive=False, connections=1, stats=None, max_depth=None, descend=None):
+    """List `root_path`, and its subdirectories when `recursive`, yielding (path, info)
+
+    Directories waiting to be listed are spread over up to `connections`
+    control connections borrowed with `connect()`, each listing one directory
+    at a time. Extra connections are only opened while directories are
+    waiting, and entries are yielded as they are listed. The number
+    of listed directories and the walk duration are set in `stats`.
+    Subdirectories deeper than `max_depth`, or for which `descend(path)` is
+    false, are not listed.
+    """
+    stats = {} if stats is None else stats
+    stats.update(directories=0, connections=0, seconds=0.0)
+    start = time.monotonic()
+    pending = collections.deque([(pathlib.PurePosixPath(root_path), 0)])
+    leases = {}
+    idle = []
+    opening = {}
+    listing = {}
+    failed = {}
+    entries = asyncio.Queue(WALK_BUFFER)
+    getter = None
     try:
-        async with aioftp.ClientSession(host, port, login, password, socket_timeout=FTP_TIMEOUT, path_timeout=FTP_TIMEOUT) as client:
-            async for _ in client.list('/'):  # noqa
-                # Iterate once if any result, only list command matters not the results
-                break
-            return web.json_response({'success': True})
-    except (OSError, asyncio.TimeoutError, TimeoutError):
+        while pending or listing or not entries.empty() or getter is not None:
+            while pending and idle:
+                client = idle.pop()
+                directory, depth = pending.popleft()
+                listing[asyncio.ensure_future(_list_directory(client, directory, depth, entries))] = client, depth
+            for _ in range(min(len(pending), connections - len(leases) - len(opening))):
+                lease = connect()
+                opening[asyncio.ensure_future(lease.__aenter__())] = lease
+
+            if getter is None:
+                getter = asyncio.ensure_future(entries.get())
+            if not getter.done():
+                await asyncio.wait([*opening, *listing, getter], return_when=asyncio.FIRST_COMPLETED)
+            if getter.done():
+                listed = [getter.result()]
+                getter = None
+                while not entries.empty():
+                    listed.append(entries.get_nowait())
+                for path, info, depth in listed:
+                    yield path, info
+                    if (recursive and (max_depth is None or depth < max_depth) and info['type'] == 'dir'
+                            and (descend is None or descend(path))):
+                        pending.append((path, depth + 1))
+
+            done = [task for task in [*opening, *listing] if task.done()]
+            for task in done:
+                if task in opening:
+                    lease = opening.pop(task)
+                    try:
+                        client = task.result()
+                    except Exception:
+                        if not leases and not opening:
+                            raise
+                        # Servers often limit connections per user, carry on with those already open
+                        connections = len(leases) + len(opening)
+                        continue
+                    leases[client] = lease
+                    idle.append(client)
+                    continue
+
+                client, depth = listing.pop(task)
+                try:
+                    task.result()
+                except Exception as exc:
+                    failed[client] = exc
+                    raise
+                idle.append(client)
+                stats['directories'] += 1
+
+            if getter is not None and not getter.done() and not pending and not listing:
+                # Every listing finished and its entries were yielded
+                getter.cancel()
+                getter = None
+    finally:
+        stats['seconds'] = time.monotonic() - start
+        stats['connections'] = len(leases)
+        if getter is not None:
+            getter.cancel()
+        await _release(leases, opening, listing, failed)
+
+
+async def _release(leases, opening, listing, failed):
+    """Give connections of an interrupted walk back to the pool, discarding those left mid-transfer"""
+    for task in [*opening, *listing]:
+        task.cancel()
+    await asyncio.gather(*opening, *listing, return_exceptions=True)
+    for task, lease in opening.items():
+        if not task.cancelled() and task.exception() is None:
+            leases[task.result()] = lease
+    for task, (client, _) in listing.items():
+        failed[client] = asyncio.CancelledError() if task.cancelled() else task.exception()
+    for client, lease in leases.items():
+        exc = failed.get(client)
+        await lease.__aexit__(None if exc is None else type(exc), exc, None)
+
+
+def walk_connections(request):
+    """Connections used to list a directory tree, within the pool limit per server"""
+    return max(min(config.FTP_WALK_CONNECTIONS, request.app['ftp_pool'].max_size), 1)
+
+
+def walk_summary(stats):
+    seconds = stats['seconds']
+    return {
+        'walk_time': round(seconds, 3),
+        'dirs_per_sec': round(stats['directories'] / seconds if seconds else 0.0, 1),
+    }
+
+
+def walk_headers(stats):
+    summary = walk_summary(stats)
+    return {
+        'X-ftpproxy-walk-time': str(summary['walk_time']),
+        'X-ftpproxy-walk-dirs-per-sec': str(summary['dirs_per_sec']),
+    }
+
+
+def parse_modify(value):
+    """POSIX timestamp of a "modify" fact, YYYYMMDDHHMMSS[.sss] in UTC"""
+    try:
+        modified = datetime.datetime.strptime(value[:14], '%Y%m%d%H%M%S')
+    except ValueError:
+        # Some servers send a POSIX timestamp
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    return modified.replace(tzinfo=datetime.timezone.utc).timestamp()
+
+
+def entry_metadata(info):
+    """(type, size, modified, mode) from MLSD facts, or those aioftp parsed from a LIST line"""
+    size = info.get('size', '')
+    modified = info.get('modify')
+    mode = info.get('unix.mode')
+    if isinstance(mode, str):
+        mode = int(mode, 8) if mode.isdigit() else None
+    return info.get('type', 'unknown'), int(size) if size.isdigit() else None, modified and parse_modify(modified), mode
+
+
+def entry_details(path, info):
+    """Listing entry from MLSD facts, or those aioftp parsed from a LIST line"""
+    return listing_entry(str(path), *entry_metadata(info))
+
+
+async def iter_listing(request, root_path, recursive=False, extension=None, stats=None, details=False, max_depth=None,
+                       listing_filter=None):
+    root = pathlib.PurePosixPath(root_path)
+    if listing_filter is not None and not listing_filter.active:
+        listing_filter = None
+
+    def descend(path):
+        return listing_filter.descend(str(path.relative_to(root)))
+
+    try:
+        connections = walk_connections(request) if recursive else 1
+        async for path, info in walk(functools.partial(connect, request), root_path, recursive, connections, stats,
+                                     max_depth, listing_filter and descend):
+            if extension is not None and path.suffix != extension:
+                continue
+            if listing_filter is not None and not listing_filter.matches(str(path.relative_to(root)), *entry_metadata(info)[:3]):
+                continue
+            yield entry_details(path, info) if details else str(path)
+    except asyncio.TimeoutError:
+        raise UpstreamTimeout('first_byte')
+    except OSError:
         raise ServerUnreachable
     except aioftp.errors.StatusCodeError as ftp_error:
         raise AioftpError(ftp_error)
@@ -38,45 +421,297 @@ async def ls(request):
     Optional query params:
       path: directory to list (defaults to "/")
       recursive: recurse down folders (defaults to "false")
+      max_depth: number of folders to recurse down, 0 only lists `path`
+      include, exclude: glob patterns of the paths to list or leave out, relative to `path`
+      include_regex, exclude_regex: regular expressions searched in the same relative paths
+      modified_since: only list files modified since this ISO 8601 date or POSIX timestamp
+      min_size: only list files of at least this many bytes
+      details: list entries with their type, size, modification time and permissions (defaults to "false")
+      stream: send paths as they are listed, as newline delimited JSON (defaults to "false")
+
+    Listings read from the server report their duration and the number of
+    directories listed per second.
     """
-    host, port, login, password = parse_headers(request)
+    credentials = parse_headers(request)
+
+    root_path = request.query.get('path', '/')
+    recursive = request.query.get('recursive', 'false') == 'true'
+    extension = request.query.get('extension')
+    details = request.query.get('details', 'false') == 'true'
+    max_depth = parse_int(request, 'max_depth')
+    listing_filter = parse_filter(request)
+    stats = {}
+
+    entries = functools.partial(iter_listing, request, root_path, recursive, extension, stats, details, max_depth, listing_filter)
+    if wants_stream(request):
+        return await stream_json_lines(request, entries(), summary=lambda: walk_summary(stats))
+
+    async def list_files():
+        return [entry async for entry in entries()]
+
+    # Spellings of the same path share their listing
+    response = await cache.cached_listing(request, 'ftp', credentials, str(pathlib.PurePosixPath(root_path)), list_files,
+                                          recursive=recursive, extension=extension, details=details, max_depth=max_depth,
+                                          filter=listing_filter.options)
+    if stats:
+        # Only set when this request listed the server, not for cached or shared listings
+        response.headers.update(walk_headers(stats))
+    return response
+
+
+async def changes(request):
+    """Entries added, modified or removed since a previous call
+
+    Optional query params:
+      cursor: returned by the previous call, every entry is added without it
+      path, recursive, extension, max_depth, include, exclude, include_regex, exclude_regex, modified_since, min_size:
+        as for ls
+    """
+    credentials = parse_headers(request)
 
     root_path = request.query.get('path', '/')
     recursive = request.query.get('recursive', 'false') == 'true'
     extension = request.query.get('extension')
+    max_depth = parse_int(request, 'max_depth')
+    listing_filter = parse_filter(request)
 
-    files = []
+    async def list_entries():
+        return [entry async for entry in iter_listing(request, root_path, recursive, extension, details=True, max_depth=max_depth,
+                                                      listing_filter=listing_filter)]
 
+    return await list_changes(request, 'ftp', credentials, root_path, list_entries, recursive=recursive, extension=extension,
+                              max_depth=max_depth, filter=listing_filter.options)
+
+
+async def invalidate(request):
+    """Drop cached listings of the FTP server
+
+    Optional query params:
+      path: only drop listings including this path
+    """
+    return await cache.invalidate(request, 'ftp', parse_headers(request))
+
+
+async def download(request):
+    """ftp RETR command
+
+    Single and multiple byte ranges are served from REST offsets, whole
+    files are compressed when the client accepts it. Files are sent with an
+    ETag and Last-Modified from their size and modification time, clients
+    already having them get a 304 without the file being transferred, as
+    HEAD requests.
+    """
+    credentials = parse_headers(request)
+    path = request.query.get('path')
+    if not path:
+        raise MissingMandatoryQueryParameter('path')
     try:
-        async with aioftp.ClientSession(host, port, login, password, socket_timeout=FTP_TIMEOUT, path_timeout=FTP_TIMEOUT) as client:
-            async for path, info in client.list(root_path, recursive=recursive):
-                if extension is None or path.suffix == extension:
-                    files.append(str(path))
-    except (OSError, asyncio.TimeoutError, TimeoutError):
+        async with connect(request) as client:
+            size, mtime = await file_version(client, path)
+            response = conditional_response(request, size, mtime)
+            if response is not None:
+                return response
+            slot = download_cache.lookup(request, 'ftp', credentials, path, size, mtime)
+            if slot is not None and slot.filepath:
+                return await slot.respond(request)
+
+            def read_range(offset, length):
+                return iter_file(client, path, offset, length)
+
+            if slot is not None:
+                return await stream_download(request, slot.read_range(read_range), slot.size, headers=slot.headers,
+                                             path=path)
+            return await stream_download(request, read_range, size, headers=validators(size, mtime), path=path)
+    except asyncio.TimeoutError:
+        raise UpstreamTimeout('first_byte')
+    except OSError:
         raise ServerUnreachable
     except aioftp.errors.StatusCodeError as ftp_error:
         raise AioftpError(ftp_error)
 
-    return web.json_response(files)
 
+# Names of the algorithms in HASH commands, and commands of the older extensions
+HASH_NAMES = {'md5': 'MD5', 'sha1': 'SHA-1', 'sha256': 'SHA-256', 'crc32': 'CRC32'}
+X_COMMANDS = {'md5': 'XMD5', 'sha1': 'XSHA1', 'sha256': 'XSHA256', 'crc32': 'XCRC'}
+
+
+async def server_features(client):
+    """{feature: parameters} announced by the server in reply to FEAT, kept with the connection"""
+    features = getattr(client, 'ftpproxy_features', None)
+    if features is None:
+        features = {}
+        try:
+            _, info = await client.command('FEAT', '211')
+        except aioftp.errors.StatusCodeError:
+            info = []
+        # Feature lines are between the "211-Features:" and "211 End" lines
+        for line in info[1:-1]:
+            name, _, parameters = line.strip().partition(' ')
+            features[name.upper()] = parameters
+        client.ftpproxy_features = features
+    return features
+
+
+def _find_digest(info, algorithm):
+    for word in ' '.join(info).split():
+        if len(word) == HEX_LENGTHS[algorithm] and all(char in string.hexdigits for char in word):
+            return word.lower()
+    return None
+
+
+async def server_checksum(client, path, algorithm):
+    """Digest computed by servers supporting the HASH command or its XMD5/XSHA/XCRC predecessors, None otherwise"""
+    features = await server_features(client)
+    try:
+        if HASH_NAMES[algorithm] in features.get('HASH', '').replace('*', '').split(';'):
+            await client.command(f'OPTS HASH {HASH_NAMES[algorithm]}', '200')
+            _, info = await client.command(f'HASH {path}', '213')
+            return _find_digest(info, algorithm)
+        if X_COMMANDS[algorithm] in features:
+            _, info = await client.command(f'{X_COMMANDS[algorithm]} {path}', '2xx')
+            return _find_digest(info, algorithm)
+    except aioftp.errors.StatusCodeError:
+        # Hashed by the proxy instead, which reports missing files
+        pass
+    return None
 
-async def download(request):
-    host, port, login, password = parse_headers(request)
 
+async def checksum_file(client, path, algorithm):
+    try:
+        digest = await server_checksum(client, path, algorithm)
+        if digest is not None:
+            return digest, 'server'
+        return await hash_chunks(algorithm, iter_file(client, path)), 'proxy'
+    except aioftp.errors.StatusCodeError as ftp_error:
+        raise AioftpError(ftp_error)
+
+
+async def checksum(request):
+    """Checksums of files, computed by the server when it supports it, else by the proxy
+
+    Files are given as a JSON {"paths": [...]} body, or as a single path.
+
+    Optional query params:
+      path: file to check, mandatory without body
+      algorithm: "md5", "sha1", "sha256" or "crc32" (defaults to "sha256")
+    """
+    parse_headers(request)
+    paths = await read_files(request)
+    if paths is None:
+        paths = request.query.get('path')
+        if not paths:
+            raise MissingMandatoryQueryParameter('path')
+    try:
+        # Each file hashed concurrently holds a control connection
+        concurrency = min(config.CHECKSUM_CONCURRENCY, request.app['ftp_pool'].max_size)
+        return await checksums(request, paths, functools.partial(connect, request), checksum_file, concurrency)
+    except asyncio.TimeoutError:
+        raise UpstreamTimeout('first_byte')
+    except OSError:
+        raise ServerUnreachable
+    except aioftp.errors.StatusCodeError as ftp_error:
+        raise AioftpError(ftp_error)
+
+
+async def upload(request):
+    """ftp STOR command, streaming the request body to the server
+
+    Mandatory query param:
+      path: file to write, replaced when it exists
+
+    Optional query params:
+      atomic: write to a temporary file renamed to `path` once complete, so
+        that the file is never seen partially written (defaults to "false")
+    """
+    credentials = parse_headers(request)
     path = request.query.get('path')
     if not path:
         raise MissingMandatoryQueryParameter('path')
+    atomic = request.query.get('atomic', 'false') == 'true'
+    target = temporary_path(path) if atomic else path
     try:
-        async with aioftp.ClientSession(host, port, login, password, socket_timeout=FTP_TIMEOUT, path_timeout=FTP_TIMEOUT) as client:
-            ftp_stream = await client.download_stream(path)
+        async with connect(request) as client:
+            try:
+                size = await upload_file(client, target, request.content.iter_chunked(UPLOAD_CHUNK_SIZE))
+                if atomic:
+                    await replace(client, target, path)
+            except BaseException:
+                if atomic:
+                    try:
+                        await client.remove_file(target)
+                    except Exception:
+                        pass
+                raise
+    except asyncio.TimeoutError:
+        raise UpstreamTimeout('first_byte')
+    except OSError:
+        raise ServerUnreachable
+    except aioftp.errors.StatusCodeError as ftp_error:
+        raise AioftpError(ftp_error)
+    finally:
+        # Even failed uploads may have changed the file
+        await cache.invalidate_file(request, 'ftp', credentials, path)
+    return web.json_response({'path': path, 'size': size}, status=201)
+
+
+async def _archived_chunks(client, path):
+    try:
+        async for chunk in iter_file(client, path):
+            yield chunk
+    except aioftp.StatusCodeError as ftp_error:
+        raise AioftpError(ftp_error)
+
+
+async def archive_file(client, path):
+    """Size and content of a file to archive, failing with AioftpError when the server refuses it"""
+    try:
+        size = await file_size(client, path)
+    except aioftp.StatusCodeError as ftp_error:
+        raise AioftpError(ftp_error)
+    return size, _archived_chunks(client, path)
 
-            response = web.StreamResponse()
-            response.content_type = 'application/octet-stream'
-            await response.prepare(request)
-            async for chunk in ftp_stream.iter_by_block():
-                await response.write(chunk)
-            return response
-    except (OSError, asyncio.TimeoutError, TimeoutError):
+
+async def archive(request):
+    """Download several files as a single zip or tar archive
+
+    Files are given as a JSON {"paths": [...]} body, or listed from a directory.
+
+    Optional query params:
+      path: directory to archive, mandatory without body
+      recursive: archive files of subdirectories (defaults to "false")
+      extension: only archive files with this extension
+      max_depth, include, exclude, include_regex, exclude_regex, modified_since, min_size: as for ls
+      format: "zip" or "tar" (defaults to "zip")
+    """
+    parse_headers(request)
+    format = parse_format(request)
+    paths = await read_files(request)
+    try:
+        if paths is not None:
+            files = [(path, archive_name(path)) for path in paths]
+        else:
+            root_path = request.query.get('path')
+            if not root_path:
+                raise MissingMandatoryQueryParameter('path')
+            recursive = request.query.get('recursive', 'false') == 'true'
+            extension = request.query.get('extension')
+            max_depth = parse_int(request, 'max_depth')
+            listing_filter = parse_filter(request)
+            files = [(entry['path'], archive_name(entry['path'], root_path))
+                     async for entry in iter_listing(request, root_path, recursive, extension, details=True, max_depth=max_depth,
+                                                     listing_filter=listing_filter)
+                     if entry['type'] == 'file']
+
+        # Each file fetched concurrently holds a control connection
+        concurrency = min(config.ARCHIVE_CONCURRENCY, request.app['ftp_pool'].max_size)
+        return await stream_archive(request, files, functools.partial(connect, request), archive_file, concurrency, format)
+    except asyncio.TimeoutError:
+        raise UpstreamTimeout('first_byte')
+    except OSError:
         raise ServerUnreachable
     except aioftp.errors.StatusCodeError as ftp_error:
         raise AioftpError(ftp_error)
+
+
+def create_pool():
+    return FtpPool(max_size=config.FTP_POOL_SIZE, idle_timeout=config.FTP_POOL_IDLE_TIMEOUT)
@@ -1,26 +1,133 @@
 
 import argparse
+import asyncio
+import importlib
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import time
+import traceback
 from aiohttp import web
 
-import ftp
-import sftp
+import config
+import metrics
+import profiler
+import tracing
+from cache import ListingCache, SharedListingCache
+from changes import SnapshotStore
+from download_cache import DownloadCache
 from errors import error_middleware
+from limits import HostLimiter, SharedSlots, admission_middleware, parse_limits
+from singleflight import SingleFlight
+from timeouts import HostTimeouts, default_timeouts, parse_timeouts
 
 
-def init_func(argv=None):
+async def stats(request):
+    """Upstream connection pools and caches usage, to help tuning settings"""
+    listing_cache = request.app['listing_cache']
+    download_cache = request.app['download_cache']
+    return web.json_response({
+        **{f'{protocol}_pool': request.app[f'{protocol}_pool'].stats() for protocol in request.app['protocols']},
+        'listing_cache': await listing_cache.run(listing_cache.stats),
+        'download_cache': download_cache and download_cache.stats(),
+        'host_limits': request.app['host_limiter'].stats(),
+    })
+
+
+async def close_pools(app):
+    for protocol in app['protocols']:
+        await app[f'{protocol}_pool'].close()
+
+
+async def close_listing_cache(app):
+    app['listing_cache'].close()
+
+
+async def close_host_limiter(app):
+    app['host_limiter'].close()
+
+
+PROTOCOLS = ('ftp', 'sftp')
+
+
+def load_protocols(names):
+    """Modules of the protocols `names`, only importing those so that unused dependencies are never loaded"""
+    unknown = set(names) - set(PROTOCOLS)
+    if unknown:
+        raise ValueError(f'Unknown protocols: {", ".join(sorted(unknown))}')
+    return {name: importlib.import_module(name) for name in PROTOCOLS if name in names}
+
+
+def use_event_loop(name):
+    """Install the event loop policy of `name`, asyncio or uvloop"""
+    if name == 'uvloop':
+        import uvloop  # Optional dependency
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    elif name != 'asyncio':
+        raise ValueError(f'Unknown event loop: {name}')
+
+
+def init_func(argv=None, worker=0, workers=1, state_dir=None, protocols=None):
+    """Application of one of the `workers` processes of a server, sharing caches in `state_dir` when several
+
+    Only the `protocols` enabled by config.PROTOCOLS by default are served.
+    """
     app = web.Application()
+    modules = load_protocols(config.PROTOCOLS if protocols is None else protocols)
+    app['protocols'] = tuple(modules)
+
+    # Setup shared upstream connections
+    for protocol, module in modules.items():
+        app[f'{protocol}_pool'] = module.create_pool()
+    app.on_cleanup.append(close_pools)
+    if workers > 1:
+        app['listing_cache'] = SharedListingCache(os.path.join(state_dir, 'listings.sqlite'),
+                                                  max_bytes=config.LISTING_CACHE_SIZE, ttl=config.LISTING_CACHE_TTL)
+        app.on_cleanup.append(close_listing_cache)
+    else:
+        app['listing_cache'] = ListingCache(max_bytes=config.LISTING_CACHE_SIZE, ttl=config.LISTING_CACHE_TTL)
+    app['download_cache'] = None
+    if config.DOWNLOAD_CACHE_DIR:
+        app['download_cache'] = DownloadCache(config.DOWNLOAD_CACHE_DIR, config.DOWNLOAD_CACHE_SIZE,
+                                              config.DOWNLOAD_CACHE_HOSTS, config.DOWNLOAD_CACHE_EXCLUDED_HOSTS,
+                                              shared=workers > 1)
+
+    app['snapshots'] = SnapshotStore(config.SNAPSHOT_DIR, config.SNAPSHOT_SIZE)
+    # Identical concurrent requests share their upstream operation, listings in the listing cache
+    app['ping_flights'] = SingleFlight('ping')
+
+    # Workers take turns with limited servers from slots shared in the state directory
+    limits = parse_limits(config.HOST_LIMITS, config.HOST_QUEUE_SIZE, config.HOST_QUEUE_TIMEOUT)
+    slots = SharedSlots(os.path.join(state_dir, 'limits')) if workers > 1 and limits else None
+    app['host_limiter'] = HostLimiter(limits, slots)
+    app.on_cleanup.append(close_host_limiter)
+    defaults = default_timeouts()
+    app['host_timeouts'] = HostTimeouts(parse_timeouts(config.HOST_TIMEOUTS, defaults), defaults)
 
     # Setup routes
-    app.add_routes([web.get('/ftp/ping', ftp.ping)])
-    app.add_routes([web.get('/ftp/ls', ftp.ls)])
-    app.add_routes([web.get('/ftp/download', ftp.download)])
+    for protocol, module in modules.items():
+        app.add_routes([web.get(f'/{protocol}/ping', module.ping)])
+        app.add_routes([web.get(f'/{protocol}/ls', module.ls)])
+        app.add_routes([web.get(f'/{protocol}/download', module.download)])
+        app.add_routes([web.put(f'/{protocol}/upload', module.upload)])
+        app.add_routes([web.get(f'/{protocol}/changes', module.changes)])
+        app.add_routes([web.get(f'/{protocol}/checksum', module.checksum), web.post(f'/{protocol}/checksum', module.checksum)])
+        app.add_routes([web.post(f'/{protocol}/cache/invalidate', module.invalidate)])
+        app.add_routes([web.get(f'/{protocol}/archive', module.archive), web.post(f'/{protocol}/archive', module.archive)])
 
-    app.add_routes([web.get('/sftp/ping', sftp.ping)])
-    app.add_routes([web.get('/sftp/ls', sftp.ls)])
-    app.add_routes([web.get('/sftp/download', sftp.download)])
+    app.add_routes([web.get('/stats', stats)])
+    app.add_routes([web.get('/metrics', metrics.export)])
+    app.add_routes([web.get('/debug/profile', profiler.profile)])
 
-    # Setup middleware
+    # Setup middleware, tracing first to time the whole request
+    tracing.setup_logging()
+    app.middlewares.append(tracing.tracing_middleware)
+    app.on_response_prepare.append(tracing.add_server_timing)
+    app.middlewares.append(metrics.metrics_middleware)
     app.middlewares.append(error_middleware)
+    app.middlewares.append(admission_middleware)
 
     return app
 
@@ -28,10 +135,97 @@ def init_func(argv=None):
 app = init_func()
 
 
-def cli():
-    parser = argparse.ArgumentParser(description="aiohttp server example")
+# Workers exiting sooner after being started are not restarted
+RESTART_MIN_UPTIME = 5
+
+
+def _run_worker(host, port, worker, workers, state_dir):
+    status = 0
+    try:
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        # Never share the event loop of the parent process
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        web.run_app(init_func(worker=worker, workers=workers, state_dir=state_dir), host=host, port=port,
+                    reuse_port=True, print=print if worker == 0 else None)
+    except BaseException:
+        traceback.print_exc()
+        status = 1
+    finally:
+        # Leave the parent process cleanup alone
+        os._exit(status)
+
+
+def serve(host, port, workers=1, loop=None):
+    """Run the server, forking `workers` processes which all accept connections on the port
+
+    Workers share listings in config.STATE_DIR, the download cache and the
+    per server limits. Workers exiting are restarted, unless they exit on
+    startup. The event `loop` is config.EVENT_LOOP by default. Returns the
+    exit status.
+    """
+    use_event_loop(loop or config.EVENT_LOOP)
+    if workers <= 1:
+        web.run_app(init_func(), host=host, port=port)
+        return 0
+
+    state_dir = config.STATE_DIR or tempfile.mkdtemp(prefix='ftpproxy-')
+    os.makedirs(state_dir, exist_ok=True)
+    children = {}
+    stopping = False
+    status = 0
+
+    def start(worker):
+        pid = os.fork()
+        if pid == 0:
+            _run_worker(host, port, worker, workers, state_dir)
+        children[pid] = worker, time.monotonic()
+
+    def stop(signum=None, frame=None):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    try:
+        for worker in range(workers):
+            start(worker)
+        while children:
+            pid, _ = os.wait()
+            worker, started = children.pop(pid)
+            if stopping:
+                continue
+            if time.monotonic() - started < RESTART_MIN_UPTIME:
+                # Such as when the port is already taken
+                print(f'Worker {worker} exited on startup, stopping', file=sys.stderr)
+                status = 1
+                stop()
+                continue
+            print(f'Worker {worker} exited, restarting it', file=sys.stderr)
+            start(worker)
+    finally:
+        if not config.STATE_DIR:
+            shutil.rmtree(state_dir, ignore_errors=True)
+    return status
+
+
+def cli(argv=None):
+    parser = argparse.ArgumentParser(description="HTTP proxy to FTP and SFTP servers")
+    parser.add_argument('command', nargs='?', choices=['serve'], default='serve')
     parser.add_argument('--host', default='0.0.0.0')
     parser.add_argument('--port', default=2121, type=int)
+    parser.add_argument('--workers', default=1, type=int, help='processes accepting connections on the port')
+    parser.add_argument('--loop', choices=['asyncio', 'uvloop'], default=config.EVENT_LOOP,
+                        help='event loop, uvloop requires the uvloop package')
 
-    args = parser.parse_args()
-    web.run_app(app, path=args.path, port=args.port)
+    args = parser.parse_args(argv)
+    try:
+        use_event_loop(args.loop)
+    except ImportError:
+        parser.error('--loop uvloop requires the uvloop package')
+    sys.exit(serve(args.host, args.port, args.workers, args.loop))
@@ -0,0 +1,332 @@
+
+import asyncio
+import collections
+import contextvars
+import fcntl
+import fnmatch
+import hashlib
+import math
+import os
+import time
+
+from aiohttp import web
+
+import metrics
+from errors import ServerBusy
+import tracing
+
+
+# Weight of the last request in the average time a request holds its turn
+DURATION_WEIGHT = 0.2
+# Seconds between two attempts to take a turn held by other worker processes
+POLL_INTERVAL = 0.05
+
+# Holder of the turn of the shared operation being run, instead of the request
+_operation = contextvars.ContextVar('admission_holder', default=None)
+
+
+def parse_limits(items, queue_size, queue_timeout):
+    """(pattern, limit, queue size, queue timeout) of "<pattern>=<limit>[:<queue size>[:<queue timeout>]]" items"""
+    limits = []
+    for item in items:
+        pattern, equal, values = item.rpartition('=')
+        if not equal or not pattern:
+            raise ValueError(f'Invalid host limit: {item}')
+        limit, size, timeout = (values.split(':') + [None, None])[:3]
+        limits.append((pattern.strip(), int(limit),
+                       queue_size if size is None else int(size),
+                       queue_timeout if timeout is None else float(timeout)))
+    return limits
+
+
+class SharedSlots:
+    """Turns with servers shared by the worker processes, as exclusive locks on files of `directory`
+
+    A server limited to n requests has n slot files, a turn is a lock on one
+    of them. Locks are released by the system when a worker exits, so that
+    turns are never lost.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._fds = {}
+
+    def _fd(self, host, slot):
+        fd = self._fds.get((host, slot))
+        if fd is None:
+            name = f'{hashlib.sha1(host.encode()).hexdigest()}.{slot}'
+            fd = self._fds[host, slot] = os.open(os.path.join(self.directory, name), os.O_RDWR | os.O_CREAT, 0o600)
+        return fd
+
+    def take(self, host, limit, held):
+        """Number of a free slot of `host` now held, None when they are all held by this or other workers"""
+        for slot in range(limit):
+            if slot in held:
+                continue
+            try:
+                fcntl.flock(self._fd(host, slot), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                continue
+            return slot
+        return None
+
+    def give(self, host, slot):
+        fcntl.flock(self._fd(host, slot), fcntl.LOCK_UN)
+
+    def close(self):
+        for fd in self._fds.values():
+            os.close(fd)
+        self._fds.clear()
+
+
+class _Host:
+    def __init__(self, limit, queue_size, queue_timeout):
+        self.limit = limit
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.waiters = collections.deque()
+        # Seconds a request holds its turn, on average
+        self.duration = 1.0
+        # Shared slots held by this worker, and the task taking them for waiting requests
+        self.slots = []
+        self.poller = None
+
+
+class HostLimiter:
+    """Requests handled concurrently per upstream server, waiting their turn in order
+
+    Servers get the limit of the first pattern matching their host name, they
+    are not limited when none does. Requests beyond the limit wait in a first
+    come, first served queue. They are turned away with ServerBusy when the
+    queue is full or they waited too long, with a Retry-After estimated from
+    the average time taken by requests to the server.
+
+    Worker processes of a server share the limits through `slots`, a
+    SharedSlots, queueing their requests separately.
+    """
+
+    def __init__(self, limits, slots=None):
+        self.limits = limits
+        self.slots = slots
+        self._hosts = {}
+        self.counters = collections.Counter()
+
+    def _host(self, host):
+        state = self._hosts.get(host)
+        if state is None:
+            for pattern, limit, queue_size, queue_timeout in self.limits:
+                if fnmatch.fnmatch(host, pattern):
+                    state = self._hosts[host] = _Host(limit, queue_size, queue_timeout)
+                    break
+        return state
+
+    def _retry_after(self, state):
+        return max(1, math.ceil(state.duration * (len(state.waiters) + 1) / max(state.limit, 1)))
+
+    def acquire_nowait(self, host):
+        """Take a turn with `host` if one is free, raising ServerBusy otherwise, returning whether `release` must be called"""
+        state = self._host(host)
+        if state is None:
+            return False
+        if not self._acquire_free(host, state):
+            raise ServerBusy(self._retry_after(state))
+        return True
+
+    def _acquire_free(self, host, state):
+        if state.active < state.limit and not state.waiters and self._take(host, state):
+            state.active += 1
+            return True
+        return False
+
+    async def acquire(self, host):
+        """Wait for the turn of a request to `host`, returning whether `release` must be called"""
+        state = self._host(host)
+        if state is None:
+            return False
+        if self._acquire_free(host, state):
+            return True
+        if len(state.waiters) >= state.queue_size:
+            self.counters['rejected'] += 1
+            metrics.ADMISSION_REJECTED.inc(host, 'queue_full')
+            raise ServerBusy(self._retry_after(state))
+
+        self.counters['queued'] += 1
+        waiter = asyncio.get_event_loop().create_future()
+        state.waiters.append(waiter)
+        if self.slots is not None and state.poller is None:
+            # Turns of other workers are not handed over, they are polled for
+            state.poller = asyncio.ensure_future(self._poll(host, state))
+        start = time.monotonic()
+        try:
+            await asyncio.wait_for(waiter, state.queue_timeout)
+        except asyncio.TimeoutError:
+            self.counters['timeouts'] += 1
+            metrics.ADMISSION_REJECTED.inc(host, 'timeout')
+            raise ServerBusy(self._retry_after(state))
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # Handed the turn while being cancelled
+                self.release(host)
+            raise
+        finally:
+            if waiter in state.waiters:
+                state.waiters.remove(waiter)
+        metrics.ADMISSION_WAIT.observe(time.monotonic() - start)
+        tracing.add('admission', time.monotonic() - start)
+        return True
+
+    def release(self, host, duration=None):
+        state = self._hosts[host]
+        if duration is not None:
+            state.duration += DURATION_WEIGHT * (duration - state.duration)
+        while state.waiters:
+            waiter = state.waiters.popleft()
+            if not waiter.done():
+                # Hand the turn over, requests arriving meanwhile queue behind
+                waiter.set_result(None)
+                return
+        state.active -= 1
+        if self.slots is not None:
+            self.slots.give(host, state.slots.pop())
+
+    def _take(self, host, state):
+        """Take a shared slot of `host`, whether one was free"""
+        if self.slots is None:
+            return True
+        slot = self.slots.take(host, state.limit, state.slots)
+        if slot is None:
+            return False
+        state.slots.append(slot)
+        return True
+
+    async def _poll(self, host, state):
+        """Hand the slots freed by other workers to waiting requests"""
+        try:
+            while state.waiters:
+                await asyncio.sleep(POLL_INTERVAL)
+                while state.waiters and state.active < state.limit and self._take(host, state):
+                    state.active += 1
+                    self.release(host)
+        finally:
+            state.poller = None
+
+    def close(self):
+        for state in self._hosts.values():
+            if state.poller is not None:
+                state.poller.cancel()
+        if self.slots is not None:
+            self.slots.close()
+
+    def stats(self):
+        return {
+            'hosts': {
+                host: {'limit': state.limit, 'active': state.active, 'waiting': len(state.waiters)}
+                for host, state in self._hosts.items() if state.active or state.waiters
+            },
+            **{name: self.counters[name] for name in ('queued', 'rejected', 'timeouts')},
+        }
+
+
+class _Admission:
+    """Turns of a request with its upstream server, one per connection open
+
+    The first connection waits for the turn of the request. Connections
+    opened meanwhile by the request take a turn each, only if one is free:
+    they are refused with ServerBusy otherwise, the request carrying on
+    with the connections it has.
+    """
+
+    def __init__(self, limiter, host):
+        self.limiter = limiter
+        self.host = host
+        self.start = time.monotonic()
+        self.task = asyncio.ensure_future(limiter.acquire(host))
+        self.connections = 0
+        self.extra_turns = 0
+
+    def enter(self):
+        if self.connections and self.task.result() and self.limiter.acquire_nowait(self.host):
+            self.extra_turns += 1
+        self.connections += 1
+
+    def exit(self):
+        self.connections -= 1
+        if self.extra_turns:
+            self.extra_turns -= 1
+            self.limiter.release(self.host)
+
+    def finish(self):
+        if not self.task.done():
+            self.task.cancel()
+        elif not self.task.cancelled() and self.task.exception() is None and self.task.result():
+            self.limiter.release(self.host, time.monotonic() - self.start)
+
+
+class _AdmittedLease:
+    def __init__(self, request, host, lease):
+        self.request = request
+        self.host = host
+        self.lease = lease
+        self.admission = None
+
+    async def __aenter__(self):
+        holder = _operation.get()
+        if holder is None:
+            holder = self.request
+        admission = holder.get('admission')
+        if admission is None:
+            admission = holder['admission'] = _Admission(self.request.app['host_limiter'], self.host)
+        await asyncio.shield(admission.task)
+        admission.enter()
+        self.admission = admission
+        try:
+            return await self.lease.__aenter__()
+        except BaseException:
+            admission.exit()
+            raise
+
+    async def __aexit__(self, exc_type, exc, tb):
+        try:
+            return await self.lease.__aexit__(exc_type, exc, tb)
+        finally:
+            self.admission.exit()
+
+
+def admit(request, host, lease):
+    """Wrap a pool lease so that the request first waits for its turn with `host`
+
+    The turn is taken with the first upstream connection of the request, so
+    that responses served from cache never wait, and kept until the request
+    is handled. Connections opened concurrently by the request take a turn
+    each while they are open.
+    """
+    return _AdmittedLease(request, host, lease)
+
+
+async def run_admitted(func):
+    """Result of `func()`, taking its own turn with upstream servers rather than that of the request calling it
+
+    For operations shared by several requests, which must neither end with
+    the request which started them nor keep its turn once it is handled.
+    """
+    holder = {}
+    token = _operation.set(holder)
+    try:
+        return await func()
+    finally:
+        _operation.reset(token)
+        admission = holder.get('admission')
+        if admission is not None:
+            admission.finish()
+
+
+@web.middleware
+async def admission_middleware(request, handler):
+    try:
+        return await handler(request)
+    finally:
+        admission = request.get('admission')
+        if admission is not None:
+            admission.finish()
@@ -0,0 +1,172 @@
+
+import bisect
+import collections
+import time
+
+from aiohttp import web
+
+
+# Request latencies, in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _labels(names, values, extra=''):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        REGISTRY.append(self)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        lines.extend(self._samples())
+        return lines
+
+
+class Counter(_Metric):
+    """Monotonic count, label values are given positionally"""
+    type = 'counter'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values = collections.defaultdict(float)
+
+    def inc(self, *labels, value=1):
+        self._values[labels] += value
+
+    def _samples(self):
+        for labels, value in list(self._values.items()):
+            yield f'{self.name}{_labels(self.labelnames, labels)} {value:g}'
+
+
+class Gauge(Counter):
+    type = 'gauge'
+
+    def dec(self, *labels, value=1):
+        self._values[labels] -= value
+
+    def set(self, *labels, value):
+        self._values[labels] = value
+
+    def replace(self, values):
+        """Set every labelled value at once, dropping label values no longer reported"""
+        self._values = collections.defaultdict(float, values)
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}
+
+    def observe(self, value, *labels):
+        series = self._series.get(labels)
+        if series is None:
+            # Count per bucket, then sum of observations
+            series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def _samples(self):
+        for labels, series in list(self._series.items()):
+            total = 0
+            for bound, count in zip(self.buckets + ('+Inf',), series):
+                total += count
+                bucket = 'le="%s"' % bound
+                yield f'{self.name}_bucket{_labels(self.labelnames, labels, bucket)} {total}'
+            yield f'{self.name}_sum{_labels(self.labelnames, labels)} {series[-1]:g}'
+            yield f'{self.name}_count{_labels(self.labelnames, labels)} {total}'
+
+
+REGISTRY = []
+
+REQUEST_DURATION = Histogram('ftpproxy_request_duration_seconds', 'Time spent handling requests, including streamed bodies',
+                             ['route', 'method', 'status'])
+REQUESTS_IN_PROGRESS = Gauge('ftpproxy_requests_in_progress', 'Requests being handled, such as active downloads',
+                             ['route', 'method'])
+RESPONSE_BYTES = Counter('ftpproxy_response_bytes_total', 'Bytes sent in response bodies', ['route'])
+ERRORS = Counter('ftpproxy_errors_total', 'Errors returned to clients, by error class', ['error'])
+UPSTREAM_CONNECT = Histogram('ftpproxy_upstream_connect_seconds', 'Time to open a connection to an upstream server',
+                             ['protocol'])
+UPSTREAM_AUTH = Histogram('ftpproxy_upstream_auth_seconds', 'Time to log in to an upstream server once connected',
+                          ['protocol'])
+UPSTREAM_CONNECTIONS = Gauge('ftpproxy_upstream_connections', 'Open upstream FTP control and SSH connections',
+                             ['protocol', 'host', 'state'])
+ADMISSION_REJECTED = Counter('ftpproxy_admission_rejected_total', 'Requests turned away by the per server limits',
+                             ['host', 'reason'])
+ADMISSION_WAIT = Histogram('ftpproxy_admission_wait_seconds', 'Time requests waited for their turn with a limited server')
+COALESCED_REQUESTS = Counter('ftpproxy_coalesced_requests_total',
+                             'Requests sharing the upstream operation of an identical concurrent request', ['operation'])
+
+
+def render():
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+def route_label(request):
+    route = request.match_info.route
+    # Unmatched paths would make a label value per scanned url
+    return route.resource.canonical if route.resource is not None else 'unmatched'
+
+
+async def _body_length(response):
+    if response.prepared:
+        # Streamed bodies are only counted once complete
+        await response.write_eof()
+        return response.body_length
+    # Sent once returned by the handler
+    return response.content_length or 0
+
+
+@web.middleware
+async def metrics_middleware(request, handler):
+    route = route_label(request)
+    method = request.method
+    start = time.monotonic()
+    status = 500
+    REQUESTS_IN_PROGRESS.inc(route, method)
+    try:
+        response = await handler(request)
+        status = response.status
+        # Bodies of HEAD requests are never sent
+        RESPONSE_BYTES.inc(route, value=0 if method == 'HEAD' else await _body_length(response))
+        return response
+    except web.HTTPException as exc:
+        status = exc.status
+        raise
+    finally:
+        REQUESTS_IN_PROGRESS.dec(route, method)
+        REQUEST_DURATION.observe(time.monotonic() - start, route, method, str(status))
+
+
+def collect_pools(app):
+    connections = {}
+    for protocol in app['protocols']:
+        for (host, port), (in_use, idle) in app[f'{protocol}_pool'].connections_by_host().items():
+            connections[protocol, f'{host}:{port}', 'in_use'] = in_use
+            connections[protocol, f'{host}:{port}', 'idle'] = idle
+    UPSTREAM_CONNECTIONS.replace(connections)
+
+
+async def export(request):
+    """Metrics in the Prometheus text format"""
+    collect_pools(request.app)
+    return web.Response(text=render(), headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
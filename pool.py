@@ -0,0 +1,343 @@
+
+import asyncio
+import collections
+import time
+
+from errors import FtpProxyError, ServerUnreachable
+from timeouts import default_timeouts
+import tracing
+
+
+class _Entry:
+    """Pooled upstream connection and its bookkeeping"""
+    def __init__(self, key, connection):
+        self.key = key
+        self.connection = connection
+        self.leases = 0
+        self.last_used = time.monotonic()
+        self.closed = False
+
+
+class Pool:
+    """Keyed pool of upstream connections shared by every route of a protocol
+
+    Connections are keyed by (host, port, user, password). At most `max_size`
+    connections are opened per key, each of them lent to up to `max_leases`
+    concurrent requests. Connections idle for more than `idle_timeout` seconds
+    are closed, connections which failed during a request are discarded.
+    Connections idle for more than `check_after` seconds are checked before
+    being lent again, those used since being most likely alive.
+
+    Subclasses implement `_connect`, `_check` and `_close`, and may override
+    `_lease` / `_unlease` when a lease is more than the connection itself, and
+    `_is_broken` to keep connections alive through harmless errors. Connections
+    are opened and lent within the timeouts of the request borrowing them.
+    """
+    max_leases = 1
+    check_after = 5
+
+    def __init__(self, max_size=4, idle_timeout=60, max_leases=None):
+        self.max_size = max_size
+        if max_leases is not None:
+            self.max_leases = max_leases
+        self.idle_timeout = idle_timeout
+        self._entries = collections.defaultdict(list)
+        self._opening = collections.Counter()
+        # Requests waiting for a connection of each key
+        self._waiting = collections.Counter()
+        self._conditions = {}
+        self._reaper = None
+        self.counters = collections.Counter()
+
+    async def _connect(self, key, timeouts):
+        raise NotImplementedError
+
+    async def _check(self, connection):
+        """Health check run when lending an idle connection"""
+        return True
+
+    async def _close(self, connection):
+        raise NotImplementedError
+
+    async def _lease(self, connection, timeouts):
+        return connection
+
+    async def _unlease(self, connection, lease, exc):
+        pass
+
+    def _is_broken(self, connection, exc):
+        """Whether an error raised while using a connection makes it unusable"""
+        return True
+
+    def acquire(self, host, port, user, password, timeouts=None):
+        return _Lease(self, (host, port, user, password), timeouts or default_timeouts())
+
+    def _condition(self, key):
+        if key not in self._conditions:
+            self._conditions[key] = asyncio.Condition()
+        return self._conditions[key]
+
+    def _prune(self, key):
+        """Forget a key left without connections, unless requests are still opening or waiting for one"""
+        if not self._entries.get(key) and not self._opening[key] and not self._waiting[key]:
+            self._entries.pop(key, None)
+            self._conditions.pop(key, None)
+            del self._opening[key], self._waiting[key]
+
+    async def _checkout(self, key, timeouts):
+        if self._reaper is None and self.idle_timeout:
+            self._reaper = asyncio.ensure_future(self._reap())
+
+        while True:
+            # Dropped with the last connection of the key
+            condition = self._condition(key)
+            async with condition:
+                entry = self._available(key)
+                if entry is None and len(self._entries[key]) + self._opening[key] < self.max_size:
+                    self._opening[key] += 1
+                    opening = True
+                elif entry is None:
+                    self.counters['waits'] += 1
+                    self._waiting[key] += 1
+                    try:
+                        with tracing.phase('pool'):
+                            await condition.wait()
+                    finally:
+                        self._waiting[key] -= 1
+                    continue
+                else:
+                    opening = False
+                    entry.leases += 1
+
+            if opening:
+                return await self._open(key, timeouts)
+
+            idle = time.monotonic() - entry.last_used
+            if entry.leases == 1 and idle > self.check_after and not await self._healthy(entry):
+                await self._discard(entry)
+                continue
+
+            self.counters['reused'] += 1
+            return entry
+
+    def _available(self, key):
+        """Busiest open connection which can still take a lease"""
+        candidates = [entry for entry in self._entries[key] if not entry.closed and entry.leases < self.max_leases]
+        if not candidates:
+            return None
+        return max(candidates, key=lambda entry: entry.leases)
+
+    async def _healthy(self, entry):
+        try:
+            return await self._check(entry.connection)
+        except Exception:
+            return False
+
+    async def _open(self, key, timeouts):
+        condition = self._condition(key)
+        try:
+            connection = await self._connect(key, timeouts)
+        except BaseException:
+            async with condition:
+                self._opening[key] -= 1
+                condition.notify()
+                self._prune(key)
+            raise
+
+        entry = _Entry(key, connection)
+        entry.leases = 1
+        async with condition:
+            self._opening[key] -= 1
+            self._entries[key].append(entry)
+            # Requests waiting for this key may share the new connection
+            condition.notify_all()
+        self.counters['created'] += 1
+        return entry
+
+    async def _checkin(self, entry, discard=False):
+        if discard:
+            await self._discard(entry)
+            return
+
+        condition = self._condition(entry.key)
+        async with condition:
+            entry.leases -= 1
+            entry.last_used = time.monotonic()
+            condition.notify()
+
+    async def _discard(self, entry):
+        """Drop a connection from the pool, whatever its remaining leases"""
+        condition = self._condition(entry.key)
+        async with condition:
+            entry.leases -= 1
+            if entry.closed:
+                return
+            entry.closed = True
+            self._entries[entry.key].remove(entry)
+            self.counters['discarded'] += 1
+            condition.notify()
+            self._prune(entry.key)
+        await self._close_quietly(entry)
+
+    def evict(self, connection):
+        """Forget about a connection closed by the remote end"""
+        for key, entries in self._entries.items():
+            for entry in entries:
+                if entry.connection is connection and not entry.closed:
+                    entry.closed = True
+                    entries.remove(entry)
+                    self.counters['discarded'] += 1
+                    self._prune(key)
+                    return
+
+    async def _close_quietly(self, entry):
+        try:
+            await self._close(entry.connection)
+        except Exception:
+            pass
+
+    async def _reap(self):
+        """Periodically close connections left idle for too long"""
+        while True:
+            await asyncio.sleep(self.idle_timeout / 2)
+            deadline = time.monotonic() - self.idle_timeout
+            for key, entries in list(self._entries.items()):
+                expired = []
+                async with self._condition(key):
+                    for entry in list(entries):
+                        if entry.leases == 0 and entry.last_used < deadline:
+                            entry.closed = True
+                            entries.remove(entry)
+                            expired.append(entry)
+                    self._prune(key)
+                for entry in expired:
+                    self.counters['expired'] += 1
+                    await self._close_quietly(entry)
+
+    async def close(self):
+        if self._reaper is not None:
+            self._reaper.cancel()
+            self._reaper = None
+        entries = [entry for entries in self._entries.values() for entry in entries]
+        self._entries.clear()
+        for entry in entries:
+            entry.closed = True
+            await self._close_quietly(entry)
+
+    def connections_by_host(self):
+        """Open connections in use and idle, per (host, port)"""
+        connections = collections.defaultdict(lambda: [0, 0])
+        for (host, port, _, _), entries in self._entries.items():
+            for entry in entries:
+                connections[host, port][0 if entry.leases else 1] += 1
+        return connections
+
+    def stats(self):
+        # Per server rather than per credentials, never exposing the accounts of other clients
+        hosts = collections.defaultdict(lambda: {'accounts': 0, 'connections': 0, 'in_use': 0, 'idle': 0})
+        for (host, port, _, _), entries in self._entries.items():
+            if not entries:
+                continue
+            counts = hosts[f'{host}:{port}']
+            counts['accounts'] += 1
+            counts['connections'] += len(entries)
+            counts['in_use'] += sum(entry.leases for entry in entries)
+            counts['idle'] += sum(1 for entry in entries if entry.leases == 0)
+        return {
+            'max_size': self.max_size,
+            'max_leases': self.max_leases,
+            'idle_timeout': self.idle_timeout,
+            'hosts': hosts,
+            **{name: self.counters[name] for name in ('created', 'reused', 'discarded', 'expired', 'waits')},
+        }
+
+
+class _Lease:
+    """Async context manager lending a pooled connection to a request
+
+    The connection is discarded when the block raises.
+    """
+    def __init__(self, pool, key, timeouts):
+        self.pool = pool
+        self.key = key
+        self.timeouts = timeouts
+        self.entry = None
+        self.lease = None
+
+    async def __aenter__(self):
+        self.entry = await self.pool._checkout(self.key, self.timeouts)
+        try:
+            self.lease = await self.pool._lease(self.entry.connection, self.timeouts)
+        except BaseException:
+            await self.pool._checkin(self.entry, discard=True)
+            raise
+        return self.lease
+
+    async def __aexit__(self, exc_type, exc, tb):
+        connection = self.entry.connection
+        discard = exc_type is not None and self.pool._is_broken(connection, exc)
+        try:
+            await self.pool._unlease(connection, self.lease, exc)
+        except Exception:
+            discard = True
+        await self.pool._checkin(self.entry, discard=discard)
+
+
+def error_message(exc):
+    """Message reporting `exc` for one of several files, rather than failing the request"""
+    if isinstance(exc, FtpProxyError):
+        return exc.message
+    return ServerUnreachable.message
+
+
+class Workers:
+    """Workers taking `items` one after the other, each over a connection borrowed with `connect()`
+
+    `process(connection, item)` handles an item, errors it raises failing
+    the connection, which is then replaced. Servers often limit connections
+    per user: a worker refused a connection leaves the items to the workers
+    holding or opening one, items are only given up with `fail(item, exc)`
+    when no other worker is left.
+    """
+
+    def __init__(self, items, connect, process, fail):
+        self.pending = collections.deque(items)
+        self.connect = connect
+        self.process = process
+        self.fail = fail
+        # Workers holding or opening a connection
+        self.active = 0
+
+    async def run(self, lease=None, connection=None):
+        """Work until no item is left, starting over `connection` of `lease` when given"""
+        while lease is not None or self.pending:
+            self.active += 1
+            if lease is None:
+                lease = self.connect()
+                try:
+                    connection = await lease.__aenter__()
+                except asyncio.CancelledError:
+                    self.active -= 1
+                    raise
+                except Exception as exc:
+                    self.active -= 1
+                    if not self.active:
+                        # Do not retry an unreachable server once per item
+                        while self.pending:
+                            self.fail(self.pending.popleft(), exc)
+                    return
+
+            error = None
+            try:
+                while self.pending:
+                    await self.process(connection, self.pending.popleft())
+            except asyncio.CancelledError as exc:
+                error = exc
+                raise
+            except Exception as exc:
+                # Carry on over a new connection
+                error = exc
+            finally:
+                self.active -= 1
+                await lease.__aexit__(None if error is None else type(error), error, None)
+                lease = None
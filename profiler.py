@@ -0,0 +1,79 @@
+
+import asyncio
+import collections
+import hmac
+import os
+import sys
+import threading
+
+from aiohttp import web
+
+import config
+from errors import AdminForbidden, InvalidQueryParameter
+from utils import parse_int
+
+
+# Seconds between two samples of the event loop stack
+SAMPLE_INTERVAL = 0.005
+# Longest profile, in seconds
+MAX_SECONDS = 60
+
+
+def check_admin(request):
+    """Fail unless the request carries the admin token, admin routes being disabled without one"""
+    scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+    if not config.ADMIN_TOKEN or scheme.lower() != 'bearer' or not hmac.compare_digest(token.strip(), config.ADMIN_TOKEN):
+        raise AdminForbidden()
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+
+
+def sample_stacks(thread_id, stop, interval=SAMPLE_INTERVAL):
+    """Collapsed stacks of the thread `thread_id` sampled every `interval` seconds, until `stop` is set
+
+    Stacks are keyed by their frames from the outermost one, joined with ";",
+    as expected by flame graph tools.
+    """
+    stacks = collections.Counter()
+    while not stop.wait(interval):
+        frame = sys._current_frames().get(thread_id)
+        frames = []
+        while frame is not None:
+            frames.append(_frame_name(frame))
+            frame = frame.f_back
+        if frames:
+            stacks[';'.join(reversed(frames))] += 1
+    return stacks
+
+
+async def profile(request):
+    """Sample the stack of the event loop for ?seconds=N, returning collapsed stacks with their sample counts
+
+    The loop carries on serving requests meanwhile, sampled from another
+    thread. Stacks ending in the selector are time the loop was idle.
+    """
+    check_admin(request)
+    seconds = parse_int(request, 'seconds', 10)
+    if not 0 < seconds <= MAX_SECONDS:
+        raise InvalidQueryParameter('seconds')
+
+    loop = asyncio.get_event_loop()
+    done = loop.create_future()
+    stop = threading.Event()
+
+    def run(thread_id):
+        stacks = sample_stacks(thread_id, stop)
+        loop.call_soon_threadsafe(lambda: done.done() or done.set_result(stacks))
+
+    threading.Thread(target=run, args=(threading.get_ident(),), name='ftpproxy-profiler', daemon=True).start()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        # Also stop sampling when the client goes away
+        stop.set()
+    stacks = await done
+    body = ''.join(f'{stack} {count}\n' for stack, count in stacks.most_common())
+    return web.Response(text=body, content_type='text/plain')
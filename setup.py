@@ -149,7 +149,7 @@ setup(
 
         # Specify the Python versions you support here. In particular, ensure
         # that you indicate whether you support Python 2, Python 3 or both.
-        'Programming Language :: Python :: 3.6',
+        'Programming Language :: Python :: 3.7',
     ],
 
     # This field adds keywords for your project which will appear on the
@@ -167,7 +167,8 @@ setup(
     #
     #   py_modules=["my_module"],
     #
-    py_modules=["ftp_proxy", "ftp", "sftp", "utils", "errors"],
+    py_modules=["ftp_proxy", "ftp", "sftp", "utils", "errors", "config", "pool", "cache", "download_cache", "archive", "compression", "metrics",
+                "limits", "filters", "changes", "singleflight", "checksum", "timeouts", "tracing", "profiler"],
 
     # This field lists other packages that your project depends on to run.
     # Any package you put here will be installed by pip when your project is
@@ -177,6 +178,9 @@ setup(
     # https://packaging.python.org/en/latest/requirements.html
     install_requires=['aiohttp', 'aioftp', 'asyncssh'],  # Optional
 
+    # contextvars, asyncio.current_task, time.time_ns and datetime.fromisoformat
+    python_requires='>=3.7',
+
     # List additional groups of dependencies here (e.g. development
     # dependencies). Users will be able to install these using the "extras"
     # syntax, for example:
@@ -187,6 +191,8 @@ setup(
     # projects.
     extras_require={  # Optional
         'dev': ['pytest', 'pytest-aiohttp', 'flake8'],
+        'zstd': ['zstandard'],
+        'uvloop': ['uvloop'],
     },
 
     # If there are data files included in your packages that need to be
@@ -212,6 +218,7 @@ setup(
     entry_points={
         'console_scripts': [
             'ftpproxy=ftp_proxy:cli',
+            'ftp-proxy=ftp_proxy:cli',
         ]
     },
 
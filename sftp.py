@@ -1,87 +1,676 @@
 
+import asyncio
+import collections
+import functools
+import inspect
+import stat
+import time
+
 from aiohttp import web
 import asyncssh
+from asyncssh.constants import FX_CONNECTION_LOST, FX_NO_CONNECTION, FXP_EXTENDED_REPLY
+from asyncssh.packet import String, UInt32, UInt64
 
-from utils import parse_headers, asyncio_timeout
-from errors import FtpProxyError, ServerUnreachable, MissingMandatoryQueryParameter
-
-
-SFTP_TIMEOUT = 60
-CHUNK_SIZE = 8192
+from archive import archive_name, parse_format, read_files, stream_archive
+import cache
+import config
+from checksum import checksums, hash_chunks
+from changes import list_changes
+import download_cache
+import metrics
+from limits import admit
+from pool import Pool
+from singleflight import flight_key
+from filters import parse_filter
+from timeouts import request_timeouts, timed, within
+import tracing
+from utils import (parse_headers, parse_int, listing_entry, conditional_response, stream_download, stream_json_lines, temporary_path,
+                   validators, wants_stream)
+from errors import FtpProxyError, ServerUnreachable, MissingMandatoryQueryParameter, UpstreamTimeout
 
 
 class AsyncsshError(FtpProxyError):
     def __init__(self, error):
+        self.error = error
         self.message = error.reason
 
 
-@asyncio_timeout(SFTP_TIMEOUT)
+class _SshClient(asyncssh.SSHClient):
+    """Evict pooled connections as soon as they are closed by the server"""
+    def __init__(self, pool, connected):
+        self._pool = pool
+        self._conn = None
+        self._connected = connected
+        self._started = time.monotonic()
+
+    def connection_made(self, conn):
+        self._conn = conn
+        if not self._connected.done():
+            self._connected.set_result(conn)
+        now = time.monotonic()
+        metrics.UPSTREAM_CONNECT.observe(now - self._started, 'sftp')
+        self._started = now
+
+    def auth_completed(self):
+        metrics.UPSTREAM_AUTH.observe(time.monotonic() - self._started, 'sftp')
+
+    def connection_lost(self, exc):
+        self._pool.evict(self._conn)
+
+
+def _is_closed(exc):
+    """Whether an SFTP error tells the session is gone, rather than being a status reply of the server"""
+    if isinstance(exc, AsyncsshError):
+        exc = exc.error
+    return isinstance(exc, asyncssh.SFTPError) and exc.code in (FX_NO_CONNECTION, FX_CONNECTION_LOST)
+
+
+class SshPool(Pool):
+    """Authenticated SSH connections, each multiplexing several SFTP channels
+
+    A lease is an SFTP client session, kept open on its connection for the
+    next request once released.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Idle SFTP sessions of the connections in the pool
+        self._channels = {}
+
+    async def _connect(self, key, timeouts):
+        host, port, username, password = key
+        connected = asyncio.get_event_loop().create_future()
+        # known_hosts explicitly disabled
+        connecting = asyncio.ensure_future(asyncssh.create_connection(
+            lambda: _SshClient(self, connected), host, port=port, username=username, password=password, known_hosts=None))
+        try:
+            # The TCP connection is made before the key exchange and authentication
+            with tracing.phase('connect'):
+                await asyncio.wait([connecting, connected], timeout=timeouts.connect, return_when=asyncio.FIRST_COMPLETED)
+            if not connecting.done() and not connected.done():
+                raise UpstreamTimeout('connect')
+            with tracing.phase('auth'):
+                await asyncio.wait([connecting], timeout=timeouts.auth)
+            if not connecting.done():
+                raise UpstreamTimeout('auth')
+        except BaseException:
+            connecting.cancel()
+            if connected.done():
+                # Left open by asyncssh when cancelled
+                connected.result().abort()
+            raise
+        conn, _ = connecting.result()
+        self._channels[conn] = []
+        return conn
+
+    async def _check(self, conn):
+        """Round trip over an idle SFTP session, dropping it when the server closed it"""
+        channels = self._channels.get(conn)
+        if not channels:
+            return True
+        sftp = channels[-1]
+        try:
+            await within(sftp.realpath('.'), sftp.ftpproxy_timeouts.first_byte, 'first_byte')
+        except asyncssh.SFTPError as exc:
+            if _is_closed(exc):
+                channels.remove(sftp)
+                sftp.exit()
+        return True
+
+    async def _close(self, conn):
+        for sftp in self._channels.pop(conn, []):
+            sftp.exit()
+        conn.close()
+        await conn.wait_closed()
+
+    async def _lease(self, conn, timeouts):
+        if self._channels.get(conn):
+            sftp = self._channels[conn].pop()
+        else:
+            with tracing.phase('session'):
+                sftp = await within(conn.start_sftp_client(), timeouts.first_byte, 'first_byte')
+        sftp.ftpproxy_timeouts = timeouts
+        return sftp
+
+    async def _unlease(self, conn, sftp, exc):
+        # Requests of the channel may still be running after a timeout, and
+        # channels closed by the server fail every later request
+        reusable = exc is None or (isinstance(exc, (asyncssh.SFTPError, FtpProxyError)) and not isinstance(exc, UpstreamTimeout)
+                                   and not _is_closed(exc))
+        if reusable and conn in self._channels:
+            self._channels[conn].append(sftp)
+        else:
+            sftp.exit()
+
+    def _is_broken(self, conn, exc):
+        # Other errors only close the SFTP channel, leaving the connection to concurrent requests
+        return isinstance(exc, (OSError, asyncssh.DisconnectError))
+
+    def evict(self, conn):
+        super().evict(conn)
+        self._channels.pop(conn, None)
+
+
+async def iter_file(fp, offset=0, size=None, block_size=None, window=None):
+    """Read a remote file keeping up to `window` read requests in flight
+
+    Blocks are yielded in order, at most `window` blocks are buffered so that
+    a slow HTTP client slows down reads from the server.
+    """
+    block_size = block_size or config.SFTP_BLOCK_SIZE
+    window = window or config.SFTP_READ_WINDOW
+    if size is None:
+        size = (await fp.stat()).size - offset
+    end = offset + size
+
+    pending = collections.deque()
+    next_offset = offset
+    try:
+        while True:
+            while len(pending) < window and next_offset < end:
+                length = min(block_size, end - next_offset)
+                pending.append((next_offset, length, asyncio.ensure_future(fp.read(length, next_offset))))
+                next_offset += length
+            if not pending:
+                return
+
+            start, length, read = pending.popleft()
+            data = await read
+            # Servers may return less than requested, fetch the end of the block
+            while data and len(data) < length:
+                more = await fp.read(length - len(data), start + len(data))
+                if not more:
+                    break
+                data += more
+            if data:
+                yield data
+            if len(data) < length:
+                # File truncated since it was opened
+                return
+    finally:
+        for _, _, read in pending:
+            read.cancel()
+
+
+async def write_file(fp, chunks, window=None, timeout=None):
+    """Write `chunks` to a remote file keeping up to `window` write requests in flight, returning its size
+
+    The next chunk is only read once a write completed beyond the window, so
+    that a slow server slows down the client. Waiting for a write fails after
+    `timeout` seconds.
+    """
+    window = window or config.SFTP_WRITE_WINDOW
+    pending = collections.deque()
+    offset = 0
+    try:
+        async for chunk in chunks:
+            pending.append(asyncio.ensure_future(fp.write(chunk, offset)))
+            offset += len(chunk)
+            if len(pending) >= window:
+                await within(pending.popleft(), timeout, 'idle')
+        while pending:
+            await within(pending.popleft(), timeout, 'idle')
+    finally:
+        for write in pending:
+            write.cancel()
+    return offset
+
+
+async def replace(sftp, source, destination):
+    """Rename `source` over `destination`, atomically when the server supports POSIX renames"""
+    try:
+        await sftp.posix_rename(source, destination)
+        return
+    except asyncssh.SFTPError as exc:
+        if exc.code != asyncssh.FX_OP_UNSUPPORTED:
+            raise
+    # SFTP renames fail when the destination exists
+    try:
+        await sftp.remove(destination)
+    except asyncssh.SFTPError as exc:
+        if exc.code != asyncssh.FX_NO_SUCH_FILE:
+            raise
+    await sftp.rename(source, destination)
+
+
+def connect(request):
+    """Borrow an SFTP session from the application SSH pool"""
+    host, port, username, password = parse_headers(request, default_user=None, default_port=22)
+    return admit(request, host, request.app['sftp_pool'].acquire(host, port, username, password,
+                                                                 request_timeouts(request, host)))
+
+
+async def _ping(request):
+    try:
+        async with connect(request):
+            pass
+    except asyncssh.misc.Error as exc:
+        raise AsyncsshError(exc)
+    except OSError:
+        raise ServerUnreachable
+
+
 async def ping(request):
-    """test SFTP connection by sending a minimal LS command
+    """test SFTP connection, checking its idle SFTP session with a round trip
     returns "pong" on success
+
+    Concurrent pings of a server share a single check.
     """
-    host, port, username, password = parse_headers(request, default_user=None, default_port=22)
+    key = flight_key('sftp', parse_headers(request, default_user=None, default_port=22), 'ping')
+    await request.app['ping_flights'].run(key, functools.partial(_ping, request))
+    return web.json_response({'success': True})
+
+
+def is_dir(attrs):
+    return attrs.permissions is not None and stat.S_ISDIR(attrs.permissions)
+
+
+def is_link(attrs):
+    return attrs.permissions is not None and stat.S_ISLNK(attrs.permissions)
+
+
+def file_type(attrs):
+    if attrs.permissions is None:
+        return 'unknown'
+    if stat.S_ISDIR(attrs.permissions):
+        return 'dir'
+    if stat.S_ISLNK(attrs.permissions):
+        return 'link'
+    if stat.S_ISREG(attrs.permissions):
+        return 'file'
+    return 'unknown'
 
+
+def entry_details(path, attrs):
+    """Listing entry from the attributes returned by readdir"""
+    return listing_entry(path, file_type(attrs), attrs.size, attrs.mtime, attrs.permissions)
+
+
+async def _read_directory(sftp, directory, canonical, depth, follow_symlinks):
+    """List a directory, resolving the target of its symbolic links if they should be followed"""
+    names = [name for name in await sftp.readdir(directory) if name.filename not in ('.', '..')]
+    targets = [None] * len(names)
+    if follow_symlinks:
+        links = [i for i, name in enumerate(names) if is_link(name.attrs)]
+
+        async def resolve(name):
+            path = directory + name.filename
+            attrs = await sftp.stat(path)
+            return await sftp.realpath(path) if is_dir(attrs) else None
+
+        for i, target in zip(links, await asyncio.gather(*[resolve(names[i]) for i in links])):
+            targets[i] = target
+    return directory, canonical, depth, names, targets
+
+
+async def walk(sftp, path, recursive=False, max_depth=None, follow_symlinks=False, concurrency=None, descend=None):
+    """List `path`, and its subdirectories when `recursive`, yielding (path, attrs)
+
+    Directories are read breadth first with up to `concurrency` readdir
+    requests in flight over the SFTP session, entries are yielded as each
+    directory is read. Subdirectories deeper than `max_depth`, or for which
+    `descend(path)` is false, are not read.
+    Symbolic links to directories are only followed when `follow_symlinks`,
+    each real directory then being read once to avoid cycles.
+    """
+    concurrency = concurrency or config.SFTP_WALK_CONCURRENCY
+    canonical = await sftp.realpath(path) if follow_symlinks else path
+    visited = {canonical}
+    pending = collections.deque([(path, canonical, 0)])
+    running = set()
     try:
-        # known_hosts explicitly disabled
-        async with asyncssh.connect(host, port=port, username=username, password=password, known_hosts=None) as conn:
-            async with conn.start_sftp_client():
-                return web.json_response({'success': True})
+        while pending or running:
+            while pending and len(running) < concurrency:
+                directory, canonical, depth = pending.popleft()
+                running.add(asyncio.ensure_future(_read_directory(sftp, directory, canonical, depth, follow_symlinks)))
+            done, running = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                directory, canonical, depth, names, targets = task.result()
+                deeper = recursive and (max_depth is None or depth < max_depth)
+                for name, target in zip(names, targets):
+                    entry = f'{directory}{name.filename}'
+                    yield entry, name.attrs
+                    if not deeper:
+                        continue
+                    if is_dir(name.attrs):
+                        target = f'{canonical.rstrip("/")}/{name.filename}'
+                    elif target is None:
+                        continue
+                    if descend is not None and not descend(entry):
+                        continue
+                    if target not in visited:
+                        visited.add(target)
+                        pending.append((entry + '/', target, depth + 1))
+    finally:
+        for task in running:
+            task.cancel()
+
+
+async def iter_listing(request, path, extension='', recursive=False, max_depth=None, follow_symlinks=False,
+                       details=False, listing_filter=None):
+    if listing_filter is not None and not listing_filter.active:
+        listing_filter = None
+
+    def descend(entry):
+        return listing_filter.descend(entry[len(path):])
+
+    try:
+        async with connect(request) as sftp:
+            async for entry, attrs in timed(walk(sftp, path, recursive, max_depth, follow_symlinks, descend=listing_filter and descend),
+                                            sftp.ftpproxy_timeouts):
+                if extension and not entry.endswith(extension):
+                    continue
+                if listing_filter is not None and not listing_filter.matches(entry[len(path):], file_type(attrs), attrs.size, attrs.mtime):
+                    continue
+                yield entry_details(entry, attrs) if details else entry
     except asyncssh.misc.Error as exc:
         raise AsyncsshError(exc)
     except OSError:
         raise ServerUnreachable
 
 
-@asyncio_timeout(SFTP_TIMEOUT)
 async def ls(request):
     """
     :param path: (optional) Path to list
     :param extension: (optional) Filter by extension
+    :param recursive: (optional) Recurse down folders when "true"
+    :param max_depth: (optional) Maximum number of folders to recurse down
+    :param follow_symlinks: (optional) Recurse down symbolic links to folders when "true"
+    :param include, exclude: (optional) Glob patterns of the paths to list or leave out, relative to `path`
+    :param include_regex, exclude_regex: (optional) Regular expressions searched in the same relative paths
+    :param modified_since: (optional) Only list files modified since this ISO 8601 date or POSIX timestamp
+    :param min_size: (optional) Only list files of at least this many bytes
+    :param details: (optional) List entries with their type, size, modification time and permissions when "true"
+    :param stream: (optional) Send paths as newline delimited JSON when "true"
     """
-    host, port, username, password = parse_headers(request, default_user=None, default_port=22)
+    credentials = parse_headers(request, default_user=None, default_port=22)
     path = request.query.get('path', '')
     path = path.rstrip('/') + '/'
     extension = request.query.get('extension', '')
+    recursive = request.query.get('recursive', 'false') == 'true'
+    max_depth = parse_int(request, 'max_depth')
+    follow_symlinks = request.query.get('follow_symlinks', 'false') == 'true'
+    details = request.query.get('details', 'false') == 'true'
+    listing_filter = parse_filter(request)
+
+    entries = functools.partial(iter_listing, request, path, extension, recursive, max_depth, follow_symlinks, details,
+                                listing_filter)
+    if wants_stream(request):
+        return await stream_json_lines(request, entries())
+
+    async def list_files():
+        return [f async for f in entries()]
+
+    return await cache.cached_listing(request, 'sftp', credentials, path, list_files, extension=extension,
+                                      recursive=recursive, max_depth=max_depth, follow_symlinks=follow_symlinks,
+                                      details=details, filter=listing_filter.options)
+
+
+async def changes(request):
+    """Entries added, modified or removed since a previous call
+
+    :param cursor: (optional) Returned by the previous call, every entry is added without it
+    :param path, extension, recursive, max_depth, follow_symlinks, include, exclude, include_regex, exclude_regex,
+        modified_since, min_size: (optional) As for ls
+    """
+    credentials = parse_headers(request, default_user=None, default_port=22)
+    path = request.query.get('path', '')
+    path = path.rstrip('/') + '/'
+    extension = request.query.get('extension', '')
+    recursive = request.query.get('recursive', 'false') == 'true'
+    max_depth = parse_int(request, 'max_depth')
+    follow_symlinks = request.query.get('follow_symlinks', 'false') == 'true'
+    listing_filter = parse_filter(request)
+
+    async def list_entries():
+        return [entry async for entry in iter_listing(request, path, extension, recursive, max_depth, follow_symlinks,
+                                                      details=True, listing_filter=listing_filter)]
+
+    return await list_changes(request, 'sftp', credentials, path, list_entries, extension=extension, recursive=recursive,
+                              max_depth=max_depth, follow_symlinks=follow_symlinks, filter=listing_filter.options)
+
+
+async def invalidate(request):
+    """Drop cached listings of the SFTP server
+
+    :param path: (optional) Only drop listings including this path
+    """
+    return await cache.invalidate(request, 'sftp', parse_headers(request, default_user=None, default_port=22))
+
+
+async def download(request):
+    """
+    :param path: Filepath
+
+    Single and multiple byte ranges are served from the matching offsets,
+    whole files are compressed when the client accepts it. Files are sent
+    with an ETag and Last-Modified from their stat, clients already having
+    them get a 304 without the file being opened, as HEAD requests.
+    """
+    credentials = parse_headers(request, default_user=None, default_port=22)
+    path = request.query.get('path', '')
+    if not path:
+        raise MissingMandatoryQueryParameter('path')
 
     try:
-        async with asyncssh.connect(host, port=port, username=username, password=password, known_hosts=None) as conn:
-            async with conn.start_sftp_client() as sftp:
-                files = [f'{path}{f}' for f in await sftp.listdir(path)
-                         if f not in ('.', '..') and (not extension or f.endswith(extension))]
-                return web.json_response(files)
+        async with connect(request) as sftp:
+            timeouts = sftp.ftpproxy_timeouts
+            # A stat before opening costs the same round trip as one on the opened file
+            attrs = await within(sftp.stat(path), timeouts.first_byte, 'first_byte')
+            response = conditional_response(request, attrs.size, attrs.mtime)
+            if response is not None:
+                return response
+            slot = download_cache.lookup(request, 'sftp', credentials, path, attrs.size, attrs.mtime)
+            if slot is not None and slot.filepath:
+                return await slot.respond(request)
+
+            fp = await within(sftp.open(path, 'rb', block_size=config.SFTP_BLOCK_SIZE), timeouts.first_byte, 'first_byte')
+            async with fp:
+                def read_range(offset, length):
+                    return timed(iter_file(fp, offset, length), timeouts)
+
+                if slot is not None:
+                    return await stream_download(request, slot.read_range(read_range), slot.size, headers=slot.headers,
+                                                 path=path)
+                return await stream_download(request, read_range, attrs.size, headers=validators(attrs.size, attrs.mtime),
+                                             path=path)
+
     except asyncssh.misc.Error as exc:
         raise AsyncsshError(exc)
     except OSError:
         raise ServerUnreachable
 
 
-@asyncio_timeout(SFTP_TIMEOUT)
-async def download(request):
-    """
-    :param path: Filepath
+async def upload(request):
+    """Write the request body to a remote file
+
+    :param path: File to write, replaced when it exists
+    :param atomic: (optional) Write to a temporary file renamed to `path` once
+        complete when "true", so that the file is never seen partially written
     """
-    host, port, username, password = parse_headers(request, default_user=None, default_port=22)
+    credentials = parse_headers(request, default_user=None, default_port=22)
     path = request.query.get('path', '')
     if not path:
         raise MissingMandatoryQueryParameter('path')
+    atomic = request.query.get('atomic', 'false') == 'true'
+    target = temporary_path(path) if atomic else path
+
+    try:
+        async with connect(request) as sftp:
+            timeouts = sftp.ftpproxy_timeouts
+            try:
+                fp = await within(sftp.open(target, 'wb', block_size=config.SFTP_BLOCK_SIZE), timeouts.first_byte, 'first_byte')
+                async with fp:
+                    size = await write_file(fp, request.content.iter_chunked(config.SFTP_BLOCK_SIZE), timeout=timeouts.idle)
+                if atomic:
+                    await within(replace(sftp, target, path), timeouts.first_byte, 'first_byte')
+            except BaseException:
+                if atomic:
+                    try:
+                        await sftp.remove(target)
+                    except Exception:
+                        pass
+                raise
+    except asyncssh.misc.Error as exc:
+        raise AsyncsshError(exc)
+    except OSError:
+        raise ServerUnreachable
+    finally:
+        # Even failed uploads may have changed the file
+        await cache.invalidate_file(request, 'sftp', credentials, path)
+    return web.json_response({'path': path, 'size': size}, status=201)
+
+
+def _send_extended(handler, name, args, waiter):
+    """Send an extended request with the private asyncssh API, whose signature changed across versions"""
+    parameters = inspect.signature(handler._send_request).parameters.values()
+    if any(parameter.kind == parameter.VAR_POSITIONAL for parameter in parameters):
+        handler._send_request(name, *args, waiter=waiter)
+    else:
+        handler._send_request(name, args, waiter)
+
+
+async def _check_file(sftp, path, algorithm):
+    handler = sftp._handler
+    waiter = asyncio.get_event_loop().create_future()
+    # Whole file hashed at once
+    _send_extended(handler, b'check-file-name', (String(path), String(algorithm), UInt64(0), UInt64(0), UInt32(0)), waiter)
+    reply_type, reply = await within(waiter, sftp.ftpproxy_timeouts.first_byte, 'first_byte')
+    if reply_type != FXP_EXTENDED_REPLY:
+        code = reply.get_uint32()
+        if code == asyncssh.FX_OP_UNSUPPORTED:
+            sftp.ftpproxy_check_file = False
+            return None
+        raise asyncssh.SFTPError(code, reply.get_string().decode('utf-8', 'replace'))
+    reply.get_string()
+    if reply.get_string().decode() != algorithm:
+        return None
+    return reply.get_remaining_payload().hex()
 
+
+async def server_checksum(sftp, path, algorithm):
+    """Digest computed by servers supporting the check-file-name extension, None otherwise
+
+    asyncssh has no API for this extension, the request is sent over its
+    SFTP session directly. Servers not supporting it, and asyncssh versions
+    this does not work with, are only tried once per session.
+    """
+    if getattr(sftp, 'ftpproxy_check_file', True) is False or not hasattr(getattr(sftp, '_handler', None), '_send_request'):
+        return None
     try:
-        async with asyncssh.connect(host, port=port, username=username, password=password, known_hosts=None) as conn:
-            async with conn.start_sftp_client() as sftp:
-                async with sftp.open(path, 'rb') as fp:
-                    response = web.StreamResponse()
-                    response.content_type = 'application/octet-stream'
-                    await response.prepare(request)
+        return await _check_file(sftp, path, algorithm)
+    except (asyncssh.Error, FtpProxyError):
+        raise
+    except Exception:
+        # Hashed by the proxy instead
+        sftp.ftpproxy_check_file = False
+        return None
 
-                    chunk = await fp.read(CHUNK_SIZE)
-                    while chunk:
-                        await response.write(chunk)
-                        chunk = await fp.read(CHUNK_SIZE)
 
-                    return response
+async def checksum_file(sftp, path, algorithm):
+    try:
+        digest = await server_checksum(sftp, path, algorithm)
+        if digest is not None:
+            return digest, 'server'
+        timeouts = sftp.ftpproxy_timeouts
+        fp = await within(sftp.open(path, 'rb'), timeouts.first_byte, 'first_byte')
+        async with fp:
+            return await hash_chunks(algorithm, timed(iter_file(fp), timeouts)), 'proxy'
+    except asyncssh.SFTPError as exc:
+        raise AsyncsshError(exc)
 
+
+async def checksum(request):
+    """Checksums of files, computed by the server when it supports it, else by the proxy
+
+    Files are given as a JSON {"paths": [...]} body, or as a single path.
+
+    :param path: (optional) File to check, mandatory without body
+    :param algorithm: (optional) "md5", "sha1", "sha256" (default) or "crc32"
+    """
+    parse_headers(request, default_user=None, default_port=22)
+    paths = await read_files(request)
+    if paths is None:
+        paths = request.query.get('path')
+        if not paths:
+            raise MissingMandatoryQueryParameter('path')
+    try:
+        pool = request.app['sftp_pool']
+        # Files hashed concurrently share the pooled SSH connections, one SFTP channel each
+        concurrency = min(config.CHECKSUM_CONCURRENCY, pool.max_size * pool.max_leases)
+        return await checksums(request, paths, functools.partial(connect, request), checksum_file, concurrency)
     except asyncssh.misc.Error as exc:
         raise AsyncsshError(exc)
     except OSError:
         raise ServerUnreachable
+
+
+async def _archived_chunks(fp, size, timeouts):
+    try:
+        async for chunk in timed(iter_file(fp, 0, size), timeouts):
+            yield chunk
+    except asyncssh.SFTPError as exc:
+        raise AsyncsshError(exc)
+    finally:
+        await fp.close()
+
+
+async def archive_file(sftp, path):
+    """Size and content of a file to archive, failing with AsyncsshError when the server refuses it"""
+    timeouts = sftp.ftpproxy_timeouts
+    try:
+        fp = await within(sftp.open(path, 'rb', block_size=config.SFTP_BLOCK_SIZE), timeouts.first_byte, 'first_byte')
+    except asyncssh.SFTPError as exc:
+        raise AsyncsshError(exc)
+    try:
+        size = (await within(fp.stat(), timeouts.first_byte, 'first_byte')).size
+    except BaseException:
+        await fp.close()
+        raise
+    return size, _archived_chunks(fp, size, timeouts)
+
+
+async def archive(request):
+    """Download several files as a single zip or tar archive
+
+    Files are given as a JSON {"paths": [...]} body, or listed from a directory.
+
+    :param path: (optional) Directory to archive, mandatory without body
+    :param recursive: (optional) Archive files of subdirectories when "true"
+    :param extension: (optional) Only archive files with this extension
+    :param max_depth, include, exclude, include_regex, exclude_regex, modified_since, min_size: (optional) As for ls
+    :param format: (optional) "zip" (default) or "tar"
+    """
+    parse_headers(request, default_user=None, default_port=22)
+    format = parse_format(request)
+    paths = await read_files(request)
+    try:
+        if paths is not None:
+            files = [(path, archive_name(path)) for path in paths]
+        else:
+            path = request.query.get('path', '')
+            if not path:
+                raise MissingMandatoryQueryParameter('path')
+            path = path.rstrip('/') + '/'
+            recursive = request.query.get('recursive', 'false') == 'true'
+            extension = request.query.get('extension', '')
+            max_depth = parse_int(request, 'max_depth')
+            listing_filter = parse_filter(request)
+            files = [(entry['path'], archive_name(entry['path'], path))
+                     async for entry in iter_listing(request, path, extension, recursive, max_depth, details=True,
+                                                     listing_filter=listing_filter)
+                     if entry['type'] == 'file']
+
+        pool = request.app['sftp_pool']
+        # Files fetched concurrently share the pooled SSH connections, one SFTP channel each
+        concurrency = min(config.ARCHIVE_CONCURRENCY, pool.max_size * pool.max_leases)
+        return await stream_archive(request, files, functools.partial(connect, request), archive_file, concurrency, format)
+    except asyncssh.misc.Error as exc:
+        raise AsyncsshError(exc)
+    except OSError:
+        raise ServerUnreachable
+
+
+def create_pool():
+    return SshPool(max_size=config.SFTP_POOL_SIZE, idle_timeout=config.SFTP_POOL_IDLE_TIMEOUT,
+                   max_leases=config.SFTP_MAX_CHANNELS)
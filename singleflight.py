@@ -0,0 +1,48 @@
+
+import asyncio
+import functools
+import hashlib
+import json
+
+from limits import run_admitted
+import metrics
+
+
+def flight_key(protocol, credentials, route, **params):
+    """Key of identical requests, from their protocol, credentials, route and parsed query parameters"""
+    data = json.dumps([protocol, list(credentials), route, sorted(params.items())])
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+class SingleFlight:
+    """Concurrent calls with the same key sharing a single run of the first one, and its outcome
+
+    Results and errors are returned to every waiter. Waiters going away do
+    not cancel the run the others are waiting for, which takes its own turn
+    with upstream servers rather than that of the first request. Shared calls
+    are counted in the coalesced requests metric of `operation`.
+    """
+
+    def __init__(self, operation):
+        self.operation = operation
+        self._inflight = {}
+
+    def running(self, key):
+        return key in self._inflight
+
+    async def run(self, key, func):
+        """Result of `func()`, or of the run already in flight for `key`"""
+        task = self._inflight.get(key)
+        if task is None:
+            task = self._inflight[key] = asyncio.ensure_future(run_admitted(func))
+            task.add_done_callback(functools.partial(self._done, key))
+        else:
+            metrics.COALESCED_REQUESTS.inc(self.operation)
+        return await asyncio.shield(task)
+
+    def _done(self, key, task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if not task.cancelled():
+            # Retrieved even when every waiter went away
+            task.exception()
@@ -0,0 +1,124 @@
+import asyncio
+import threading
+
+from cache import ListingCache, SharedListingCache, _Listing
+
+
+def listing(path, body=b'[]', recursive=False, scope=('ftp', 'localhost', 21)):
+    return _Listing(scope, path, recursive, body)
+
+
+class TestListingCache:
+    def test_lru_size_bound(self):
+        cache = ListingCache(max_bytes=10, ttl=60)
+        cache.put('a', listing('/a', b'1234'))
+        cache.put('b', listing('/b', b'1234'))
+        assert cache.get('a', 60) is not None
+        cache.put('c', listing('/c', b'1234'))
+
+        assert cache.get('b', 60) is None
+        assert cache.get('a', 60) is not None
+        assert cache.get('c', 60) is not None
+        assert cache.size == 8
+        assert cache.stats()['evictions'] == 1
+
+    def test_max_age(self):
+        cache = ListingCache(max_bytes=10, ttl=60)
+        entry = listing('/a')
+        cache.put('a', entry)
+        entry.created -= 30
+
+        assert cache.get('a', 60) is entry
+        assert cache.get('a', 10) is None
+
+    def test_invalidate(self):
+        cache = ListingCache(max_bytes=1000, ttl=60)
+        cache.put('root', listing('/'))
+        cache.put('recursive_root', listing('/', recursive=True))
+        cache.put('parent', listing('/data'))
+        cache.put('self', listing('/data/in'))
+        cache.put('child', listing('/data/in/2019'))
+        cache.put('sibling', listing('/data/out'))
+        cache.put('other_server', listing('/data/in', scope=('ftp', 'other', 21)))
+
+        assert cache.invalidate(('ftp', 'localhost', 21), '/data/in') == 4
+        assert set(cache._entries) == {'root', 'sibling', 'other_server'}
+
+        assert cache.invalidate(('ftp', 'localhost', 21)) == 2
+        assert set(cache._entries) == {'other_server'}
+
+    async def test_single_flight(self):
+        cache = ListingCache(max_bytes=1000, ttl=60)
+        calls = []
+
+        async def entry_factory():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return listing('/')
+
+        results = await asyncio.gather(*[cache.fetch('a', entry_factory, 60) for _ in range(5)])
+
+        assert len(calls) == 1
+        assert all(entry is results[0][0] for entry, hit in results)
+        assert cache.stats()['shared'] == 4
+
+    async def test_error_propagation(self):
+        cache = ListingCache(max_bytes=1000, ttl=60)
+
+        async def entry_factory():
+            await asyncio.sleep(0.01)
+            raise ValueError('boom')
+
+        results = await asyncio.gather(*[cache.fetch('a', entry_factory, 60) for _ in range(3)], return_exceptions=True)
+
+        assert all(isinstance(result, ValueError) for result in results)
+        assert cache.get('a', 60) is None
+        assert not cache._flights.running('a')
+
+
+class TestSharedListingCache:
+    def test_workers(self, tmp_path):
+        filename = str(tmp_path / 'listings.sqlite')
+        worker, other_worker = SharedListingCache(filename, 1000, 60), SharedListingCache(filename, 1000, 60)
+        worker.put('root', listing('/', b'["/a"]'))
+        worker.put('data', listing('/data'))
+
+        assert other_worker.get('root', 60).body == b'["/a"]'
+        assert other_worker.get('root', 60).scope == ('ftp', 'localhost', 21)
+        assert other_worker.invalidate(('ftp', 'localhost', 21), '/data/file') == 1
+        assert worker.get('data', 60) is None
+        assert worker.stats()['entries'] == 1
+
+    def test_size_bound(self, tmp_path):
+        cache = SharedListingCache(str(tmp_path / 'listings.sqlite'), max_bytes=10, ttl=60)
+        cache.put('a', listing('/a', b'1234'))
+        cache.put('b', listing('/b', b'1234'))
+        assert cache.get('a', 60) is not None
+        cache.put('c', listing('/c', b'1234'))
+
+        assert cache.get('b', 60) is None
+        assert cache.get('a', 60) is not None
+        assert cache.stats()['bytes'] == 8
+
+    async def test_off_event_loop(self, tmp_path):
+        cache = SharedListingCache(str(tmp_path / 'listings.sqlite'), 1000, 60)
+        threads = []
+        get, put = cache.get, cache.put
+
+        def record(function):
+            def call(*args):
+                threads.append(threading.get_ident())
+                return function(*args)
+            return call
+
+        async def entry_factory():
+            return listing('/a', b'["/a/b"]')
+
+        cache.get, cache.put = record(get), record(put)
+        assert (await cache.fetch('a', entry_factory, 60))[1] is False
+        entry, hit = await cache.fetch('a', entry_factory, 60)
+        assert hit and entry.body == b'["/a/b"]'
+
+        assert len(threads) == 3
+        assert threading.get_ident() not in threads
+        cache.close()
@@ -0,0 +1,56 @@
+import os
+
+import pytest
+
+from changes import SnapshotStore, decode, diff, encode
+from errors import ExpiredCursor, InvalidQueryParameter
+from utils import listing_entry
+
+
+ENTRIES = [
+    listing_entry('/data/2026/b.csv', 'file', 10, 1000),
+    listing_entry('/data/2026/a.csv', 'file', 20, 1000),
+    listing_entry('/data/2026', 'dir'),
+]
+
+
+class TestSnapshots:
+    def test_encode(self):
+        body = encode(ENTRIES)
+        assert decode(body) == {entry['path']: (entry['type'], entry['size'], entry['modified']) for entry in ENTRIES}
+        # Paths only store what differs from the previous one
+        assert body.count(b'/data') == 1
+
+    def test_diff(self):
+        previous = decode(encode(ENTRIES))
+        entries = [listing_entry('/data/2026/b.csv', 'file', 11, 1000), ENTRIES[2], listing_entry('/data/2026/c.csv', 'file', 1, 1000)]
+        added, modified, removed = diff(previous, entries)
+        assert [entry['path'] for entry in added] == ['/data/2026/c.csv']
+        assert [entry['path'] for entry in modified] == ['/data/2026/b.csv']
+        assert removed == ['/data/2026/a.csv']
+
+    async def test_store(self, tmp_path):
+        store = SnapshotStore(str(tmp_path), max_bytes=1024 * 1024)
+        scope = store.scope('ftp', ('localhost', 21, 'anonymous', ''), '/data')
+        cursor = await store.save(scope, ENTRIES)
+        # Unchanged listings keep their cursor
+        assert await store.save(scope, ENTRIES[::-1]) == cursor
+        assert len(os.listdir(str(tmp_path))) == 1
+        assert await store.load(scope, cursor) == decode(encode(ENTRIES))
+
+        other_scope = store.scope('ftp', ('localhost', 21, 'anonymous', ''), '/other')
+        with pytest.raises(InvalidQueryParameter):
+            await store.load(other_scope, cursor)
+        with pytest.raises(InvalidQueryParameter):
+            await store.load(scope, '../../etc/passwd')
+        with pytest.raises(ExpiredCursor):
+            await store.load(scope, scope + '0' * 16)
+
+    async def test_eviction(self, tmp_path):
+        store = SnapshotStore(str(tmp_path), max_bytes=1)
+        scope = store.scope('ftp', ('localhost', 21, 'anonymous', ''), '/data')
+        first = await store.save(scope, ENTRIES)
+        last = await store.save(scope, ENTRIES[:1])
+        assert os.listdir(str(tmp_path)) == [f'{last}.snapshot']
+        with pytest.raises(ExpiredCursor):
+            await store.load(scope, first)
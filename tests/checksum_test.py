@@ -0,0 +1,16 @@
+import hashlib
+import zlib
+
+from checksum import hash_chunks
+
+
+async def chunks(*data):
+    for chunk in data:
+        yield chunk
+
+
+class TestHashChunks:
+    async def test_algorithms(self):
+        assert await hash_chunks('sha256', chunks(b'foo', b'bar')) == hashlib.sha256(b'foobar').hexdigest()
+        assert await hash_chunks('md5', chunks()) == hashlib.md5().hexdigest()
+        assert await hash_chunks('crc32', chunks(b'foo', b'bar')) == f'{zlib.crc32(b"foobar"):08x}'
@@ -0,0 +1,71 @@
+import gzip
+import os
+import threading
+
+from aiohttp.test_utils import make_mocked_request
+import pytest
+
+import compression
+import config
+
+
+def request(**headers):
+    return make_mocked_request('GET', '/ftp/download', headers=headers)
+
+
+async def chunks(*blocks):
+    for block in blocks:
+        yield block
+
+
+class TestNegotiate:
+    def test_accepted_encodings(self):
+        assert compression.accepted_encodings('gzip, deflate;q=0.5, br;q=0') == {'gzip': 1.0, 'deflate': 0.5, 'br': 0.0}
+
+    def test_gzip(self):
+        assert compression.negotiate(request(**{'Accept-Encoding': 'gzip, deflate'}), '/data.csv', 10000) == 'gzip'
+        assert compression.negotiate(request(**{'Accept-Encoding': '*'}), '/data.csv', None) in ('gzip', 'zstd')
+
+    def test_not_accepted(self):
+        assert compression.negotiate(request(), '/data.csv', 10000) is None
+        assert compression.negotiate(request(**{'Accept-Encoding': 'gzip;q=0'}), '/data.csv', 10000) is None
+
+    def test_skipped(self):
+        headers = {'Accept-Encoding': 'gzip'}
+        assert compression.negotiate(request(**headers), '/data.csv.gz', 10000) is None
+        assert compression.negotiate(request(**headers), '/data.csv', 100) is None
+        assert compression.negotiate(request(**headers, Range='bytes=0-10'), '/data.csv', 10000) is None
+        # Incompressible content whatever the extension
+        assert compression.negotiate(request(**headers), '/data.csv', 10000, sample=os.urandom(10000)) is None
+        assert compression.negotiate(request(**headers), '/data.csv', 10000, sample=b'a;b;c\n' * 1000) == 'gzip'
+
+    def test_zstd(self):
+        pytest.importorskip('zstandard')
+        assert compression.negotiate(request(**{'Accept-Encoding': 'gzip, zstd'}), '/data.csv', 10000) == 'zstd'
+
+
+class TestCompress:
+    async def test_gzip(self, monkeypatch):
+        monkeypatch.setattr(compression, 'EXECUTOR_THRESHOLD', 100)
+        data = [b'a;b;c\n' * 10, b'd;e;f\n' * 100]
+        compressed = b''.join([chunk async for chunk in compression.compress('gzip', chunks(data[1]), data[0])])
+        assert gzip.decompress(compressed) == b''.join(data)
+
+    @pytest.mark.parametrize('chunk_size', [8192, config.SFTP_BLOCK_SIZE])
+    async def test_executor(self, monkeypatch, chunk_size):
+        # Chunks of aioftp and of SFTP reads, buffered up to the executor threshold
+        threads = []
+
+        class Gzip(compression._Gzip):
+            def compress(self, data):
+                threads.append(threading.get_ident())
+                return super().compress(data)
+
+        monkeypatch.setitem(compression.ENCODINGS, 'gzip', Gzip)
+        data = os.urandom(chunk_size // 2).hex().encode() * 20
+        blocks = [data[offset:offset + chunk_size] for offset in range(0, len(data), chunk_size)]
+        compressed = b''.join([chunk async for chunk in compression.compress('gzip', chunks(*blocks))])
+
+        assert gzip.decompress(compressed) == data
+        assert len(threads) < len(blocks)
+        assert threading.get_ident() not in threads
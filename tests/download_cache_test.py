@@ -0,0 +1,96 @@
+import fcntl
+import os
+
+from download_cache import DownloadCache
+
+
+async def chunks(*blocks):
+    for block in blocks:
+        yield block
+
+
+async def store(cache, key, data, mtime=1000):
+    version = cache.version(len(data), mtime)
+    return b''.join([chunk async for chunk in cache.tee(key, version, len(data), mtime, chunks(data[:2], data[2:]))])
+
+
+class TestDownloadCache:
+    async def test_tee(self, tmp_path):
+        cache = DownloadCache(str(tmp_path), max_bytes=100)
+        assert await store(cache, 'a', b'12345') == b'12345'
+
+        filepath = cache.get('a', cache.version(5, 1000))
+        with open(filepath, 'rb') as fp:
+            assert fp.read() == b'12345'
+        assert os.stat(filepath).st_mtime == 1000
+        # Changed remote file
+        assert cache.get('a', cache.version(5, 2000)) is None
+        assert cache.stats()['stale'] == 1
+        assert os.listdir(str(tmp_path)) == []
+
+    async def test_incomplete_download(self, tmp_path):
+        cache = DownloadCache(str(tmp_path), max_bytes=100)
+        version = cache.version(10, 1000)
+        assert b''.join([chunk async for chunk in cache.tee('a', version, 10, 1000, chunks(b'12345'))]) == b'12345'
+
+        assert cache.get('a', version) is None
+        assert os.listdir(str(tmp_path)) == []
+
+    async def test_lru_size_bound(self, tmp_path):
+        cache = DownloadCache(str(tmp_path), max_bytes=10)
+        await store(cache, 'a', b'1234')
+        await store(cache, 'b', b'1234')
+        assert cache.get('a', cache.version(4, 1000)) is not None
+        await store(cache, 'c', b'1234')
+
+        assert cache.get('b', cache.version(4, 1000)) is None
+        assert cache.size == 8
+        assert len(os.listdir(str(tmp_path))) == 2
+        assert cache.stats()['evictions'] == 1
+
+    async def test_reload(self, tmp_path):
+        cache = DownloadCache(str(tmp_path), max_bytes=10)
+        key = cache.key('ftp', ('localhost', 21, 'anonymous', ''), '/a')
+        await store(cache, key, b'1234')
+
+        cache = DownloadCache(str(tmp_path), max_bytes=10)
+        assert cache.get(key, cache.version(4, 1000)) is not None
+        assert cache.size == 4
+
+    async def test_shared(self, tmp_path):
+        worker = DownloadCache(str(tmp_path), max_bytes=10, shared=True)
+        other_worker = DownloadCache(str(tmp_path), max_bytes=10, shared=True)
+        keys = [worker.key('ftp', ('localhost', 21, 'anonymous', ''), path) for path in ('/a', '/b', '/c')]
+        await store(worker, keys[0], b'1234')
+        await store(other_worker, keys[1], b'1234')
+
+        # Stored by another worker
+        assert other_worker.get(keys[0], other_worker.version(4, 1000)) is not None
+        await store(worker, keys[2], b'1234')
+
+        # Least recently used in the whole directory
+        assert worker.get(keys[1], worker.version(4, 1000)) is None
+        assert other_worker.get(keys[1], other_worker.version(4, 1000)) is None
+        assert other_worker.get(keys[0], other_worker.version(4, 1000)) is not None
+        assert worker.stats()['evictions'] == 1
+
+    async def test_shared_eviction_running(self, tmp_path):
+        cache = DownloadCache(str(tmp_path), max_bytes=4, shared=True)
+        keys = [cache.key('ftp', ('localhost', 21, 'anonymous', ''), path) for path in ('/a', '/b')]
+        await store(cache, keys[0], b'1234')
+        with open(os.path.join(str(tmp_path), '.lock'), 'a') as fp:
+            # Another worker evicting
+            fcntl.flock(fp, fcntl.LOCK_EX)
+            await store(cache, keys[1], b'1234')
+            assert len(os.listdir(str(tmp_path))) == 3
+
+        await store(cache, keys[1], b'1234')
+        assert cache.get(keys[0], cache.version(4, 1000)) is None
+        assert cache.get(keys[1], cache.version(4, 1000)) is not None
+        assert cache.stats()['evictions'] == 1
+
+    def test_hosts(self, tmp_path):
+        cache = DownloadCache(str(tmp_path), max_bytes=10, hosts=('*.example.com',), excluded_hosts=('live.example.com',))
+        assert cache.enabled_for('archive.example.com')
+        assert not cache.enabled_for('live.example.com')
+        assert not cache.enabled_for('localhost')
@@ -0,0 +1,64 @@
+import re
+
+import pytest
+from aiohttp.test_utils import make_mocked_request
+
+from errors import InvalidQueryParameter
+from filters import ListingFilter, parse_filter
+
+
+class TestListingFilter:
+    def test_include_glob(self):
+        listing_filter = ListingFilter(include=['incoming/2026-10-*/**/*.csv'])
+        assert listing_filter.matches('incoming/2026-10-05/a.csv', 'file')
+        assert listing_filter.matches('incoming/2026-10-05/x/y/a.csv', 'file')
+        assert not listing_filter.matches('incoming/2026-10-05/a.txt', 'file')
+        assert not listing_filter.matches('incoming/2026-09-30/a.csv', 'file')
+        assert not listing_filter.matches('incoming/2026-10-05', 'dir')
+
+        assert listing_filter.descend('incoming')
+        assert listing_filter.descend('incoming/2026-10-05')
+        assert listing_filter.descend('incoming/2026-10-05/x')
+        assert not listing_filter.descend('incoming/2026-09-30')
+        assert not listing_filter.descend('outgoing')
+
+    def test_exclude(self):
+        listing_filter = ListingFilter(exclude=['**/tmp'], exclude_regex=[re.compile(r'\.bak$')])
+        assert not listing_filter.descend('a/tmp')
+        assert not listing_filter.matches('tmp', 'dir')
+        assert not listing_filter.matches('a/file.bak', 'file')
+        assert listing_filter.matches('a/file', 'file')
+        assert listing_filter.descend('a')
+
+    def test_include_regex(self):
+        listing_filter = ListingFilter(include=['*.txt'], include_regex=[re.compile(r'^logs/.*\.log$')])
+        assert listing_filter.matches('a.txt', 'file')
+        assert listing_filter.matches('logs/2026/a.log', 'file')
+        assert not listing_filter.matches('b.csv', 'file')
+        # Regular expressions may match anywhere
+        assert listing_filter.descend('data')
+
+    def test_modified_since_and_min_size(self):
+        listing_filter = ListingFilter(modified_since=1000, min_size=10)
+        assert listing_filter.matches('a', 'file', size=10, modified=1000)
+        assert not listing_filter.matches('a', 'file', size=9, modified=1000)
+        assert not listing_filter.matches('a', 'file', size=10, modified=999)
+        assert not listing_filter.matches('a', 'file', size=None, modified=1000)
+        assert not listing_filter.matches('d', 'dir', size=4096, modified=2000)
+        assert listing_filter.descend('d')
+
+    def test_parse(self):
+        request = make_mocked_request('GET', '/ftp/ls?include=*.csv&include=*.txt&modified_since=2026-10-01&min_size=1')
+        listing_filter = parse_filter(request)
+        assert listing_filter.options['include'] == ['*.csv', '*.txt']
+        assert listing_filter.modified_since == 1790812800
+        assert listing_filter.active
+        assert not parse_filter(make_mocked_request('GET', '/ftp/ls')).active
+
+        request = make_mocked_request('GET', '/ftp/ls?modified_since=2026-10-01T02:00:00%2B02:00')
+        assert parse_filter(request).modified_since == 1790812800
+
+    @pytest.mark.parametrize('query', ['include_regex=(', 'modified_since=yesterday', 'min_size=big'])
+    def test_invalid(self, query):
+        with pytest.raises(InvalidQueryParameter):
+            parse_filter(make_mocked_request('GET', f'/ftp/ls?{query}'))
@@ -0,0 +1,84 @@
+import asyncio
+import os
+import subprocess
+import sys
+
+import aiohttp
+import pytest
+
+from ftp_proxy import init_func, use_event_loop
+from ftp_test import FtpServer
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class TestFtpProxy:
+    async def test_protocols(self, aiohttp_client):
+        client = await aiohttp_client(init_func(protocols=('ftp',)))
+        resp = await client.get('/sftp/ping')
+        assert resp.status == 404
+
+        stats = await (await client.get('/stats')).json()
+        assert 'ftp_pool' in stats and 'sftp_pool' not in stats
+        resp = await client.get('/metrics')
+        assert resp.status == 200
+
+    async def test_workers(self, loop, tmp_path):
+        env = {**os.environ, 'FTPPROXY_STATE_DIR': str(tmp_path / 'state'), 'FTPPROXY_DOWNLOAD_CACHE_DIR': str(tmp_path / 'downloads'),
+               'FTPPROXY_LISTING_CACHE_TTL': '60'}
+        args = ['--host', 'localhost', '--port', '8089', '--workers', '2']
+        process = subprocess.Popen([sys.executable, '-c', 'import ftp_proxy; ftp_proxy.cli()', *args], cwd=ROOT, env=env)
+        try:
+            async with aiohttp.ClientSession() as session, FtpServer(loop, host='localhost', port=2221):
+                for _ in range(100):
+                    try:
+                        await session.get('http://localhost:8089/stats')
+                        break
+                    except aiohttp.ClientConnectionError:
+                        await asyncio.sleep(0.1)
+
+                headers = {'X-ftpproxy-host': 'localhost', 'X-ftpproxy-port': '2221'}
+                with open(os.path.join(ROOT, 'setup.py'), 'rb') as fp:
+                    content = fp.read()
+
+                async def get(route, path):
+                    async with session.get(f'http://localhost:8089/ftp/{route}', headers=headers, params={'path': path}) as resp:
+                        assert resp.status == 200
+                        return resp.headers['X-ftpproxy-cache'], await resp.read()
+
+                assert await get('download', '/setup.py') == ('miss', content)
+                assert (await get('ls', '/'))[0] == 'miss'
+                # Stored once the download went through
+                await asyncio.sleep(0.5)
+                # Cached by either worker for both of them
+                for _ in range(4):
+                    assert await get('download', '/setup.py') == ('hit', content)
+                    assert (await get('ls', '/'))[0] == 'hit'
+        finally:
+            process.terminate()
+            assert process.wait(10) == 0
+
+    def test_unknown_protocol(self):
+        with pytest.raises(ValueError):
+            init_func(protocols=('ftp', 'http'))
+
+    def test_lazy_import(self):
+        code = 'import sys, ftp_proxy; print("asyncssh" in sys.modules, ftp_proxy.app["protocols"])'
+        env = {**os.environ, 'FTPPROXY_PROTOCOLS': 'ftp'}
+        output = subprocess.check_output([sys.executable, '-c', code], cwd=ROOT, env=env)
+        assert output.decode().strip() == "False ('ftp',)"
+
+    def test_uvloop(self):
+        uvloop = pytest.importorskip('uvloop')
+        policy = asyncio.get_event_loop_policy()
+        try:
+            use_event_loop('uvloop')
+            loop = asyncio.new_event_loop()
+            assert isinstance(loop, uvloop.Loop)
+            loop.close()
+        finally:
+            asyncio.set_event_loop_policy(policy)
+
+        with pytest.raises(ValueError):
+            use_event_loop('trio')
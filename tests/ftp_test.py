@@ -1,16 +1,35 @@
+import asyncio
+import hashlib
+import io
+import json
+import os
+import tarfile
+import tempfile
+import time
+import zipfile
 
 import aioftp
+import aiohttp
+import pytest
+
+import config
+import ftp
+from changes import SnapshotStore
+from download_cache import DownloadCache
+from limits import HostLimiter, parse_limits
+from timeouts import Timeouts
 
 
 class FtpServer():
     """Provide testing ftp server as an async context manager"""
-    def __init__(self, loop, host='localhost', port=2221, user=None, password=None):
+    def __init__(self, loop, host='localhost', port=2221, user=None, password=None, maximum_connections=None,
+                 server_class=aioftp.Server, **options):
         if user:
-            users = aioftp.User(user, password),
-            self.server = aioftp.Server(users, loop=loop)
+            users = aioftp.User(user, password, maximum_connections=maximum_connections),
+            self.server = server_class(users, loop=loop, **options)
         else:
             # Setup server with anonymous login
-            self.server = aioftp.Server(loop=loop)
+            self.server = server_class(loop=loop, **options)
         self.host = host
         self.port = port
 
@@ -39,6 +58,40 @@ class TestFtpPing:
         assert resp.status == 400
         assert await resp.json() == {'error': 'Failed connecting to FTP server'}
 
+    async def test_concurrent(self, client, loop):
+        async with FtpServer(loop, host='localhost', port=2221):
+            headers = {'X-ftpproxy-host': 'localhost', 'X-ftpproxy-port': '2221'}
+            responses = await asyncio.gather(*[client.get('/ftp/ping', headers=headers) for _ in range(10)])
+            assert [resp.status for resp in responses] == [200] * 10
+
+            # A single upstream check
+            stats = (await (await client.get('/stats')).json())['ftp_pool']
+            assert stats['created'] == 1
+            assert stats['reused'] == 0
+
+        # Errors reach every client
+        responses = await asyncio.gather(*[client.get('/ftp/ping', headers=headers) for _ in range(3)])
+        assert [await resp.json() for resp in responses] == [{'error': 'Failed connecting to FTP server'}] * 3
+
+    async def test_connect_timeout(self, client, loop):
+        async def silent(reader, writer):
+            await asyncio.sleep(1)
+            writer.close()
+
+        server = await asyncio.start_server(silent, 'localhost', 2221)
+        try:
+            headers = {'X-ftpproxy-host': 'localhost', 'X-ftpproxy-port': '2221', 'X-ftpproxy-timeout-connect': '0.1'}
+            resp = await client.get('/ftp/ping', headers=headers)
+            assert resp.status == 504
+            assert await resp.json() == {'error': 'Timed out connecting to the server'}
+
+            headers['X-ftpproxy-timeout-connect'] = 'never'
+            resp = await client.get('/ftp/ping', headers=headers)
+            assert await resp.json() == {'error': 'Invalid X-ftpproxy-timeout-connect header'}
+        finally:
+            server.close()
+            await server.wait_closed()
+
     async def test_mandatory_param(self, client):
         resp = await client.get('/ftp/ping')
         assert resp.status == 400
@@ -110,6 +163,210 @@ class TestFtpLs:
             assert '/tests/ftp_test.py' in response_data
             assert '/tests' not in response_data
 
+    async def test_stream(self, client, loop):
+        async with FtpServer(loop, host='localhost', port=2221):
+            headers = {'X-ftpproxy-host': 'localhost', 'X-ftpproxy-port': '2221'}
+            params = {'recursive': 'true', 'stream': 'true'}
+
+            resp = await client.get('/ftp/ls', headers=headers, params=params)
+            lines = [json.loads(line) for line in (await resp.text()).splitlines()]
+
+            assert resp.status == 200
+            assert resp.content_type == 'application/x-ndjson'
+            assert '/tests/ftp_test.py' in lines
+            assert lines[-1]['status'] == 'ok'
+            assert lines[-1]['count'] == len(lines) - 1
+            assert lines[-1]['dirs_per_sec'] > 0
+
+            resp = await client.get('/ftp/ls', headers={**headers, 'Accept': 'application/x-ndjson'}, params={'path': '/foo'})
+            assert resp.status == 400
+
+    async def test_details(self, client, loop):
+        async with FtpServer(loop, host='localhost', port=2221):
+            headers = {'X-ftpproxy-host': 'localhost', 'X-ftpproxy-port': '2221'}
+            params = {'details': 'true'}
+
+            resp = await client.get('/ftp/ls', headers=headers, params=params)
+            assert resp.status == 200
+            entries = {entry['path']: entry for entry in await resp.json()}
+
+            readme = entries['/README.md']
+            assert readme['type'] == 'file'
+            assert readme['size'] == os.path.getsize('README.md')
+            assert readme['modified'].endswith('Z')
+            assert entries['/tests']['type'] == 'dir'
+
+    async def test_parallel_walk(self, client, loop):
+        async with FtpServer(loop, host='localhost', port=2221):
+            headers = {'X-ftpproxy-host': 'localhost', 'X-ftpproxy-port': '2221'}
+
+            resp = await client.get('/ftp/ls', headers=headers, params={'recursive': 'true'})
+            assert resp.status == 200
+            assert float(resp.headers['X-ftpproxy-walk-time']) > 0
+            assert float(resp.headers['X-ftpproxy-walk-dirs-per-sec']) > 0
+
+            ftp_client = aioftp.Client()
+            await ftp_client.connect('localhost', 2221)
+            await ftp_client.login()
+            expected = [str(path) for path, _ in await ftp_client.list('/', recursive=True)]
+            ftp_client.close()
+            assert sorted(await resp.json()) == sorted(expected)
+
+            # Subdirectories were listed over several pooled connections
+            resp = await client.get('/stats')
+            stats = (await resp.json())['ftp_pool']
+            assert stats['created'] > 1
+            assert stats['hosts']['localhost:2221']['connections'] <= stats['max_size']
+
+    async def test_walk_connection_limit(self, client, loop):
+        async with FtpServer(loop, host='localhost', port=2221, user='foo', password='bar', maximum_connections=1):
+            headers = {'X-ftpproxy-host': 'localhost', 'X-ftpproxy-port': '2221',
+                       'X-ftpproxy-user': 'foo', 'X-ftpproxy-password': 'bar'}
+
+            resp = await client.get('/ftp/ls', headers=headers, params={'recursive': 'true'})
+            assert resp.status == 200
+            assert '/tests/ftp_test.py' in await resp.json()
+
+    async def test_filters(self, client, loop, monkeypatch):
+        listed = []
+        list_directory = ftp._list_directory
+
+        async def record(client, directory, *args):
+            listed.append(str(directory))
+            return await list_directory(client, directory, *args)
+
+        monkeypatch.setattr(ftp, '_list_directory', record)
+        with tempfile.TemporaryDirectory(dir='.') as root:
+            make_tree(root)
+            path = '/' + os.path.basename(root)
+            async with FtpServer(loop, host='localhost', port=2221):
+                headers = {'X-ftpproxy-host': 'localhost', 'X-ftpproxy-port': '2221'}
+                params = {'path': path, 'recursive': 'true', 'include': 'incoming/2026-10-*/**/*.csv'}
+
+                resp = await client.get('/ftp/ls', headers=headers, params=params)
+                assert resp.status == 200
+                assert sorted(await resp.json()) == [f'{path}/incoming/2026-10-01/a.csv', f'{path}/incoming/2026-10-01/sub/b.csv']
+                # Other folders were never listed
+                assert sorted(listed) == [path, f'{path}/incoming', f'{path}/incoming/2026-10-01', f'{path}/incoming/2026-10-01/sub']
+
+                params = {'path': path, 'recursive': 'true', 'max_depth': '1', 'exclude': '**/*.txt', 'min_size': '2',
+                          'modified_since': '2026-01-01T00:00:00Z'}
+                resp = await client.get('/ftp/ls', headers=headers, params=params)
+                assert await resp.json() == [f'{path}/outgoing/d.csv']
+
+
+class SlowListingClient:
+    """Client listing one entry, then the next one once `more` is set"""
+    ftpproxy_timeouts = Timeouts(1, 1, 1, 1)
+
+    def __init__(self):
+        self.more = asyncio.Event()
+
+    async def list(self, directory):
+        yield directory / 'a.txt', {'type': 'file'}
+        await self.more.wait()
+        yield directory / 'b.txt', {'type': 'file'}
+
+
+class SlowListingLease:
+    def __init__(self, client):
+        self.client = client
+
+    async def __aenter__(self):
+        return self.client
+
+    async def __aexit__(self, *args):
+        pass
+
+
+class TestFtpWalk:
+    async def test_streamed(self):
+        client = SlowListingClient()
+        walk = ftp.walk(lambda: SlowListingLease(client), '/data')
+        # Entries come as they are listed, not once the directory is
+        path, _ = await asyncio.wait_for(walk.__anext__(), 0.5)
+        assert str(path) == '/data/a.txt'
+        client.more.set()
+        assert [str(path) async for path, _ in walk] == ['/data/b.txt']
+
+
+def make_tree(root):
+    """Files to filter, all 4 bytes long and modified on 2026-10-01"""
+    for name in ('incoming/2026-10-01/a.csv', 'incoming/2026-10-01/e.txt', 'incoming/2026-10-01/sub/b.csv',
+                 'incoming/2026-09-30/c.csv', 'outgoing/d.csv'):
+        filepath = os.path.join(root, name)
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        with open(filepath, 'w') as fp:
+            fp.write('a,b\n')
+        os.utime(filepath, (1790812800, 1790812800))
+
+
+class TestFtpChanges:
+    async def test_default(self, client, loop, tmp_path):
+        client.server.app['snapshots'] = SnapshotStore(str(tmp_path), max_bytes=1024 * 1024)
+        with tempfile.TemporaryDirectory(dir='.') as root:
+            make_tree(root)
+            path = '/' + os.path.basename(root)
+            async with FtpServer(loop, host='localhost', port=2221):
+                headers = {'X-ftpproxy-host': 'localhost', 'X-ftpproxy-port': '2221'}
+                params = {'path': path, 'recursive': 'true', 'include': '**/*.csv'}
+
+                resp = await client.get('/ftp/changes', headers=headers, params=params)
+                assert resp.status == 200
+                changes = await resp.json()
+                assert len(changes['added']) == 4
+                assert changes['added'][0]['size'] == 4
+                assert changes['modified'] == changes['removed'] == []
+
+                with open(os.path.join(root, 'outgoing', 'd.csv'), 'a') as fp:
+                    fp.write('c,d\n')
+                os.remove(os.path.join(root, 'incoming', '2026-09-30', 'c.csv'))
+                make_tree(os.path.join(root, 'new'))
+                params['cursor'] = changes['cursor']
+                resp = await client.get('/ftp/changes', headers=headers, params=params)
+                changes = await resp.json()
+                assert sorted(entry['path'] for entry in changes['added']) == [
+                    f'{path}/new/incoming/2026-09-30/c.csv', f'{path}/new/incoming/2026-10-01/a.csv',
+                    f'{path}/new/incoming/2026-10-01/sub/b.csv', f'{path}/new/outgoing/d.csv']
+                assert [entry['path'] for entry in changes['modified']] == [f'{path}/outgoing/d.csv']
+                assert changes['removed'] == [f'{path}/incoming/2026-09-30/c.csv']
+
+                params['cursor'] = changes['cursor']
+                resp = await client.get('/ftp/changes', headers=headers, params=params)
+                assert await resp.json() == {'cursor': params['cursor'], 'added': [], 'modified': [], 'removed': []}
+
+                # Cursors only apply to the listing they were returned for
+                params['path'] = '/'
+                resp = await client.get('/ftp/changes', headers=headers, params=params)
+                assert resp.status == 400
+
+
+class SizeServer(aioftp.Server):
+    """Server without MLST, answering SIZE and MDTM instead"""
+    listed = []
+
+    async def mlst(self, connection, rest):
+        connection.response('502', 'Command not implemented')
+        return True
+
+    async def mlsd(self, connection, rest):
+        self.listed.append(rest)
+        return await super().mlsd(connection, rest)
+
+    async def list(self, connection, rest):
+        self.listed.append(rest)
+        return await super().list(connection, rest)
+
+    async def size(self, connection, rest):
+        real_path, _ = self.get_paths(connection, rest)
+        connection.response('213', str(real_path.stat().st_size))
+        return True
+
+    async def mdtm(self, connection, rest):
+        real_path, _ = self.get_paths(connection, rest)
+        connection.response('213', time.strftime('%Y%m%d%H%M%S', time.gmtime(real_path.stat().st_mtime)))
+        return True
+
 
 class TestFtpDownload:
     async def test_default(self, client, loop):
@@ -124,6 +381,134 @@ class TestFtpDownload:
             assert resp.content_type == 'application/octet-stream'
             assert b'class TestFtpDownload:' in file_content
 
+    async def test_range(self, client, loop):
+        with open('tests/ftp_test.py', 'rb') as fp:
+            content = fp.read()
+        async with FtpServer(loop, host='localhost', port=2221):
+            headers = {'X-ftpproxy-host': 'localhost', 'X-ftpproxy-port': '2221', 'Range': 'bytes=10-19'}
+            params = {'path': '/tests/ftp_test.py'}
+
+            resp = await client.get('/ftp/download', headers=headers, params=params)
+
+            assert resp.status == 206
+            assert resp.headers['Content-Range'] == f'bytes 10-19/{len(content)}'
+            assert await resp.read() == content[10:20]
+
+            headers['Range'] = 'bytes=-10'
+            resp = await client.get('/ftp/download', headers=headers, params=params)
+
+            assert resp.status == 206
+            assert await resp.read() == content[-10:]
+
+            # Connection is still usable after aborted transfers
+            del headers['Range']
+            resp = await client.get('/ftp/download', headers=headers, params=params)
+
+            assert resp.status == 200
+            assert await resp.read() == content
+            stats = (await (await client.get('/stats')).json())['ftp_pool']
+            assert stats['created'] == 1
+
+    async def test_multiple_ranges(self, client, loop):
+        with open('tests/ftp_test.py', 'rb') as fp:
+            content = fp.read()
+        async with FtpServer(loop, host='localhost', port=2221):
+            headers = {'X-ftpproxy-host': 'localhost', 'X-ftpproxy-port': '2221', 'Range': 'bytes=0-4,100-109'}
+            params = {'path': '/tests/ftp_test.py'}
+
+            resp = await client.get('/ftp/download', headers=headers, params=params)
+            body = await resp.read()
+
+            assert resp.status == 206
+            assert resp.content_type == 'multipart/byteranges'
+            assert len(body) == int(resp.headers['Content-Length'])
+            assert f'Content-Range: bytes 0-4/{len(content)}\r\n\r\n'.encode() + content[:5] in body
+            assert f'Content-Range: bytes 100-109/{len(content)}\r\n\r\n'.encode() + content[100:110] in body
+
+    async def test_range_not_satisfiable(self, client, loop):
+        async with FtpServer(loop, host='localhost', port=2221):
+            headers = {'X-ftpproxy-host': 'localhost', 'X-ftpproxy-port': '2221', 'Range': 'bytes=100000000-'}
+            params = {'path': '/tests/ftp_test.py'}
+
+            resp = await client.get('/ftp/download', headers=headers, params=params)
+
+            assert resp.status == 416
+            assert resp.headers['Content-Range'].startswith('bytes */')
+
+    async def test_compression(self, client, loop):
+        async with FtpServer(loop, host='localhost', port=2221):
+            headers = {'X-ftpproxy-host': 'localhost', 'X-ftpproxy-port': '2221'}
+            params = {'path': '/README.md'}
+            with open('README.md', 'rb') as fp:
+                content = fp.read()
+
+            resp = await client.get('/ftp/download', headers={**headers, 'Accept-Encoding': 'gzip'}, params=params)
+            assert resp.headers['Content-Encoding'] == 'gzip'
+            assert resp.headers['Vary'] == 'Accept-Encoding'
+            assert await resp.read() == content
+
+            resp = await client.get('/ftp/download', headers={**headers, 'Accept-Encoding': 'identity'}, params=params)
+            assert 'Content-Encoding' not in resp.headers
+            assert resp.content_length is None or resp.content_length == len(content)
+            assert await resp.read() == content
+
+    async def test_conditional(self, client, loop):
+        async with FtpServer(loop, host='localhost', port=2221):
+            headers = {'X-ftpproxy-host': 'localhost', 'X-ftpproxy-port': '2221', 'Accept-Encoding': 'identity'}
+            params = {'path': '/tests/ftp_test.py'}
+
+            resp = await client.get('/ftp/download', headers=headers, params=params)
+            assert resp.status == 200
+            etag = resp.headers['ETag']
+            last_modified = resp.headers['Last-Modified']
+
+            resp = await client.get('/ftp/download', headers={**headers, 'If-None-Match': etag}, params=params)
+            assert resp.status == 304
+            assert resp.headers['ETag'] == etag
+            assert await resp.read() == b''
+
+            resp = await client.get('/ftp/download', headers={**headers, 'If-Modified-Since': last_modified}, params=params)
+            assert resp.status == 304
+
+            resp = await client.head('/ftp/download', headers=headers, params=params)
+            assert resp.status == 200
+            assert resp.headers['ETag'] == etag
+            assert resp.headers['Content-Length'] == str(os.path.getsize('tests/ftp_test.py'))
+
+            # Compressed files are other bytes of the same file
+            resp = await client.get('/ftp/download', headers={'X-ftpproxy-host': 'localhost', 'X-ftpproxy-port': '2221',
+                                                              'Accept-Encoding': 'gzip'}, params=params)
+            assert resp.headers['ETag'] == 'W/' + etag
+
+    async def test_conditional_without_mlst(self, client, loop):
+        async with FtpServer(loop, host='localhost', port=2221, server_class=SizeServer):
+            headers = {'X-ftpproxy-host': 'localhost', 'X-ftpproxy-port': '2221', 'Accept-Encoding': 'identity'}
+            params = {'path': '/tests/ftp_test.py'}
+
+            resp = await client.head('/ftp/download', headers=headers, params=params)
+            assert resp.status == 200
+            assert resp.headers['Content-Length'] == str(os.path.getsize('tests/ftp_test.py'))
+            resp = await client.get('/ftp/download', headers={**headers, 'If-None-Match': resp.headers['ETag']}, params=params)
+            assert resp.status == 304
+            # Never listing the parent directory instead
+            assert SizeServer.listed == []
+
+    async def test_idle_timeout(self, client, loop):
+        # One block of the server per second
+        async with FtpServer(loop, host='localhost', port=2221, write_speed_limit_per_connection=8192):
+            headers = {'X-ftpproxy-host': 'localhost', 'X-ftpproxy-port': '2221', 'X-ftpproxy-timeout-idle': '0.2',
+                       'Accept-Encoding': 'identity'}
+
+            resp = await client.get('/ftp/download', headers=headers, params={'path': '/tests/ftp_test.py'})
+            assert resp.status == 200
+            # Cut short rather than completed with an error message
+            with pytest.raises(aiohttp.ClientPayloadError):
+                await resp.read()
+
+            # The connection left mid-transfer was not kept
+            stats = (await (await client.get('/stats')).json())['ftp_pool']
+            assert stats['discarded'] == 1
+
     async def test_mandatory_path(self, client, loop):
         async with FtpServer(loop, host='localhost', port=2221):
             headers = {'X-ftpproxy-host': 'localhost', 'X-ftpproxy-port': '2221'}
@@ -142,3 +527,414 @@ class TestFtpDownload:
 
             assert resp.status == 400
             assert await resp.json() == {'error': 'path does not exists'}
+
+    async def test_download_cache(self, client, loop, tmp_path):
+        client.server.app['download_cache'] = DownloadCache(str(tmp_path), max_bytes=1024 * 1024)
+        async with FtpServer(loop, host='localhost', port=2221):
+            headers = {'X-ftpproxy-host': 'localhost', 'X-ftpproxy-port': '2221'}
+            params = {'path': '/README.md'}
+            with open('README.md', 'rb') as fp:
+                content = fp.read()
+
+            resp = await client.get('/ftp/download', headers=headers, params=params)
+            assert resp.headers['X-ftpproxy-cache'] == 'miss'
+            assert await resp.read() == content
+
+            resp = await client.get('/ftp/download', headers=headers, params=params)
+            assert resp.headers['X-ftpproxy-cache'] == 'hit'
+            assert await resp.read() == content
+
+            resp = await client.get('/ftp/download', headers={**headers, 'Range': 'bytes=0-9,-10'}, params=params)
+            assert resp.status == 206
+            assert resp.headers['X-ftpproxy-cache'] == 'hit'
+            assert content[:10] in await resp.read()
+
+            resp = await client.get('/ftp/download', headers={**headers, 'Cache-Control': 'no-cache'}, params=params)
+            assert resp.headers['X-ftpproxy-cache'] == 'miss'
+            assert await resp.read() == content
+
+
+class TestFtpUpload:
+    async def test_default(self, client, loop, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        async with FtpServer(loop, host='localhost', port=2221):
+            headers = {'X-ftpproxy-host': 'localhost', 'X-ftpproxy-port': '2221'}
+            content = os.urandom(1024 * 1024)
+
+            resp = await client.put('/ftp/upload', headers=headers, params={'path': '/upload.bin'}, data=content)
+            assert resp.status == 201, await resp.text()
+            assert await resp.json() == {'path': '/upload.bin', 'size': len(content)}
+            assert (tmp_path / 'upload.bin').read_bytes() == content
+
+    async def test_atomic(self, client, loop, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        (tmp_path / 'upload.txt').write_bytes(b'old')
+        async with FtpServer(loop, host='localhost', port=2221):
+            headers = {'X-ftpproxy-host': 'localhost', 'X-ftpproxy-port': '2221'}
+            resp = await client.get('/ftp/ls', headers={**headers, 'Cache-Control': 'max-age=60'}, params={'details': 'true'})
+            assert [entry['size'] for entry in await resp.json()] == [3]
+
+            resp = await client.put('/ftp/upload', headers=headers, params={'path': '/upload.txt', 'atomic': 'true'}, data=b'new content')
+            assert resp.status == 201, await resp.text()
+            assert os.listdir(str(tmp_path)) == ['upload.txt']
+            assert (tmp_path / 'upload.txt').read_bytes() == b'new content'
+
+            # Listings including the file were dropped from cache
+            resp = await client.get('/ftp/ls', headers={**headers, 'Cache-Control': 'max-age=60'}, params={'details': 'true'})
+            assert resp.headers['X-ftpproxy-cache'] == 'miss'
+            assert [entry['size'] for entry in await resp.json()] == [11]
+
+    async def test_mandatory_path(self, client, loop):
+        headers = {'X-ftpproxy-host': 'localhost', 'X-ftpproxy-port': '2221'}
+        resp = await client.put('/ftp/upload', headers=headers, data=b'content')
+        assert resp.status == 400
+        assert await resp.json() == {'error': 'Missing mandatory query parameter: path'}
+
+
+class TestFtpArchive:
+    async def test_paths(self, client, loop):
+        async with FtpServer(loop, host='localhost', port=2221):
+            headers = {'X-ftpproxy-host': 'localhost', 'X-ftpproxy-port': '2221'}
+            paths = ['/README.md', '/tests/ftp_test.py', '/missing.txt', '/setup.py']
+
+            resp = await client.post('/ftp/archive', headers=headers, json={'paths': paths})
+            assert resp.status == 200
+            assert resp.content_type == 'application/zip'
+
+            archive = zipfile.ZipFile(io.BytesIO(await resp.read()))
+            assert archive.namelist() == ['README.md', 'tests/ftp_test.py', 'setup.py', 'manifest.json']
+            with open('setup.py', 'rb') as fp:
+                assert archive.read('setup.py') == fp.read()
+
+            manifest = json.loads(archive.read('manifest.json'))
+            assert manifest['count'] == 4
+            assert manifest['errors'] == 1
+            assert manifest['files'][2]['path'] == '/missing.txt'
+            assert manifest['files'][2]['status'] == 'error'
+            assert manifest['files'][3] == {'path': '/setup.py', 'name': 'setup.py', 'status': 'ok',
+                                            'size': os.path.getsize('setup.py')}
+
+            # Connections were given back to the pool, and kept through the missing file error
+            stats = (await (await client.get('/stats')).json())['ftp_pool']
+            assert stats['hosts']['localhost:2221']['in_use'] == 0
+            assert stats['discarded'] == 0
+
+    async def test_connection_limit(self, client, loop):
+        async with FtpServer(loop, host='localhost', port=2221, user='foo', password='bar', maximum_connections=1):
+            headers = {'X-ftpproxy-host': 'localhost', 'X-ftpproxy-port': '2221',
+                       'X-ftpproxy-user': 'foo', 'X-ftpproxy-password': 'bar'}
+            paths = ['/README.md', '/tests/ftp_test.py', '/setup.py', '/ftp.py']
+
+            resp = await client.post('/ftp/archive', headers=headers, json={'paths': paths})
+            assert resp.status == 200
+
+            # Files were all fetched over the one connection allowed
+            archive = zipfile.ZipFile(io.BytesIO(await resp.read()))
+            assert archive.namelist() == ['README.md', 'tests/ftp_test.py', 'setup.py', 'ftp.py', 'manifest.json']
+            assert json.loads(archive.read('manifest.json'))['errors'] == 0
+
+    async def test_host_limit(self, client, loop):
+        client.server.app['host_limiter'] = HostLimiter(parse_limits(['localhost=1'], 10, 30))
+        async with FtpServer(loop, host='localhost', port=2221):
+            headers = {'X-ftpproxy-host': 'localhost', 'X-ftpproxy-port': '2221'}
+            paths = ['/README.md', '/tests/ftp_test.py', '/setup.py', '/ftp.py']
+
+            resp = await client.post('/ftp/archive', headers=headers, json={'paths': paths})
+            archive = zipfile.ZipFile(io.BytesIO(await resp.read()))
+            assert json.loads(archive.read('manifest.json'))['errors'] == 0
+
+            # Files were fetched over the one connection of the request's turn
+            stats = (await (await client.get('/stats')).json())['ftp_pool']
+            assert stats['created'] == 1
+
+    async def test_directory(self, client, loop):
+        async with FtpServer(loop, host='localhost', port=2221):
+            headers = {'X-ftpproxy-host': 'localhost', 'X-ftpproxy-port': '2221'}
+            params = {'path': '/tests', 'extension': '.py', 'format': 'tar'}
+
+            resp = await client.get('/ftp/archive', headers=headers, params=params)
+            assert resp.status == 200
+
+            archive = tarfile.open(fileobj=io.BytesIO(await resp.read()))
+            assert 'ftp_test.py' in archive.getnames()
+            with open('tests/ftp_test.py', 'rb') as fp:
+                assert archive.extractfile('ftp_test.py').read() == fp.read()
+            assert json.loads(archive.extractfile('manifest.json').read())['errors'] == 0
+
+    async def test_invalid_request(self, client, loop):
+        headers = {'X-ftpproxy-host': 'localhost', 'X-ftpproxy-port': '2221'}
+
+        resp = await client.post('/ftp/archive', headers=headers, json={'paths': '/README.md'})
+        assert resp.status == 400
+        assert await resp.json() == {'error': 'Invalid request body, expected {"paths": [<path>, ...]}'}
+
+        resp = await client.get('/ftp/archive', headers=headers)
+        assert await resp.json() == {'error': 'Missing mandatory query parameter: path'}
+
+        resp = await client.get('/ftp/archive', headers=headers, params={'path': '/', 'format': 'rar'})
+        assert await resp.json() == {'error': 'Invalid query parameter: format'}
+
+    async def test_unreachable_server(self, client, loop):
+        headers = {'X-ftpproxy-host': 'localhost', 'X-ftpproxy-port': '2221'}
+
+        resp = await client.post('/ftp/archive', headers=headers, json={'paths': ['/README.md']})
+        assert resp.status == 400
+        assert await resp.json() == {'error': 'Failed connecting to FTP server'}
+
+
+class XmdServer(aioftp.Server):
+    """Server computing MD5 checksums with the XMD5 command"""
+    async def feat(self, connection, rest):
+        connection.response('211', ['Features:', 'XMD5', 'End'], True)
+        return True
+
+    async def xmd5(self, connection, rest):
+        real_path, _ = self.get_paths(connection, rest)
+        connection.response('250', hashlib.md5(real_path.read_bytes()).hexdigest())
+        return True
+
+
+class TestFtpChecksum:
+    async def test_proxy(self, client, loop):
+        async with FtpServer(loop, host='localhost', port=2221):
+            headers = {'X-ftpproxy-host': 'localhost', 'X-ftpproxy-port': '2221'}
+            with open('setup.py', 'rb') as fp:
+                content = fp.read()
+
+            resp = await client.get('/ftp/checksum', headers=headers, params={'path': '/setup.py'})
+            assert resp.status == 200
+            assert await resp.json() == {'path': '/setup.py', 'algorithm': 'sha256', 'checksum': hashlib.sha256(content).hexdigest(),
+                                         'source': 'proxy'}
+
+            resp = await client.post('/ftp/checksum', headers=headers, params={'algorithm': 'md5'},
+                                     json={'paths': ['/setup.py', '/missing.txt']})
+            body = await resp.json()
+            assert body['count'] == 2
+            assert body['errors'] == 1
+            assert body['files'][0] == {'path': '/setup.py', 'status': 'ok', 'checksum': hashlib.md5(content).hexdigest(),
+                                        'source': 'proxy'}
+            assert body['files'][1]['status'] == 'error'
+
+            resp = await client.get('/ftp/checksum', headers=headers, params={'path': '/missing.txt'})
+            assert resp.status == 400
+
+    async def test_server(self, client, loop):
+        async with FtpServer(loop, host='localhost', port=2221, server_class=XmdServer):
+            headers = {'X-ftpproxy-host': 'localhost', 'X-ftpproxy-port': '2221'}
+            with open('setup.py', 'rb') as fp:
+                content = fp.read()
+
+            resp = await client.get('/ftp/checksum', headers=headers, params={'path': '/setup.py', 'algorithm': 'md5'})
+            assert await resp.json() == {'path': '/setup.py', 'algorithm': 'md5', 'checksum': hashlib.md5(content).hexdigest(),
+                                         'source': 'server'}
+
+            # Not supported by the server
+            resp = await client.get('/ftp/checksum', headers=headers, params={'path': '/setup.py', 'algorithm': 'sha1'})
+            assert (await resp.json())['source'] == 'proxy'
+
+    async def test_connection_limit(self, client, loop):
+        async with FtpServer(loop, host='localhost', port=2221, user='foo', password='bar', maximum_connections=1):
+            headers = {'X-ftpproxy-host': 'localhost', 'X-ftpproxy-port': '2221',
+                       'X-ftpproxy-user': 'foo', 'X-ftpproxy-password': 'bar'}
+            paths = ['/README.md', '/tests/ftp_test.py', '/setup.py', '/ftp.py']
+
+            resp = await client.post('/ftp/checksum', headers=headers, json={'paths': paths})
+            body = await resp.json()
+            assert body['errors'] == 0
+            assert [file['path'] for file in body['files']] == paths
+
+    async def test_unreachable_server(self, client, loop):
+        headers = {'X-ftpproxy-host': 'localhost', 'X-ftpproxy-port': '2221'}
+
+        resp = await client.post('/ftp/checksum', headers=headers, json={'paths': ['/README.md', '/setup.py']})
+        body = await resp.json()
+        assert body['errors'] == 2
+        assert body['files'][1] == {'path': '/setup.py', 'status': 'error', 'error': 'Failed connecting to FTP server'}
+
+    async def test_invalid_request(self, client, loop):
+        headers = {'X-ftpproxy-host': 'localhost', 'X-ftpproxy-port': '2221'}
+
+        resp = await client.get('/ftp/checksum', headers=headers)
+        assert await resp.json() == {'error': 'Missing mandatory query parameter: path'}
+
+        resp = await client.get('/ftp/checksum', headers=headers, params={'path': '/setup.py', 'algorithm': 'sha512'})
+        assert await resp.json() == {'error': 'Invalid query parameter: algorithm'}
+
+
+class TestFtpPool:
+    async def test_reuse(self, client, loop):
+        async with FtpServer(loop, host='localhost', port=2221):
+            headers = {'X-ftpproxy-host': 'localhost', 'X-ftpproxy-port': '2221'}
+
+            for _ in range(3):
+                resp = await client.get('/ftp/ping', headers=headers)
+                assert resp.status == 200
+            resp = await client.get('/ftp/ls', headers=headers)
+            assert resp.status == 200
+
+            stats = (await (await client.get('/stats')).json())['ftp_pool']
+            assert stats['created'] == 1
+            assert stats['reused'] == 3
+            assert stats['hosts'] == {'localhost:2221': {'accounts': 1, 'connections': 1, 'in_use': 0, 'idle': 1}}
+
+    async def test_reuse_after_ftp_error(self, client, loop):
+        async with FtpServer(loop, host='localhost', port=2221):
+            headers = {'X-ftpproxy-host': 'localhost', 'X-ftpproxy-port': '2221'}
+
+            resp = await client.get('/ftp/download', headers=headers, params={'path': '/foo'})
+            assert resp.status == 400
+            resp = await client.get('/ftp/download', headers=headers, params={'path': '/tests/ftp_test.py'})
+            assert resp.status == 200
+            assert b'class TestFtpPool:' in await resp.read()
+
+            stats = (await (await client.get('/stats')).json())['ftp_pool']
+            assert stats['created'] == 1
+            assert stats['discarded'] == 0
+
+    async def test_health_check(self, client, loop, monkeypatch):
+        checked = []
+        check = ftp.FtpPool._check
+
+        async def record(self, connection):
+            checked.append(connection)
+            return await check(self, connection)
+
+        monkeypatch.setattr(ftp.FtpPool, '_check', record)
+        async with FtpServer(loop, host='localhost', port=2221):
+            headers = {'X-ftpproxy-host': 'localhost', 'X-ftpproxy-port': '2221'}
+            for _ in range(3):
+                resp = await client.get('/ftp/ping', headers=headers)
+                assert resp.status == 200
+            # Connections used recently are most likely alive
+            assert checked == []
+
+            pool = client.server.app['ftp_pool']
+            [[entry]] = pool._entries.values()
+            entry.last_used -= pool.check_after + 1
+            resp = await client.get('/ftp/ping', headers=headers)
+            assert resp.status == 200
+            assert checked == [entry.connection]
+
+    async def test_forget_servers(self, client, loop):
+        headers = {'X-ftpproxy-host': 'localhost', 'X-ftpproxy-port': '2221'}
+        pool = client.server.app['ftp_pool']
+        async with FtpServer(loop, host='localhost', port=2221):
+            resp = await client.get('/ftp/ping', headers=headers)
+            assert resp.status == 200
+
+        # Neither the connection closed by the server, nor failed connections, are remembered
+        for _ in range(2):
+            resp = await client.get('/ftp/ping', headers=headers)
+            assert resp.status == 400
+        assert pool.stats()['discarded'] == 1
+        assert not pool._entries and not pool._conditions and not pool._opening and not pool._waiting
+
+    async def test_stale_connection(self, client, loop):
+        headers = {'X-ftpproxy-host': 'localhost', 'X-ftpproxy-port': '2221'}
+        # Checked however recently used
+        client.server.app['ftp_pool'].check_after = 0
+        async with FtpServer(loop, host='localhost', port=2221):
+            resp = await client.get('/ftp/ping', headers=headers)
+            assert resp.status == 200
+
+        async with FtpServer(loop, host='localhost', port=2221):
+            resp = await client.get('/ftp/ping', headers=headers)
+            assert resp.status == 200
+
+        stats = (await (await client.get('/stats')).json())['ftp_pool']
+        assert stats['created'] == 2
+        assert stats['discarded'] == 1
+
+    async def test_concurrent_requests(self, client, loop):
+        async with FtpServer(loop, host='localhost', port=2221):
+            headers = {'X-ftpproxy-host': 'localhost', 'X-ftpproxy-port': '2221'}
+
+            # Distinct listings, identical ones would share a single upstream listing
+            responses = await asyncio.gather(*[client.get('/ftp/ls', headers=headers, params={'extension': f'.{i}'}) for i in range(10)])
+            assert all(resp.status == 200 for resp in responses)
+
+            stats = (await (await client.get('/stats')).json())['ftp_pool']
+            assert stats['created'] <= stats['max_size']
+            assert stats['created'] + stats['reused'] == 10
+
+    async def test_host_limit(self, client, loop):
+        client.server.app['host_limiter'] = HostLimiter(parse_limits(['localhost=2:1'], 10, 30))
+        async with FtpServer(loop, host='localhost', port=2221):
+            headers = {'X-ftpproxy-host': 'localhost', 'X-ftpproxy-port': '2221'}
+
+            responses = await asyncio.gather(*[client.get('/ftp/ls', headers=headers, params={'extension': f'.{i}'}) for i in range(6)])
+            statuses = sorted(resp.status for resp in responses)
+            assert statuses == [200, 200, 200, 503, 503, 503]
+            busy = [resp for resp in responses if resp.status == 503]
+            assert int(busy[0].headers['Retry-After']) >= 1
+
+            stats = (await (await client.get('/stats')).json())['host_limits']
+            assert stats['hosts'] == {}
+            assert stats['rejected'] == 3
+
+
+class TestFtpListingCache:
+    async def test_max_age(self, client, loop):
+        async with FtpServer(loop, host='localhost', port=2221):
+            headers = {'X-ftpproxy-host': 'localhost', 'X-ftpproxy-port': '2221', 'Cache-Control': 'max-age=60'}
+
+            resp = await client.get('/ftp/ls', headers=headers)
+            assert resp.headers['X-ftpproxy-cache'] == 'miss'
+            listing = await resp.json()
+
+            resp = await client.get('/ftp/ls', headers=headers)
+            assert resp.headers['X-ftpproxy-cache'] == 'hit'
+            assert await resp.json() == listing
+
+            # Listing options are part of the cache key
+            resp = await client.get('/ftp/ls', headers=headers, params={'extension': '.py'})
+            assert resp.headers['X-ftpproxy-cache'] == 'miss'
+
+            headers['Cache-Control'] = 'no-cache'
+            resp = await client.get('/ftp/ls', headers=headers)
+            assert resp.headers['X-ftpproxy-cache'] == 'miss'
+
+            stats = (await (await client.get('/stats')).json())['listing_cache']
+            assert stats['hits'] == 1
+            assert stats['misses'] == 3
+            assert stats['entries'] == 2
+
+    async def test_disabled_by_default(self, client, loop):
+        async with FtpServer(loop, host='localhost', port=2221):
+            headers = {'X-ftpproxy-host': 'localhost', 'X-ftpproxy-port': '2221'}
+
+            for _ in range(2):
+                resp = await client.get('/ftp/ls', headers=headers)
+                assert resp.headers['X-ftpproxy-cache'] == 'miss'
+
+    async def test_invalidate(self, client, loop):
+        async with FtpServer(loop, host='localhost', port=2221):
+            headers = {'X-ftpproxy-host': 'localhost', 'X-ftpproxy-port': '2221', 'Cache-Control': 'max-age=60'}
+
+            await client.get('/ftp/ls', headers=headers)
+            await client.get('/ftp/ls', headers=headers, params={'path': '/tests'})
+
+            resp = await client.post('/ftp/cache/invalidate', headers=headers, params={'path': '/tests/ftp_test.py'})
+            assert await resp.json() == {'invalidated': 1}
+
+            resp = await client.get('/ftp/ls', headers=headers)
+            assert resp.headers['X-ftpproxy-cache'] == 'hit'
+            resp = await client.get('/ftp/ls', headers=headers, params={'path': '/tests'})
+            assert resp.headers['X-ftpproxy-cache'] == 'miss'
+
+            resp = await client.post('/ftp/cache/invalidate', headers=headers)
+            assert await resp.json() == {'invalidated': 2}
+
+    async def test_single_flight(self, client, loop):
+        async with FtpServer(loop, host='localhost', port=2221):
+            headers = {'X-ftpproxy-host': 'localhost', 'X-ftpproxy-port': '2221'}
+            params = {'recursive': 'true'}
+
+            responses = await asyncio.gather(*[client.get('/ftp/ls', headers=headers, params=params) for _ in range(10)])
+            listings = [await resp.json() for resp in responses]
+
+            assert all(listing == listings[0] for listing in listings)
+            stats = await (await client.get('/stats')).json()
+            # A single walk, over its own control connections
+            assert stats['ftp_pool']['created'] <= config.FTP_WALK_CONNECTIONS
+            assert stats['listing_cache']['shared'] == 9
@@ -0,0 +1,143 @@
+import asyncio
+
+from aiohttp import web
+from aiohttp.test_utils import make_mocked_request
+import pytest
+
+from errors import ServerBusy
+from limits import HostLimiter, SharedSlots, admit, parse_limits
+
+
+class Lease:
+    async def __aenter__(self):
+        return 'connection'
+
+    async def __aexit__(self, *args):
+        pass
+
+
+class TestHostLimiter:
+    def test_parse_limits(self):
+        assert parse_limits(['*.partner.com=2:10:5', '*=8'], 100, 30) == [
+            ('*.partner.com', 2, 10, 5.0),
+            ('*', 8, 100, 30),
+        ]
+        with pytest.raises(ValueError):
+            parse_limits(['8'], 100, 30)
+
+    async def test_shared_slots(self, tmp_path):
+        # Limiters of two workers sharing their turns
+        limits = parse_limits(['*=2'], 10, 30)
+        first, second = [HostLimiter(limits, SharedSlots(str(tmp_path))) for _ in range(2)]
+        try:
+            assert await first.acquire('localhost')
+            assert await second.acquire('localhost')
+            waiting = [asyncio.ensure_future(limiter.acquire('localhost')) for limiter in (first, second, second)]
+            await asyncio.sleep(0.1)
+            assert not any(task.done() for task in waiting)
+
+            # Freed turns go to the waiting requests of any worker
+            first.release('localhost')
+            await asyncio.sleep(0.1)
+            assert [task.done() for task in waiting] == [True, False, False]
+            second.release('localhost')
+            await asyncio.sleep(0.1)
+            assert [task.done() for task in waiting] == [True, True, False]
+            assert first.stats()['hosts']['localhost']['active'] + second.stats()['hosts']['localhost']['active'] == 2
+
+            first.release('localhost')
+            await asyncio.sleep(0.1)
+            assert all(task.done() for task in waiting)
+        finally:
+            first.close()
+            second.close()
+
+    async def test_unlimited_host(self):
+        limiter = HostLimiter(parse_limits(['*.partner.com=1'], 10, 30))
+        assert not await limiter.acquire('localhost')
+        assert not await limiter.acquire('localhost')
+
+    async def test_order(self):
+        limiter = HostLimiter(parse_limits(['*=1'], 10, 30))
+        assert await limiter.acquire('localhost')
+        admitted = []
+
+        async def request(name):
+            await limiter.acquire('localhost')
+            admitted.append(name)
+
+        waiting = [asyncio.ensure_future(request(name)) for name in 'abc']
+        await asyncio.sleep(0)
+        limiter.release('localhost')
+        # Turns are handed over, never taken by requests arriving meanwhile
+        waiting.append(asyncio.ensure_future(request('d')))
+        for _ in range(3):
+            await asyncio.sleep(0)
+            limiter.release('localhost')
+        await asyncio.gather(*waiting)
+        assert admitted == ['a', 'b', 'c', 'd']
+        assert limiter.stats()['hosts'] == {'localhost': {'limit': 1, 'active': 1, 'waiting': 0}}
+
+    async def test_queue_full(self):
+        limiter = HostLimiter(parse_limits(['*=1:1'], 10, 30))
+        await limiter.acquire('localhost')
+        waiting = asyncio.ensure_future(limiter.acquire('localhost'))
+        await asyncio.sleep(0)
+
+        with pytest.raises(ServerBusy) as error:
+            await limiter.acquire('localhost')
+        assert error.value.status == 503
+        assert int(error.value.headers['Retry-After']) >= 1
+        assert limiter.stats()['rejected'] == 1
+
+        limiter.release('localhost')
+        assert await waiting
+
+    async def test_queue_timeout(self):
+        limiter = HostLimiter(parse_limits(['*=1:10:0.01'], 10, 30))
+        await limiter.acquire('localhost')
+        with pytest.raises(ServerBusy):
+            await limiter.acquire('localhost')
+        assert limiter.stats()['timeouts'] == 1
+        assert limiter.stats()['hosts']['localhost']['waiting'] == 0
+
+        limiter.release('localhost')
+        assert limiter.stats()['hosts'] == {}
+
+    async def test_cancelled_waiter(self):
+        limiter = HostLimiter(parse_limits(['*=1'], 10, 30))
+        await limiter.acquire('localhost')
+        waiting = asyncio.ensure_future(limiter.acquire('localhost'))
+        await asyncio.sleep(0)
+        waiting.cancel()
+        await asyncio.gather(waiting, return_exceptions=True)
+
+        limiter.release('localhost')
+        assert limiter.stats()['hosts'] == {}
+
+    async def test_connections_of_a_request(self):
+        app = web.Application()
+        limiter = app['host_limiter'] = HostLimiter(parse_limits(['*=2'], 10, 30))
+        request, other_request = [make_mocked_request('GET', '/ftp/archive', app=app) for _ in range(2)]
+
+        # Concurrent connections of a request take a turn each, when one is free
+        first, second, third = [admit(request, 'localhost', Lease()) for _ in range(3)]
+        await first.__aenter__()
+        await second.__aenter__()
+        with pytest.raises(ServerBusy):
+            await third.__aenter__()
+        assert limiter.stats()['hosts']['localhost']['active'] == 2
+
+        # Handed over once the connection is closed
+        waiting = asyncio.ensure_future(admit(other_request, 'localhost', Lease()).__aenter__())
+        await asyncio.sleep(0)
+        assert not waiting.done()
+        await second.__aexit__(None, None, None)
+        assert await waiting == 'connection'
+
+        # The request keeps its own turn until it is handled
+        await first.__aexit__(None, None, None)
+        assert limiter.stats()['hosts']['localhost']['active'] == 2
+        request['admission'].finish()
+        other_request['admission'].finish()
+        assert limiter.stats()['hosts'] == {}
@@ -0,0 +1,52 @@
+import metrics
+from ftp_test import FtpServer
+
+
+class TestMetrics:
+    def test_counter(self):
+        counter = metrics.Counter('test_requests_total', 'Requests', ['route'])
+        metrics.REGISTRY.remove(counter)
+        counter.inc('/ftp/ls')
+        counter.inc('/ftp/ls', value=2)
+        counter.inc('/a"b')
+
+        assert counter.render() == [
+            '# HELP test_requests_total Requests',
+            '# TYPE test_requests_total counter',
+            'test_requests_total{route="/ftp/ls"} 3',
+            'test_requests_total{route="/a\\"b"} 1',
+        ]
+
+    def test_histogram(self):
+        histogram = metrics.Histogram('test_duration_seconds', 'Duration', ['route'], buckets=[0.1, 1])
+        metrics.REGISTRY.remove(histogram)
+        histogram.observe(0.05, '/ftp/ls')
+        histogram.observe(0.5, '/ftp/ls')
+        histogram.observe(5, '/ftp/ls')
+
+        assert histogram.render()[2:] == [
+            'test_duration_seconds_bucket{route="/ftp/ls",le="0.1"} 1',
+            'test_duration_seconds_bucket{route="/ftp/ls",le="1"} 2',
+            'test_duration_seconds_bucket{route="/ftp/ls",le="+Inf"} 3',
+            'test_duration_seconds_sum{route="/ftp/ls"} 5.55',
+            'test_duration_seconds_count{route="/ftp/ls"} 3',
+        ]
+
+    async def test_export(self, client, loop):
+        async with FtpServer(loop, host='localhost', port=2221):
+            headers = {'X-ftpproxy-host': 'localhost', 'X-ftpproxy-port': '2221'}
+            resp = await client.get('/ftp/download', headers=headers, params={'path': '/README.md'})
+            await resp.read()
+            await client.get('/ftp/ls')
+
+            resp = await client.get('/metrics')
+            assert resp.status == 200
+            assert resp.content_type == 'text/plain'
+            samples = dict(line.rsplit(' ', 1) for line in (await resp.text()).splitlines() if not line.startswith('#'))
+
+        assert int(samples['ftpproxy_request_duration_seconds_count{route="/ftp/download",method="GET",status="200"}']) >= 1
+        assert float(samples['ftpproxy_response_bytes_total{route="/ftp/download"}']) > 0
+        assert float(samples['ftpproxy_errors_total{error="MissingHostHeader"}']) >= 1
+        assert int(samples['ftpproxy_upstream_auth_seconds_count{protocol="ftp"}']) >= 1
+        assert samples['ftpproxy_upstream_connections{protocol="ftp",host="localhost:2221",state="idle"}'] == '1'
+        assert samples['ftpproxy_requests_in_progress{route="/metrics",method="GET"}'] == '1'
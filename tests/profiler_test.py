@@ -0,0 +1,48 @@
+import threading
+import time
+
+import config
+from profiler import sample_stacks
+
+
+def busy(stop):
+    while not stop.is_set():
+        time.sleep(0.001)
+
+
+class TestProfiler:
+    def test_sample_stacks(self):
+        stop = threading.Event()
+        thread = threading.Thread(target=busy, args=(stop,))
+        thread.start()
+        threading.Timer(0.1, stop.set).start()
+        stacks = sample_stacks(thread.ident, stop, interval=0.001)
+        thread.join()
+
+        assert stacks
+        assert all(stack.split(';')[-1].startswith('busy (profiler_test.py:') for stack in stacks)
+
+    async def test_admin_only(self, client, monkeypatch):
+        resp = await client.get('/debug/profile', params={'seconds': '1'})
+        assert resp.status == 403
+
+        monkeypatch.setattr(config, 'ADMIN_TOKEN', 'secret')
+        resp = await client.get('/debug/profile', params={'seconds': '1'}, headers={'Authorization': 'Bearer wrong'})
+        assert resp.status == 403
+        assert await resp.json() == {'error': 'Missing or invalid admin token'}
+
+    async def test_profile(self, client, monkeypatch):
+        monkeypatch.setattr(config, 'ADMIN_TOKEN', 'secret')
+        headers = {'Authorization': 'Bearer secret'}
+        resp = await client.get('/debug/profile', params={'seconds': '61'}, headers=headers)
+        assert resp.status == 400
+
+        resp = await client.get('/debug/profile', params={'seconds': '1'}, headers=headers)
+        assert resp.status == 200
+        lines = (await resp.text()).splitlines()
+        assert lines
+        for line in lines:
+            stack, count = line.rsplit(' ', 1)
+            assert int(count) > 0
+        # The loop waits for events between requests
+        assert any('select (selectors.py:' in line for line in lines)
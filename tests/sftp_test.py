@@ -1,9 +1,24 @@
+import asyncio
+import hashlib
+import io
+import json
+import os
+import tempfile
+import zipfile
 
 import asyncssh
+from asyncssh.constants import FXP_EXTENDED_REPLY
+from asyncssh.packet import String
 
 
 import pytest
 
+import config
+import sftp
+from changes import SnapshotStore
+from download_cache import DownloadCache
+from ftp_test import make_tree
+
 
 class SFTPServer(asyncssh.SFTPServer):
     def __init__(self, conn):
@@ -82,6 +97,28 @@ class TestFtpPing:
         resp = await client.get('/sftp/ping', headers=headers)
         assert resp.status == 200
 
+    async def test_auth_timeout(self, client):
+        async def silent(reader, writer):
+            await asyncio.sleep(1)
+            writer.close()
+
+        # Accepts connections without ever starting the SSH handshake
+        server = await asyncio.start_server(silent, 'localhost', 8022)
+        try:
+            headers = {
+                'X-ftpproxy-host': 'localhost',
+                'X-ftpproxy-port': '8022',
+                'X-ftpproxy-user': 'foo',
+                'X-ftpproxy-password': 'password',
+                'X-ftpproxy-timeout-auth': '0.1',
+            }
+            resp = await client.get('/sftp/ping', headers=headers)
+            assert resp.status == 504
+            assert await resp.json() == {'error': 'Timed out logging in to the server'}
+        finally:
+            server.close()
+            await server.wait_closed()
+
 
 class TestSftpLs:
     async def test_default(self, client, sftp_server):
@@ -155,6 +192,166 @@ class TestSftpLs:
         assert resp.status == 400
         assert await resp.json() == {'error': 'No such file or directory'}
 
+    async def test_stream(self, client, sftp_server):
+        headers = {
+            'X-ftpproxy-host': 'localhost',
+            'X-ftpproxy-port': '8022',
+            'X-ftpproxy-user': 'foo',
+            'X-ftpproxy-password': 'password',
+            'Accept': 'application/x-ndjson',
+        }
+
+        resp = await client.get('/sftp/ls', headers=headers, params={'path': '/tests'})
+        lines = [json.loads(line) for line in (await resp.text()).splitlines()]
+
+        assert resp.status == 200
+        assert '/tests/sftp_test.py' in lines
+        assert lines[-1] == {'status': 'ok', 'count': len(lines) - 1}
+
+    async def test_recursive(self, client, sftp_server):
+        headers = {
+            'X-ftpproxy-host': 'localhost',
+            'X-ftpproxy-port': '8022',
+            'X-ftpproxy-user': 'foo',
+            'X-ftpproxy-password': 'password',
+        }
+        params = {'recursive': 'true', 'extension': '.py'}
+
+        resp = await client.get('/sftp/ls', headers=headers, params=params)
+        assert resp.status == 200
+
+        response_data = await resp.json()
+        assert '/ftp_proxy.py' in response_data
+        assert '/tests/sftp_test.py' in response_data
+        assert '/README.md' not in response_data
+
+        params['max_depth'] = '0'
+        resp = await client.get('/sftp/ls', headers=headers, params=params)
+        response_data = await resp.json()
+        assert '/ftp_proxy.py' in response_data
+        assert '/tests/sftp_test.py' not in response_data
+
+    async def test_details(self, client, sftp_server):
+        headers = {
+            'X-ftpproxy-host': 'localhost',
+            'X-ftpproxy-port': '8022',
+            'X-ftpproxy-user': 'foo',
+            'X-ftpproxy-password': 'password',
+        }
+
+        resp = await client.get('/sftp/ls', headers=headers, params={'details': 'true'})
+        assert resp.status == 200
+        entries = {entry['path']: entry for entry in await resp.json()}
+
+        readme = entries['/README.md']
+        assert readme['type'] == 'file'
+        assert readme['size'] == os.path.getsize('README.md')
+        assert readme['permissions'] == f'{os.stat("README.md").st_mode & 0o7777:04o}'
+        assert readme['modified'].endswith('Z')
+        assert entries['/tests']['type'] == 'dir'
+
+    async def test_recursive_symlinks(self, client, sftp_server):
+        headers = {
+            'X-ftpproxy-host': 'localhost',
+            'X-ftpproxy-port': '8022',
+            'X-ftpproxy-user': 'foo',
+            'X-ftpproxy-password': 'password',
+        }
+        with tempfile.TemporaryDirectory(dir='.') as root:
+            os.makedirs(os.path.join(root, 'a', 'b'))
+            open(os.path.join(root, 'a', 'b', 'file.txt'), 'w').close()
+            # Link back to an ancestor
+            os.symlink(os.path.abspath(root), os.path.join(root, 'a', 'b', 'loop'))
+            path = '/' + os.path.basename(root)
+            params = {'path': path, 'recursive': 'true'}
+
+            resp = await client.get('/sftp/ls', headers=headers, params=params)
+            response_data = await resp.json()
+            assert sorted(response_data) == [f'{path}/a', f'{path}/a/b', f'{path}/a/b/file.txt', f'{path}/a/b/loop']
+
+            params['follow_symlinks'] = 'true'
+            resp = await client.get('/sftp/ls', headers=headers, params=params)
+            response_data = await resp.json()
+            assert sorted(response_data) == [f'{path}/a', f'{path}/a/b', f'{path}/a/b/file.txt', f'{path}/a/b/loop']
+
+    async def test_invalid_max_depth(self, client, sftp_server):
+        headers = {
+            'X-ftpproxy-host': 'localhost',
+            'X-ftpproxy-port': '8022',
+            'X-ftpproxy-user': 'foo',
+            'X-ftpproxy-password': 'password',
+        }
+
+        resp = await client.get('/sftp/ls', headers=headers, params={'recursive': 'true', 'max_depth': 'deep'})
+        assert resp.status == 400
+        assert await resp.json() == {'error': 'Invalid query parameter: max_depth'}
+
+    async def test_filters(self, client, sftp_server, monkeypatch):
+        headers = {
+            'X-ftpproxy-host': 'localhost',
+            'X-ftpproxy-port': '8022',
+            'X-ftpproxy-user': 'foo',
+            'X-ftpproxy-password': 'password',
+        }
+        listed = []
+        read_directory = sftp._read_directory
+
+        async def record(sftp, directory, *args):
+            listed.append(directory)
+            return await read_directory(sftp, directory, *args)
+
+        monkeypatch.setattr(sftp, '_read_directory', record)
+        with tempfile.TemporaryDirectory(dir='.') as root:
+            make_tree(root)
+            path = '/' + os.path.basename(root)
+            params = {'path': path, 'recursive': 'true', 'include': 'incoming/2026-10-*/**/*.csv'}
+
+            resp = await client.get('/sftp/ls', headers=headers, params=params)
+            assert resp.status == 200
+            assert sorted(await resp.json()) == [f'{path}/incoming/2026-10-01/a.csv', f'{path}/incoming/2026-10-01/sub/b.csv']
+            # Other folders were never read
+            assert sorted(listed) == [f'{path}/', f'{path}/incoming/', f'{path}/incoming/2026-10-01/', f'{path}/incoming/2026-10-01/sub/']
+
+            params = {'path': path, 'recursive': 'true', 'exclude_regex': r'\.txt$', 'min_size': '2',
+                      'modified_since': '1790812801'}
+            resp = await client.get('/sftp/ls', headers=headers, params=params)
+            assert await resp.json() == []
+            params['modified_since'] = '2026-10-01'
+            resp = await client.get('/sftp/ls', headers=headers, params=params)
+            assert sorted(await resp.json()) == [f'{path}/incoming/2026-09-30/c.csv', f'{path}/incoming/2026-10-01/a.csv',
+                                                 f'{path}/incoming/2026-10-01/sub/b.csv', f'{path}/outgoing/d.csv']
+
+
+class TestSftpChanges:
+    async def test_default(self, client, sftp_server, tmp_path):
+        client.server.app['snapshots'] = SnapshotStore(str(tmp_path), max_bytes=1024 * 1024)
+        headers = {
+            'X-ftpproxy-host': 'localhost',
+            'X-ftpproxy-port': '8022',
+            'X-ftpproxy-user': 'foo',
+            'X-ftpproxy-password': 'password',
+        }
+        with tempfile.TemporaryDirectory(dir='.') as root:
+            make_tree(root)
+            path = '/' + os.path.basename(root)
+            params = {'path': path, 'recursive': 'true'}
+
+            resp = await client.get('/sftp/changes', headers=headers, params=params)
+            assert resp.status == 200
+            changes = await resp.json()
+            assert f'{path}/incoming/2026-10-01/sub' in [entry['path'] for entry in changes['added']]
+
+            os.utime(os.path.join(root, 'outgoing', 'd.csv'), (1790812801, 1790812801))
+            params['cursor'] = changes['cursor']
+            resp = await client.get('/sftp/changes', headers=headers, params=params)
+            changes = await resp.json()
+            assert changes['added'] == changes['removed'] == []
+            assert [entry['path'] for entry in changes['modified']] == [f'{path}/outgoing/d.csv']
+
+            client.server.app['snapshots'] = SnapshotStore(str(tmp_path / 'other'), max_bytes=1024 * 1024)
+            resp = await client.get('/sftp/changes', headers=headers, params=params)
+            assert resp.status == 410
+
 
 class TestSftpDownload:
     async def test_default(self, client, sftp_server):
@@ -172,6 +369,67 @@ class TestSftpDownload:
         assert resp.content_type == 'application/octet-stream'
         assert b'class TestSftpDownload:' in file_content
         assert resp.status == 200
+        phases = [item.split(';')[0] for item in resp.headers['Server-Timing'].split(', ')]
+        assert phases == ['connect', 'auth', 'session', 'first_byte', 'total']
+
+    async def test_conditional(self, client, sftp_server):
+        params = {'path': '/tests/sftp_test.py'}
+        headers = {
+            'X-ftpproxy-host': 'localhost',
+            'X-ftpproxy-port': '8022',
+            'X-ftpproxy-user': 'foo',
+            'X-ftpproxy-password': 'password',
+        }
+
+        resp = await client.head('/sftp/download', headers=headers, params=params)
+        assert resp.status == 200
+        assert resp.headers['Content-Length'] == str(os.path.getsize('tests/sftp_test.py'))
+
+        resp = await client.get('/sftp/download', headers={**headers, 'If-None-Match': resp.headers['ETag']}, params=params)
+        assert resp.status == 304
+
+    async def test_pipelined_blocks(self, client, sftp_server, monkeypatch):
+        monkeypatch.setattr(config, 'SFTP_BLOCK_SIZE', 100)
+        monkeypatch.setattr(config, 'SFTP_READ_WINDOW', 4)
+        params = {'path': '/tests/sftp_test.py'}
+        headers = {
+            'X-ftpproxy-host': 'localhost',
+            'X-ftpproxy-port': '8022',
+            'X-ftpproxy-user': 'foo',
+            'X-ftpproxy-password': 'password',
+        }
+
+        resp = await client.get('/sftp/download', headers=headers, params=params)
+        assert resp.status == 200
+        with open('tests/sftp_test.py', 'rb') as fp:
+            assert await resp.read() == fp.read()
+
+    async def test_range(self, client, sftp_server):
+        with open('tests/sftp_test.py', 'rb') as fp:
+            content = fp.read()
+        params = {'path': '/tests/sftp_test.py'}
+        headers = {
+            'X-ftpproxy-host': 'localhost',
+            'X-ftpproxy-port': '8022',
+            'X-ftpproxy-user': 'foo',
+            'X-ftpproxy-password': 'password',
+            'Range': 'bytes=10-19,-10',
+        }
+
+        resp = await client.get('/sftp/download', headers=headers, params=params)
+        body = await resp.read()
+
+        assert resp.status == 206
+        assert resp.content_type == 'multipart/byteranges'
+        assert content[10:20] in body
+        assert content[-10:] in body
+
+        headers['Range'] = 'bytes=100-'
+        resp = await client.get('/sftp/download', headers=headers, params=params)
+
+        assert resp.status == 206
+        assert resp.headers['Content-Range'] == f'bytes 100-{len(content) - 1}/{len(content)}'
+        assert await resp.read() == content[100:]
 
     async def test_download_folder(self, client, sftp_server):
         params = {'path': '/tests'}
@@ -185,3 +443,292 @@ class TestSftpDownload:
         resp = await client.get('/sftp/download', headers=headers, params=params)
         assert resp.status == 400
         assert await resp.json() == {'error': 'Is a directory'}
+
+    async def test_download_cache(self, client, sftp_server, tmp_path):
+        client.server.app['download_cache'] = DownloadCache(str(tmp_path), max_bytes=1024 * 1024)
+        headers = {
+            'X-ftpproxy-host': 'localhost',
+            'X-ftpproxy-port': '8022',
+            'X-ftpproxy-user': 'foo',
+            'X-ftpproxy-password': 'password',
+        }
+        with open('README.md', 'rb') as fp:
+            content = fp.read()
+
+        resp = await client.get('/sftp/download', headers=headers, params={'path': 'README.md'})
+        assert resp.headers['X-ftpproxy-cache'] == 'miss'
+        assert await resp.read() == content
+
+        resp = await client.get('/sftp/download', headers=headers, params={'path': 'README.md'})
+        assert resp.headers['X-ftpproxy-cache'] == 'hit'
+        assert await resp.read() == content
+        assert client.server.app['download_cache'].stats()['hits'] == 1
+
+
+class TestSftpUpload:
+    async def test_default(self, client, sftp_server, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        headers = {
+            'X-ftpproxy-host': 'localhost',
+            'X-ftpproxy-port': '8022',
+            'X-ftpproxy-user': 'foo',
+            'X-ftpproxy-password': 'password',
+        }
+        content = os.urandom(1024 * 1024)
+
+        resp = await client.put('/sftp/upload', headers=headers, params={'path': '/upload.bin'}, data=content)
+        assert resp.status == 201, await resp.text()
+        assert await resp.json() == {'path': '/upload.bin', 'size': len(content)}
+        assert (tmp_path / 'upload.bin').read_bytes() == content
+
+    async def test_atomic(self, client, sftp_server, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        (tmp_path / 'upload.txt').write_bytes(b'old')
+        client.server.app['download_cache'] = DownloadCache(str(tmp_path / 'cache'), max_bytes=1024 * 1024)
+        headers = {
+            'X-ftpproxy-host': 'localhost',
+            'X-ftpproxy-port': '8022',
+            'X-ftpproxy-user': 'foo',
+            'X-ftpproxy-password': 'password',
+        }
+        resp = await client.get('/sftp/download', headers=headers, params={'path': '/upload.txt'})
+        assert await resp.read() == b'old'
+
+        resp = await client.put('/sftp/upload', headers=headers, params={'path': '/upload.txt', 'atomic': 'true'}, data=b'new content')
+        assert resp.status == 201, await resp.text()
+        assert sorted(os.listdir(str(tmp_path))) == ['cache', 'upload.txt']
+        assert client.server.app['download_cache'].stats()['files'] == 0
+
+        resp = await client.get('/sftp/download', headers=headers, params={'path': '/upload.txt'})
+        assert await resp.read() == b'new content'
+
+    async def test_write_window(self):
+        written = []
+
+        class File:
+            async def write(self, data, offset):
+                await asyncio.sleep(0.01)
+                written.append((offset, data))
+
+        async def chunks():
+            for chunk in (b'abc', b'de', b'fghi'):
+                yield chunk
+
+        assert await sftp.write_file(File(), chunks(), window=2) == 9
+        assert sorted(written) == [(0, b'abc'), (3, b'de'), (5, b'fghi')]
+
+
+class TestSftpArchive:
+    async def test_directory(self, client, sftp_server):
+        headers = {
+            'X-ftpproxy-host': 'localhost',
+            'X-ftpproxy-port': '8022',
+            'X-ftpproxy-user': 'foo',
+            'X-ftpproxy-password': 'password',
+        }
+        params = {'path': '/', 'recursive': 'true', 'extension': '.py'}
+
+        resp = await client.get('/sftp/archive', headers=headers, params=params)
+        assert resp.status == 200
+
+        archive = zipfile.ZipFile(io.BytesIO(await resp.read()))
+        assert 'tests/sftp_test.py' in archive.namelist()
+        with open('tests/sftp_test.py', 'rb') as fp:
+            assert archive.read('tests/sftp_test.py') == fp.read()
+
+        resp = await client.post('/sftp/archive', headers=headers, json={'paths': ['README.md', 'tests']})
+        archive = zipfile.ZipFile(io.BytesIO(await resp.read()))
+        manifest = json.loads(archive.read('manifest.json'))
+        assert [entry['status'] for entry in manifest['files']] == ['ok', 'error']
+
+
+class Reply(bytes):
+    """Extended reply of a test SFTP server"""
+    def encode(self):
+        return bytes(self)
+
+
+class TestSftpChecksum:
+    async def test_proxy(self, client, sftp_server):
+        headers = {
+            'X-ftpproxy-host': 'localhost',
+            'X-ftpproxy-port': '8022',
+            'X-ftpproxy-user': 'foo',
+            'X-ftpproxy-password': 'password',
+        }
+        with open('setup.py', 'rb') as fp:
+            content = fp.read()
+
+        resp = await client.get('/sftp/checksum', headers=headers, params={'path': 'setup.py', 'algorithm': 'sha1'})
+        assert resp.status == 200
+        assert await resp.json() == {'path': 'setup.py', 'algorithm': 'sha1', 'checksum': hashlib.sha1(content).hexdigest(),
+                                     'source': 'proxy'}
+
+        resp = await client.post('/sftp/checksum', headers=headers, json={'paths': ['setup.py', 'missing.txt']})
+        body = await resp.json()
+        assert [file['status'] for file in body['files']] == ['ok', 'error']
+
+    async def test_check_file(self, client, sftp_server, monkeypatch):
+        async def check_file(handler, packet):
+            path = packet.get_string().decode()
+            algorithm = packet.get_string()
+            packet.get_remaining_payload()
+            with open(path, 'rb') as fp:
+                return Reply(String('check-file') + String(algorithm) + hashlib.md5(fp.read()).digest())
+
+        monkeypatch.setitem(asyncssh.sftp.SFTPServerHandler._packet_handlers, b'check-file-name', check_file)
+        monkeypatch.setitem(asyncssh.sftp.SFTPServerHandler._return_types, b'check-file-name', FXP_EXTENDED_REPLY)
+        headers = {
+            'X-ftpproxy-host': 'localhost',
+            'X-ftpproxy-port': '8022',
+            'X-ftpproxy-user': 'foo',
+            'X-ftpproxy-password': 'password',
+        }
+        with open('setup.py', 'rb') as fp:
+            content = fp.read()
+
+        resp = await client.get('/sftp/checksum', headers=headers, params={'path': 'setup.py', 'algorithm': 'md5'})
+        assert await resp.json() == {'path': 'setup.py', 'algorithm': 'md5', 'checksum': hashlib.md5(content).hexdigest(),
+                                     'source': 'server'}
+
+        # Later asyncssh versions take the packet fields as a tuple
+        send_request = asyncssh.sftp.SFTPClientHandler._send_request
+
+        def send_request_args(handler, pkttype, args, waiter):
+            send_request(handler, pkttype, *args, waiter=waiter)
+
+        monkeypatch.setattr(asyncssh.sftp.SFTPClientHandler, '_send_request', send_request_args)
+        resp = await client.get('/sftp/checksum', headers=headers, params={'path': 'setup.py', 'algorithm': 'md5'})
+        assert (await resp.json())['source'] == 'server'
+
+    async def test_check_file_failure(self, client, sftp_server, monkeypatch):
+        send_request = asyncssh.sftp.SFTPClientHandler._send_request
+
+        def send_request_failing(handler, pkttype, *args, **kwargs):
+            if pkttype == b'check-file-name':
+                raise TypeError('private API changed')
+            send_request(handler, pkttype, *args, **kwargs)
+
+        monkeypatch.setattr(asyncssh.sftp.SFTPClientHandler, '_send_request', send_request_failing)
+        headers = {
+            'X-ftpproxy-host': 'localhost',
+            'X-ftpproxy-port': '8022',
+            'X-ftpproxy-user': 'foo',
+            'X-ftpproxy-password': 'password',
+        }
+        with open('setup.py', 'rb') as fp:
+            content = fp.read()
+
+        # Hashed by the proxy rather than failing
+        resp = await client.get('/sftp/checksum', headers=headers, params={'path': 'setup.py', 'algorithm': 'md5'})
+        assert await resp.json() == {'path': 'setup.py', 'algorithm': 'md5', 'checksum': hashlib.md5(content).hexdigest(),
+                                     'source': 'proxy'}
+
+
+class TestSftpPool:
+    async def test_reuse(self, client, sftp_server):
+        headers = {
+            'X-ftpproxy-host': 'localhost',
+            'X-ftpproxy-port': '8022',
+            'X-ftpproxy-user': 'foo',
+            'X-ftpproxy-password': 'password',
+        }
+
+        for route in ('/sftp/ping', '/sftp/ls', '/sftp/ping'):
+            resp = await client.get(route, headers=headers)
+            assert resp.status == 200
+
+        resp = await client.get('/sftp/ls', headers=headers, params={'path': '/foo'})
+        assert resp.status == 400
+        resp = await client.get('/sftp/download', headers=headers, params={'path': '/tests/sftp_test.py'})
+        assert resp.status == 200
+        assert b'class TestSftpPool:' in await resp.read()
+
+        stats = (await (await client.get('/stats')).json())['sftp_pool']
+        assert stats['created'] == 1
+        assert stats['reused'] == 4
+        assert stats['hosts'] == {'localhost:8022': {'accounts': 1, 'connections': 1, 'in_use': 0, 'idle': 1}}
+
+    async def test_closed_channel(self, client, sftp_server):
+        headers = {
+            'X-ftpproxy-host': 'localhost',
+            'X-ftpproxy-port': '8022',
+            'X-ftpproxy-user': 'foo',
+            'X-ftpproxy-password': 'password',
+        }
+        resp = await client.get('/sftp/ping', headers=headers)
+        assert resp.status == 200
+
+        # The idle channel is found closed and replaced, the connection kept
+        pool = client.server.app['sftp_pool']
+        pool.check_after = 0
+        [channels] = pool._channels.values()
+        channels[0].exit()
+        await asyncio.sleep(0.01)
+        resp = await client.get('/sftp/ls', headers=headers)
+        assert resp.status == 200
+        assert len(channels) == 1 and channels[0]._handler._writer is not None
+        assert pool.stats()['created'] == 1
+
+        # Channels failing with a lost connection are not parked again
+        conn = next(iter(pool._channels))
+        sftp = channels.pop()
+        await pool._unlease(conn, sftp, asyncssh.SFTPError(asyncssh.FX_CONNECTION_LOST, 'Connection lost'))
+        assert channels == []
+        pool.evict(conn)
+        await pool._unlease(conn, await conn.start_sftp_client(), None)
+        assert conn not in pool._channels
+        conn.close()
+
+    async def test_concurrent_channels(self, client, sftp_server):
+        headers = {
+            'X-ftpproxy-host': 'localhost',
+            'X-ftpproxy-port': '8022',
+            'X-ftpproxy-user': 'foo',
+            'X-ftpproxy-password': 'password',
+        }
+
+        # Distinct listings, identical ones would share a single upstream listing
+        responses = await asyncio.gather(*[client.get('/sftp/ls', headers=headers, params={'extension': f'.{i}'}) for i in range(20)])
+        assert all(resp.status == 200 for resp in responses)
+
+        stats = (await (await client.get('/stats')).json())['sftp_pool']
+        assert stats['created'] <= stats['max_size']
+        assert stats['created'] + stats['reused'] == 20
+
+
+class ShortReadFile:
+    """Remote file stub returning at most 3 bytes per read request"""
+    def __init__(self, content):
+        self.content = content
+        self.requests = []
+
+    async def read(self, size, offset):
+        self.requests.append((offset, size))
+        await asyncio.sleep(0)
+        return self.content[offset:offset + min(size, 3)]
+
+
+class TestIterFile:
+    async def test_short_reads(self):
+        fp = ShortReadFile(b'0123456789' * 5)
+
+        blocks = [block async for block in sftp.iter_file(fp, size=50, block_size=8, window=3)]
+
+        assert b''.join(blocks) == fp.content
+        assert [len(block) for block in blocks] == [8] * 6 + [2]
+
+    async def test_range(self):
+        fp = ShortReadFile(b'0123456789' * 5)
+
+        blocks = [block async for block in sftp.iter_file(fp, offset=12, size=10, block_size=4, window=2)]
+
+        assert b''.join(blocks) == fp.content[12:22]
+        assert min(offset for offset, _ in fp.requests) == 12
+
+    async def test_truncated_file(self):
+        fp = ShortReadFile(b'0123456789')
+
+        blocks = [block async for block in sftp.iter_file(fp, size=50, block_size=8, window=3)]
+
+        assert b''.join(blocks) == fp.content
@@ -0,0 +1,94 @@
+import asyncio
+import functools
+
+from aiohttp import web
+from aiohttp.test_utils import make_mocked_request
+import pytest
+
+from limits import HostLimiter, admission_middleware, admit, parse_limits
+import metrics
+from singleflight import SingleFlight, flight_key
+
+
+CREDENTIALS = ('localhost', 21, 'anonymous', '')
+
+
+class TestSingleFlight:
+    def test_key(self):
+        assert flight_key('ftp', CREDENTIALS, 'ls', path='/a', recursive=True) == flight_key('ftp', CREDENTIALS, 'ls', recursive=True, path='/a')
+        assert flight_key('ftp', CREDENTIALS, 'ls', path='/a') != flight_key('sftp', CREDENTIALS, 'ls', path='/a')
+        assert flight_key('ftp', CREDENTIALS, 'ping') != flight_key('ftp', ('localhost', 21, 'anonymous', 'secret'), 'ping')
+
+    async def test_shared(self):
+        flights = SingleFlight('test')
+        calls = []
+
+        async def func():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return len(calls)
+
+        shared = metrics.COALESCED_REQUESTS._values[('test',)]
+        assert await asyncio.gather(*[flights.run('a', func) for _ in range(5)]) == [1] * 5
+        assert metrics.COALESCED_REQUESTS._values[('test',)] - shared == 4
+        assert not flights.running('a')
+        # Later calls run again
+        assert await flights.run('a', func) == 2
+
+    async def test_error(self):
+        flights = SingleFlight('test')
+
+        async def func():
+            await asyncio.sleep(0.01)
+            raise ValueError('boom')
+
+        results = await asyncio.gather(*[flights.run('a', func) for _ in range(3)], return_exceptions=True)
+        assert all(isinstance(result, ValueError) for result in results)
+
+    async def test_waiter_cancelled(self):
+        flights = SingleFlight('test')
+
+        async def func():
+            await asyncio.sleep(0.01)
+            return 'done'
+
+        first = asyncio.ensure_future(flights.run('a', func))
+        second = asyncio.ensure_future(flights.run('a', func))
+        await asyncio.sleep(0)
+        first.cancel()
+        assert await second == 'done'
+        with pytest.raises(asyncio.CancelledError):
+            await first
+
+    async def test_first_request_gone(self):
+        # The first request going away while waiting for its turn leaves the run to the others
+        app = web.Application()
+        limiter = app['host_limiter'] = HostLimiter(parse_limits(['*=1'], 10, 30))
+        await limiter.acquire('localhost')
+        flights = SingleFlight('test')
+
+        class Lease:
+            async def __aenter__(self):
+                return 'connection'
+
+            async def __aexit__(self, *args):
+                pass
+
+        async def ping(request):
+            async with admit(request, 'localhost', Lease()):
+                return 'pong'
+
+        async def handler(request):
+            return await flights.run('a', functools.partial(ping, request))
+
+        first, second = [make_mocked_request('GET', '/ftp/ping', app=app) for _ in range(2)]
+        first_task = asyncio.ensure_future(admission_middleware(first, handler))
+        second_task = asyncio.ensure_future(admission_middleware(second, handler))
+        await asyncio.sleep(0.01)
+        first_task.cancel()
+        await asyncio.sleep(0.01)
+
+        limiter.release('localhost')
+        assert await second_task == 'pong'
+        # The turn of the run is released with it
+        assert limiter.stats()['hosts'] == {}
@@ -0,0 +1,66 @@
+import asyncio
+
+from aiohttp import web
+from aiohttp.test_utils import make_mocked_request
+import pytest
+
+from errors import InvalidTimeoutHeader, UpstreamTimeout
+from timeouts import HostTimeouts, Timeouts, parse_timeouts, request_timeouts, timed
+
+
+DEFAULTS = Timeouts(10, 10, 30, 60)
+
+
+def make_request(headers=None):
+    app = web.Application()
+    app['host_timeouts'] = HostTimeouts(parse_timeouts(['*.slow.example.com=::120:300'], DEFAULTS), DEFAULTS)
+    return make_mocked_request('GET', '/ftp/download', headers=headers, app=app)
+
+
+async def chunks(*delays):
+    for delay in delays:
+        await asyncio.sleep(delay)
+        yield delay
+
+
+class TestTimeouts:
+    def test_parse(self):
+        assert parse_timeouts(['*.example.com=5:1', 'ftp.local=::60:'], DEFAULTS) == [
+            ('*.example.com', Timeouts(5, 1, 30, 60)),
+            ('ftp.local', Timeouts(10, 10, 60, 60)),
+        ]
+        with pytest.raises(ValueError):
+            parse_timeouts(['1:2:3:4'], DEFAULTS)
+        with pytest.raises(ValueError):
+            parse_timeouts(['ftp.local=1:2:3:4:5'], DEFAULTS)
+
+    def test_request(self):
+        assert request_timeouts(make_request(), 'ftp.example.com') == DEFAULTS
+        assert request_timeouts(make_request(), 'ftp.slow.example.com') == Timeouts(10, 10, 120, 300)
+
+        request = make_request({'X-ftpproxy-timeout-idle': '600', 'X-ftpproxy-timeout-first-byte': '1.5'})
+        assert request_timeouts(request, 'ftp.slow.example.com') == Timeouts(10, 10, 1.5, 600)
+
+        for value in ('soon', '0'):
+            with pytest.raises(InvalidTimeoutHeader):
+                request_timeouts(make_request({'X-ftpproxy-timeout-connect': value}), 'ftp.example.com')
+
+    async def test_timed(self):
+        timeouts = Timeouts(1, 1, 0.2, 0.05)
+        assert [chunk async for chunk in timed(chunks(0.1, 0, 0.01), timeouts)] == [0.1, 0, 0.01]
+
+        with pytest.raises(UpstreamTimeout) as error:
+            [chunk async for chunk in timed(chunks(0.3), timeouts)]
+        assert error.value.phase == 'first_byte'
+
+        with pytest.raises(UpstreamTimeout) as error:
+            [chunk async for chunk in timed(chunks(0, 0.01, 0.1), timeouts)]
+        assert error.value.phase == 'idle'
+
+    async def test_slow_consumer(self):
+        # Only the time spent waiting for the server counts
+        received = []
+        async for chunk in timed(chunks(0, 0, 0), Timeouts(1, 1, 0.05, 0.05)):
+            received.append(chunk)
+            await asyncio.sleep(0.1)
+        assert received == [0, 0, 0]
@@ -0,0 +1,65 @@
+import json
+import logging
+
+import config
+import tracing
+from ftp_test import FtpServer
+
+
+class TestTrace:
+    def test_server_timing(self):
+        trace = tracing.Trace()
+        trace.add('connect', 0.012)
+        trace.add('read', 0.5)
+        trace.add('read', 0.25)
+        phases = [item.split(';dur=') for item in trace.server_timing().split(', ')]
+        assert [name for name, _ in phases] == ['connect', 'read', 'total']
+        assert [duration for _, duration in phases[:2]] == ['12.0', '750.0']
+
+    def test_phase(self):
+        # Nothing is traced outside of requests
+        with tracing.phase('connect'):
+            pass
+
+        trace = tracing.Trace()
+        token = tracing._current.set(trace)
+        try:
+            try:
+                with tracing.phase('connect'):
+                    raise OSError
+            except OSError:
+                pass
+            tracing.add('auth', 0.1)
+        finally:
+            tracing._current.reset(token)
+        assert list(trace.phases) == ['connect', 'auth']
+
+    async def test_request(self, client, loop, monkeypatch, caplog):
+        monkeypatch.setattr(config, 'TRACE_SAMPLE_RATE', 1)
+        async with FtpServer(loop, host='localhost', port=2221):
+            headers = {'X-ftpproxy-host': 'localhost', 'X-ftpproxy-port': '2221'}
+            with caplog.at_level(logging.INFO, logger='ftpproxy.trace'):
+                resp = await client.get('/ftp/download', headers=headers, params={'path': '/README.md'})
+                await resp.read()
+            assert resp.status == 200
+
+            phases = [item.split(';')[0] for item in resp.headers['Server-Timing'].split(', ')]
+            assert phases == ['connect', 'auth', 'data', 'first_byte', 'total']
+
+            record = json.loads(caplog.records[-1].getMessage())
+            assert record['route'] == '/ftp/download'
+            assert record['status'] == 200
+            # Phases after the response headers are only logged
+            assert {'connect', 'auth', 'data', 'first_byte', 'write'} <= set(record['phases_ms'])
+
+    async def test_sampling(self, client, monkeypatch, caplog):
+        monkeypatch.setattr(config, 'TRACE_SAMPLE_RATE', 0)
+        with caplog.at_level(logging.INFO, logger='ftpproxy.trace'):
+            resp = await client.get('/stats')
+        assert 'total;dur=' in resp.headers['Server-Timing']
+        assert not caplog.records
+
+        monkeypatch.setattr(config, 'TRACE_SLOW_REQUEST', 0.000001)
+        with caplog.at_level(logging.INFO, logger='ftpproxy.trace'):
+            await client.get('/stats')
+        assert json.loads(caplog.records[-1].getMessage())['slow'] is True
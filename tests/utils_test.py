@@ -0,0 +1,108 @@
+import json
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import make_mocked_request
+
+from errors import RangeNotSatisfiable, ServerUnreachable, error_middleware
+from utils import not_modified, parse_range, stream_json_lines, validators
+
+
+class TestParseRange:
+    def test_no_header(self):
+        assert parse_range(None, 100) is None
+        assert parse_range('', 100) is None
+
+    def test_single(self):
+        assert parse_range('bytes=0-9', 100) == [(0, 9)]
+        assert parse_range('bytes=90-', 100) == [(90, 99)]
+        assert parse_range('bytes=90-200', 100) == [(90, 99)]
+
+    def test_suffix(self):
+        assert parse_range('bytes=-10', 100) == [(90, 99)]
+        assert parse_range('bytes=-200', 100) == [(0, 99)]
+
+    def test_multiple(self):
+        assert parse_range('bytes=0-9, 20-29,-5', 100) == [(0, 9), (20, 29), (95, 99)]
+
+    def test_malformed(self):
+        assert parse_range('items=0-9', 100) is None
+        assert parse_range('bytes=9-0', 100) is None
+        assert parse_range('bytes=a-b', 100) is None
+        assert parse_range('bytes=10', 100) is None
+
+    def test_unsatisfiable(self):
+        with pytest.raises(RangeNotSatisfiable) as error:
+            parse_range('bytes=100-', 100)
+        assert error.value.headers == {'Content-Range': 'bytes */100'}
+
+    def test_partly_satisfiable(self):
+        assert parse_range('bytes=150-160,0-0', 100) == [(0, 0)]
+
+
+class TestConditional:
+    def test_validators(self):
+        assert validators(1024, 1700000000.5) == {'ETag': '"18bcfe569f4-400"', 'Last-Modified': 'Tue, 14 Nov 2023 22:13:20 GMT'}
+        assert validators(1024, None) == {}
+
+    def test_not_modified(self):
+        def request(**headers):
+            return make_mocked_request('GET', '/ftp/download', headers=headers)
+
+        assert not not_modified(request(), 1024, 1700000000.5)
+        assert not_modified(request(**{'If-None-Match': '"other", W/"18bcfe569f4-400"'}), 1024, 1700000000.5)
+        assert not_modified(request(**{'If-None-Match': '*'}), 1024, 1700000000.5)
+        assert not not_modified(request(**{'If-None-Match': '"18bcfe569f4-400"'}), 1025, 1700000000.5)
+        assert not_modified(request(**{'If-Modified-Since': 'Tue, 14 Nov 2023 22:13:20 GMT'}), 1024, 1700000000.5)
+        assert not not_modified(request(**{'If-Modified-Since': 'Tue, 14 Nov 2023 22:13:19 GMT'}), 1024, 1700000000.5)
+        # If-None-Match takes precedence
+        assert not not_modified(request(**{'If-None-Match': '"other"', 'If-Modified-Since': 'Tue, 14 Nov 2023 22:13:20 GMT'}),
+                                1024, 1700000000.5)
+        # Without modification time
+        assert not not_modified(request(**{'If-None-Match': '*'}), 1024, None)
+
+
+class TestStreamJsonLines:
+    @staticmethod
+    async def listing_client(aiohttp_client, entries):
+        async def handler(request):
+            return await stream_json_lines(request, entries())
+
+        app = web.Application(middlewares=[error_middleware])
+        app.router.add_get('/', handler)
+        return await aiohttp_client(app)
+
+    async def test_error_after_first_entry(self, aiohttp_client):
+        async def entries():
+            yield '/a'
+            yield '/b'
+            raise ServerUnreachable
+
+        client = await self.listing_client(aiohttp_client, entries)
+        resp = await client.get('/')
+
+        assert resp.status == 200
+        assert resp.content_type == 'application/x-ndjson'
+        lines = [json.loads(line) for line in (await resp.text()).splitlines()]
+        assert lines == ['/a', '/b', {'status': 'error', 'error': 'Failed connecting to FTP server', 'count': 2}]
+
+    async def test_error_before_first_entry(self, aiohttp_client):
+        async def entries():
+            raise ServerUnreachable
+            yield
+
+        client = await self.listing_client(aiohttp_client, entries)
+        resp = await client.get('/')
+
+        assert resp.status == 400
+        assert await resp.json() == {'error': 'Failed connecting to FTP server'}
+
+    async def test_empty(self, aiohttp_client):
+        async def entries():
+            return
+            yield
+
+        client = await self.listing_client(aiohttp_client, entries)
+        resp = await client.get('/')
+
+        assert await resp.text() == '{"status": "ok", "count": 0}\n'
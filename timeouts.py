@@ -0,0 +1,147 @@
+
+import asyncio
+import collections
+import fnmatch
+import time
+
+import config
+from errors import InvalidTimeoutHeader, UpstreamTimeout
+import tracing
+
+
+# Seconds allowed to open the connection, to log in, for the server to start
+# answering an operation, and between two chunks once data flows
+Timeouts = collections.namedtuple('Timeouts', 'connect auth first_byte idle')
+
+
+def default_timeouts():
+    return Timeouts(config.TIMEOUT_CONNECT, config.TIMEOUT_AUTH, config.TIMEOUT_FIRST_BYTE, config.TIMEOUT_IDLE)
+
+
+def parse_timeouts(items, defaults):
+    """(pattern, Timeouts) of "<pattern>=<connect>:<auth>:<first byte>:<idle>" items, empty values keeping `defaults`"""
+    timeouts = []
+    for item in items:
+        pattern, equal, values = item.rpartition('=')
+        values = values.split(':')
+        if not equal or not pattern or len(values) > len(Timeouts._fields):
+            raise ValueError(f'Invalid host timeouts: {item}')
+        values += [''] * (len(Timeouts._fields) - len(values))
+        timeouts.append((pattern.strip(), Timeouts(*[float(value) if value else default
+                                                     for value, default in zip(values, defaults)])))
+    return timeouts
+
+
+class HostTimeouts:
+    """Timeouts of the first pattern matching the host name of a server, the defaults when none does"""
+
+    def __init__(self, timeouts, defaults):
+        self.timeouts = timeouts
+        self.defaults = defaults
+        self._hosts = {}
+
+    def get(self, host):
+        timeouts = self._hosts.get(host)
+        if timeouts is None:
+            timeouts = next((timeouts for pattern, timeouts in self.timeouts if fnmatch.fnmatch(host, pattern)), self.defaults)
+            self._hosts[host] = timeouts
+        return timeouts
+
+
+def request_timeouts(request, host):
+    """Timeouts of a request to `host`, X-ftpproxy-timeout-<phase> headers overriding those of the server"""
+    timeouts = request.app['host_timeouts'].get(host)
+    overrides = {}
+    for phase in Timeouts._fields:
+        header = 'X-ftpproxy-timeout-' + phase.replace('_', '-')
+        value = request.headers.get(header)
+        if value is None:
+            continue
+        try:
+            overrides[phase] = float(value)
+        except ValueError:
+            raise InvalidTimeoutHeader(header)
+        if not overrides[phase] > 0:
+            raise InvalidTimeoutHeader(header)
+    return timeouts._replace(**overrides) if overrides else timeouts
+
+
+async def within(awaitable, timeout, phase):
+    """Result of `awaitable`, failing with UpstreamTimeout after `timeout` seconds spent in `phase`"""
+    try:
+        return await asyncio.wait_for(awaitable, timeout)
+    except asyncio.TimeoutError:
+        raise UpstreamTimeout(phase)
+
+
+class _Deadline:
+    """Cancel the task waiting for a server once it waited too long
+
+    A single timer is kept for a whole transfer, pushed back as chunks come,
+    rather than a timer and a task per chunk.
+    """
+
+    def __init__(self):
+        self.loop = asyncio.get_event_loop()
+        self.task = None
+        self.expires = None
+        self.expired = False
+        self._handle = None
+
+    def wait(self, timeout):
+        self.task = asyncio.current_task()
+        self.expires = self.loop.time() + timeout
+        if self._handle is None or self._handle.when() > self.expires:
+            self.cancel()
+            self._handle = self.loop.call_at(self.expires, self._check)
+
+    def done(self):
+        self.expires = None
+
+    def _check(self):
+        self._handle = None
+        if self.expires is None:
+            return
+        if self.loop.time() < self.expires:
+            self._handle = self.loop.call_at(self.expires, self._check)
+            return
+        self.expired = True
+        self.task.cancel()
+
+    def cancel(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+
+async def timed(chunks, timeouts):
+    """Iterate over `chunks` read from a server, waiting up to the first byte timeout for the first one, then the idle timeout
+
+    The waits are traced as the first_byte and read phases of the request.
+    """
+    chunks = chunks.__aiter__()
+    deadline = _Deadline()
+    trace = tracing.current()
+    phase, timeout = 'first_byte', timeouts.first_byte
+    try:
+        while True:
+            deadline.wait(timeout)
+            start = time.monotonic()
+            try:
+                chunk = await chunks.__anext__()
+            except StopAsyncIteration:
+                return
+            except asyncio.CancelledError:
+                if deadline.expired:
+                    raise UpstreamTimeout(phase)
+                raise
+            finally:
+                deadline.done()
+                if trace is not None:
+                    trace.add('first_byte' if phase == 'first_byte' else 'read', time.monotonic() - start)
+            yield chunk
+            phase, timeout = 'idle', timeouts.idle
+    finally:
+        deadline.cancel()
+        if hasattr(chunks, 'aclose'):
+            await chunks.aclose()
@@ -0,0 +1,118 @@
+
+import contextlib
+import contextvars
+import json
+import logging
+import random
+import time
+
+from aiohttp import web
+
+import config
+import metrics
+
+
+logger = logging.getLogger('ftpproxy.trace')
+
+# Trace of the request being handled, seen by the pools and the tasks started for the request
+_current = contextvars.ContextVar('trace', default=None)
+
+
+class Trace:
+    """Seconds spent by a request in each phase, summed when a phase runs several times
+
+    Phases of concurrent operations, such as the files of an archive, are
+    summed as well and may add up to more than the request duration.
+    """
+
+    def __init__(self):
+        self.start = time.monotonic()
+        self.phases = {}
+
+    def add(self, phase, seconds):
+        self.phases[phase] = self.phases.get(phase, 0) + seconds
+
+    def elapsed(self):
+        return time.monotonic() - self.start
+
+    def server_timing(self):
+        """Server-Timing header value of the phases so far, in milliseconds"""
+        return ', '.join(f'{phase};dur={seconds * 1000:.1f}'
+                         for phase, seconds in [*self.phases.items(), ('total', self.elapsed())])
+
+
+def current():
+    return _current.get()
+
+
+def add(phase, seconds):
+    """Count `seconds` in `phase` of the request being handled, if any"""
+    trace = _current.get()
+    if trace is not None:
+        trace.add(phase, seconds)
+
+
+@contextlib.contextmanager
+def phase(name):
+    """Time the block as phase `name` of the request being handled, whether it succeeds or not"""
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        add(name, time.monotonic() - start)
+
+
+async def write(response, data):
+    """Send `data`, the time waiting for a slow client to take it counting as the write phase"""
+    start = time.monotonic()
+    await response.write(data)
+    add('write', time.monotonic() - start)
+
+
+def setup_logging():
+    """Write traces to stderr, unless logging is configured elsewhere"""
+    if not logger.handlers and not logging.getLogger().handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+
+
+def _log(request, trace, status):
+    duration = trace.elapsed()
+    slow = config.TRACE_SLOW_REQUEST and duration >= config.TRACE_SLOW_REQUEST
+    if not slow and random.random() >= config.TRACE_SAMPLE_RATE:
+        return
+    logger.info(json.dumps({
+        'route': metrics.route_label(request),
+        'method': request.method,
+        'host': request.headers.get('X-ftpproxy-host'),
+        'status': status,
+        'duration_ms': round(duration * 1000, 1),
+        'phases_ms': {phase: round(seconds * 1000, 1) for phase, seconds in trace.phases.items()},
+        'slow': bool(slow),
+    }))
+
+
+async def add_server_timing(request, response):
+    """Send the phases of the request up to its response headers, later phases are only logged"""
+    trace = request.get('trace')
+    if trace is not None:
+        response.headers['Server-Timing'] = trace.server_timing()
+
+
+@web.middleware
+async def tracing_middleware(request, handler):
+    trace = request['trace'] = Trace()
+    token = _current.set(trace)
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as exc:
+        status = exc.status
+        raise
+    finally:
+        _current.reset(token)
+        _log(request, trace, status)
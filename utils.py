@@ -1,9 +1,20 @@
 
-import functools
+import datetime
+import email.utils
+import json
+import posixpath
+import stat
+import uuid
 
-import asyncio
+from aiohttp import web
 
-from errors import MissingHostHeader, InvalidPortHeader, MissingUserHeader, ServerUnreachable
+import compression
+from errors import (FtpProxyError, MissingHostHeader, InvalidPortHeader, MissingUserHeader, RangeNotSatisfiable,
+                    InvalidQueryParameter)
+import tracing
+
+
+MAX_RANGES = 16
 
 
 def parse_headers(request, default_port=21, default_user='anonymous', default_password=''):
@@ -25,15 +36,245 @@ def parse_headers(request, default_port=21, default_user='anonymous', default_pa
     return host, port, user, password
 
 
-def asyncio_timeout(timeout):
-    def decorator(func):
-        @functools.wraps(func)
-        async def wrapper(*args, **kwargs):
-            future = func(*args, **kwargs)
-            try:
-                # Shield inside a timeout
-                return await asyncio.wait_for(future, timeout)
-            except asyncio.TimeoutError:
-                raise ServerUnreachable  # TODO change error message ftom FTP to SFTP
-        return wrapper
-    return decorator
+def parse_int(request, name, default=None):
+    """Parse an optional integer query parameter"""
+    value = request.query.get(name)
+    if value is None or value == '':
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise InvalidQueryParameter(name)
+
+
+def parse_range(header, size):
+    """Parse a "Range: bytes=..." header into a list of inclusive (start, end) offsets
+
+    Returns None when the whole file should be sent, as for a malformed header.
+    """
+    if not header:
+        return None
+    unit, _, specs = header.partition('=')
+    if unit.strip() != 'bytes':
+        return None
+
+    ranges = []
+    for spec in specs.split(','):
+        first, dash, last = spec.strip().partition('-')
+        try:
+            if not dash:
+                return None
+            if not first:
+                # Suffix range: last N bytes
+                length = int(last)
+                if length == 0:
+                    continue
+                start, end = max(size - length, 0), size - 1
+            else:
+                start = int(first)
+                end = int(last) if last else None
+        except ValueError:
+            return None
+        if start < 0 or (end is not None and end < start):
+            return None
+        if start >= size:
+            continue
+        ranges.append((start, size - 1 if end is None else min(end, size - 1)))
+
+    if not ranges:
+        raise RangeNotSatisfiable(size)
+    if len(ranges) > MAX_RANGES:
+        return None
+    return ranges
+
+
+def validators(size, mtime):
+    """ETag and Last-Modified headers of a remote file, from its size and modification time when known"""
+    if size is None or mtime is None:
+        return {}
+    return {
+        'ETag': f'"{int(mtime * 1000):x}-{size:x}"',
+        'Last-Modified': email.utils.formatdate(mtime, usegmt=True),
+    }
+
+
+def _opaque_tag(tag):
+    # Weak comparison, as for If-None-Match
+    tag = tag.strip()
+    return tag[2:] if tag.startswith('W/') else tag
+
+
+def not_modified(request, size, mtime):
+    """Whether the client already has the remote file, according to If-None-Match or else If-Modified-Since"""
+    etag = validators(size, mtime).get('ETag')
+    if etag is None:
+        return False
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match is not None:
+        tags = {_opaque_tag(tag) for tag in if_none_match.split(',')}
+        return '*' in tags or etag in tags
+    since = request.if_modified_since
+    # Last-Modified only has a one second resolution
+    return since is not None and int(mtime) <= since.timestamp()
+
+
+def conditional_response(request, size, mtime):
+    """Response answered from the size and modification time of a remote file alone, None when its content must be sent
+
+    Clients already having the file get a 304, HEAD requests get the headers
+    of the download without opening a transfer.
+    """
+    headers = validators(size, mtime)
+    if not_modified(request, size, mtime):
+        return web.Response(status=304, headers=headers)
+    if request.method == 'HEAD':
+        response = web.Response(headers={**headers, 'Accept-Ranges': 'bytes'}, content_type='application/octet-stream')
+        if size is not None:
+            response.headers['Content-Length'] = str(size)
+        return response
+    return None
+
+
+async def _write_chunks(response, chunks, first=b''):
+    if first:
+        await tracing.write(response, first)
+    async for chunk in chunks:
+        await tracing.write(response, chunk)
+
+
+async def _first_chunk(chunks):
+    """Start reading before sending the response, so that upstream errors can still be reported"""
+    try:
+        return await chunks.__anext__()
+    except StopAsyncIteration:
+        return b''
+
+
+async def stream_download(request, read_range, size=None, headers=None, path=None):
+    """Stream a remote file honouring the Range header
+
+    `read_range(offset, length)` iterates over the file content, from `offset`
+    until the end of file when `length` is None. Ranges are only honoured when
+    the file `size` is known. Whole files are compressed as negotiated from
+    the Accept-Encoding header when their `path` is given.
+    """
+    ranges = parse_range(request.headers.get('Range'), size) if size is not None else None
+
+    response = web.StreamResponse(headers=headers)
+    response.headers['Accept-Ranges'] = 'bytes'
+    if ranges is None:
+        chunks = read_range(0, size)
+        first = await _first_chunk(chunks)
+        response.content_type = 'application/octet-stream'
+        encoding = None
+        if path is not None:
+            response.headers['Vary'] = 'Accept-Encoding'
+            encoding = compression.negotiate(request, path, size, first)
+        if encoding is None:
+            response.content_length = size
+        else:
+            response.headers['Content-Encoding'] = encoding
+            etag = response.headers.get('ETag')
+            if etag is not None and not etag.startswith('W/'):
+                # Same file, other bytes
+                response.headers['ETag'] = 'W/' + etag
+            chunks, first = compression.compress(encoding, chunks, first), b''
+        await response.prepare(request)
+        await _write_chunks(response, chunks, first)
+        return response
+
+    response.set_status(206)
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        chunks = read_range(start, end - start + 1)
+        first = await _first_chunk(chunks)
+        response.content_type = 'application/octet-stream'
+        response.content_length = end - start + 1
+        response.headers['Content-Range'] = f'bytes {start}-{end}/{size}'
+        await response.prepare(request)
+        await _write_chunks(response, chunks, first)
+        return response
+
+    boundary = uuid.uuid4().hex
+    parts = [(f'--{boundary}\r\n'
+              'Content-Type: application/octet-stream\r\n'
+              f'Content-Range: bytes {start}-{end}/{size}\r\n\r\n').encode() for start, end in ranges]
+    closing = f'--{boundary}--\r\n'.encode()
+    start, end = ranges[0]
+    chunks = read_range(start, end - start + 1)
+    first = await _first_chunk(chunks)
+    response.content_type = f'multipart/byteranges; boundary={boundary}'
+    response.content_length = sum(len(part) + end - start + 3 for part, (start, end) in zip(parts, ranges)) + len(closing)
+    await response.prepare(request)
+    for part, (start, end) in zip(parts, ranges):
+        await response.write(part)
+        if first is None:
+            chunks = read_range(start, end - start + 1)
+        await _write_chunks(response, chunks, first)
+        first = None
+        await response.write(b'\r\n')
+    await response.write(closing)
+    return response
+
+
+def listing_entry(path, type, size=None, modified=None, mode=None):
+    """Listing entry of `?details=true`, from a POSIX timestamp and mode when known"""
+    if modified is not None:
+        modified = datetime.datetime.utcfromtimestamp(modified).strftime('%Y-%m-%dT%H:%M:%SZ')
+    return {
+        'path': path,
+        'type': type,
+        'size': size,
+        'modified': modified,
+        'permissions': None if mode is None else f'{stat.S_IMODE(mode):04o}',
+    }
+
+
+def temporary_path(path):
+    """Hidden sibling of `path` an atomic upload is written to, before being renamed to `path`"""
+    directory, name = posixpath.split(path)
+    return posixpath.join(directory, f'.{name}.{uuid.uuid4().hex[:12]}.part')
+
+
+def wants_stream(request):
+    """Whether a listing should be streamed as newline delimited JSON"""
+    return request.query.get('stream', 'false') == 'true' or 'application/x-ndjson' in request.headers.get('Accept', '')
+
+
+async def stream_json_lines(request, entries, summary=None):
+    """Stream listing `entries` as newline delimited JSON, as soon as they are listed
+
+    A last {"status": ...} line tells whether the listing completed, with the
+    error message when it failed after the response was sent. Fields returned
+    by `summary()` are added to it once the listing completed.
+    """
+    entries = entries.__aiter__()
+    try:
+        try:
+            # Errors occurring before the first entry are reported as usual
+            first = [await entries.__anext__()]
+        except StopAsyncIteration:
+            first = []
+
+        response = web.StreamResponse()
+        response.content_type = 'application/x-ndjson'
+        await response.prepare(request)
+
+        count = 0
+        try:
+            for entry in first:
+                await tracing.write(response, json.dumps(entry).encode() + b'\n')
+                count += 1
+            async for entry in entries:
+                await tracing.write(response, json.dumps(entry).encode() + b'\n')
+                count += 1
+        except FtpProxyError as error:
+            status = {'status': 'error', 'error': error.message, 'count': count}
+        else:
+            status = {'status': 'ok', 'count': count, **(summary() if summary else {})}
+        await response.write(json.dumps(status).encode() + b'\n')
+        return response
+    finally:
+        # Release the upstream connection right away when the client went away
+        if hasattr(entries, 'aclose'):
+            await entries.aclose()